@@ -0,0 +1,253 @@
+# MIT License
+
+# Copyright (c) 2020 FT Autonomous Team One
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Scripted experts driving the cars, to generate demonstrations for pretraining policies
+"""
+
+import numpy as np
+import unittest
+
+from f110_gym.envs.track_progress import TrackProgress
+
+# distance between the axles of the default vehicle, lf + lr (see F110Env params)
+WHEELBASE = 0.15875 + 0.17145
+
+
+def load_raceline(path):
+    """
+    Loads a raceline of f1tenth_racetracks, ';' separated with '#' header lines:
+    s_m; x_m; y_m; psi_rad; kappa_radpm; vx_mps; ax_mps2
+
+    Returns:
+        waypoints (np.ndarray (n, 2)): x, y of each point
+        speeds (np.ndarray (n, )): target speed at each point
+    """
+    raceline = np.loadtxt(path, delimiter=';', comments='#')
+    return raceline[:, 1:3], raceline[:, 5]
+
+
+def clear_raceline(waypoints, centerline, clearance=0.5, smoothing=5):
+    """
+    Moves raceline points towards the centerline until they're at least clearance metres inside the track's
+    edges. Racelines run along the walls at the apexes, where pure pursuit cuts the corner anyway
+
+    Args:
+        waypoints (np.ndarray (n, 2)): raceline
+        centerline (np.ndarray (m, 4)): centerline of f1tenth_racetracks, x_m, y_m, w_tr_right_m, w_tr_left_m
+        clearance (float, default=0.5): smallest distance to the track edges
+        smoothing (int, default=5): the shifts are spread over this many points either side, so a corner
+            pulled in by the clip doesn't become a kink
+
+    Returns:
+        waypoints (np.ndarray (n, 2)): raceline inside the edges
+    """
+    # a closing point repeating the first one stays on it
+    if np.array_equal(waypoints[0], waypoints[-1]):
+        cleared = clear_raceline(waypoints[:-1], centerline, clearance, smoothing)
+        return np.vstack((cleared, cleared[:1]))
+
+    tracker = TrackProgress(centerline, num_agents=waypoints.shape[0])
+    tracker.reset(waypoints[:, 0], waypoints[:, 1], np.zeros(waypoints.shape[0]))
+    idx = tracker.indices
+    # lateral offsets are positive to the left
+    rows = tracker.point_indices[idx]
+    lateral = tracker.lateral_offset
+    shift = np.clip(lateral, clearance - centerline[rows, 2], centerline[rows, 3] - clearance) - lateral
+    if smoothing > 0:
+        # the largest shift in each window, then averaged over it, so no point moves less than it has to
+        width = 2 * smoothing + 1
+        windows = np.lib.stride_tricks.sliding_window_view(np.pad(shift, smoothing, mode='wrap'), width)
+        largest = windows[np.arange(shift.size), np.argmax(np.abs(windows), axis=1)]
+        shift = np.convolve(np.pad(largest, smoothing, mode='wrap'), np.full(width, 1. / width), mode='valid')
+    # moved along the raceline's own normals, which unlike the centerline's don't jump at its corners
+    tangents = np.roll(waypoints, -1, axis=0) - np.roll(waypoints, 1, axis=0)
+    normals = np.stack((-tangents[:, 1], tangents[:, 0]), axis=1) / np.maximum(np.linalg.norm(tangents, axis=1), 1e-9)[:, None]
+    return waypoints + shift[:, None] * normals
+
+
+class BatchPurePursuit(object):
+    """
+    Pure pursuit of a closed raceline for K cars at once, one vectorised plan() for all of them.
+    Each car's nearest raceline segment is found by a TrackProgress windowed search around the segment it
+    was nearest to last time (a global search after a reset or when it's lost), so planning doesn't depend
+    on the length of the raceline. The lookahead point is then lookahead + lookahead_time * speed metres
+    further along the raceline, by arc length, and the speed is the raceline's at the car times speed_gain.
+    Racelines are optimised for other vehicles, so with max_lateral_accel the speeds are also capped by the
+    raceline's own curvature, and brought down before corners by a backward pass at max_braking
+    """
+
+    def __init__(self, waypoints, speeds, num_agents=1, lookahead=0.8, lookahead_time=0.15, speed_gain=0.9,
+                 max_lateral_accel=None, max_braking=5., wheelbase=WHEELBASE, window=10):
+        """
+        Class constructor
+
+        Args:
+            waypoints (np.ndarray (n, 2)): closed raceline
+            speeds (np.ndarray (n, )): target speed at each waypoint
+            num_agents (int, default=1): number of cars planned for
+            lookahead (float, default=0.8): lookahead distance (m) at standstill
+            lookahead_time (float, default=0.15): lookahead distance added per m/s of speed
+            speed_gain (float, default=0.9): factor on the raceline speeds
+            max_lateral_accel (float, default=None): largest lateral acceleration (m/s^2), None keeps the raceline speeds
+            max_braking (float, default=5.): deceleration (m/s^2) used to slow down for corners, with max_lateral_accel
+            wheelbase (float, default=WHEELBASE): wheelbase of the cars
+            window (int, default=10): segments searched on each side of a car's last nearest segment
+
+        Returns:
+            None
+        """
+        self.num_agents = num_agents
+        self.lookahead = lookahead
+        self.lookahead_time = lookahead_time
+        self.speed_gain = speed_gain
+        self.max_lateral_accel = max_lateral_accel
+        self.max_braking = max_braking
+        self.wheelbase = wheelbase
+        self.tracker = TrackProgress(waypoints, num_agents, window=window)
+        # target speed at the start of each of the tracker's segments
+        self.speeds = speed_gain * np.asarray(speeds, dtype=np.float64)[self.tracker.point_indices]
+        if max_lateral_accel is not None:
+            self.speeds = np.minimum(self.speeds, self._speed_limits())
+
+    def _speed_limits(self):
+        """
+        Speed at each point allowed by the curvature of the raceline, and by braking for the points after it
+        """
+        tracker = self.tracker
+        # curvature at each point, from the change of heading between the segments around it
+        turn = np.mod(tracker.seg_headings - np.roll(tracker.seg_headings, 1) + np.pi, 2 * np.pi) - np.pi
+        curvature = np.abs(turn) / (0.5 * (tracker.seg_lens + np.roll(tracker.seg_lens, 1)))
+        limits = np.sqrt(self.max_lateral_accel / np.maximum(curvature, 1e-6))
+        # v^2 <= v_next^2 + 2 a ds, backwards around the loop, twice so that it carries over the start line
+        n = len(limits)
+        for i in range(2 * n - 1, -1, -1):
+            j = i % n
+            limits[j] = min(limits[j], np.sqrt(limits[(j + 1) % n] ** 2 + 2 * self.max_braking * tracker.seg_lens[j]))
+        return limits
+
+    def config(self):
+        """
+        Settings of the expert as a dict for json, e.g. for the metadata of its demonstrations
+        """
+        return {'lookahead': self.lookahead, 'lookahead_time': self.lookahead_time, 'speed_gain': self.speed_gain,
+                'max_lateral_accel': self.max_lateral_accel, 'max_braking': self.max_braking, 'wheelbase': self.wheelbase}
+
+    def reset(self, poses, agents=None):
+        """
+        Finds the cars on the raceline after they've been reset
+
+        Args:
+            poses (np.ndarray (num_agents, 3)): x, y, theta of every car
+            agents (iterable of int, default=None): only these cars were reset, all of them if None
+
+        Returns:
+            None
+        """
+        self.tracker.reset(poses[:, 0], poses[:, 1], poses[:, 2], agents)
+
+    def plan(self, poses, velocities=None):
+        """
+        Actuation of all the cars
+
+        Args:
+            poses (np.ndarray (num_agents, 3)): x, y, theta of every car
+            velocities (np.ndarray (num_agents, ), default=None): speed of every car, for the lookahead distance
+
+        Returns:
+            actions (np.ndarray (num_agents, 2)): steering angle and speed of every car, as F110Env.step takes them
+        """
+        tracker = self.tracker
+        s = tracker.step(poses[:, 0], poses[:, 1], poses[:, 2])[0]
+        idx = tracker.indices
+
+        # point lookahead metres further along the raceline
+        lookahead = self.lookahead
+        if velocities is not None:
+            lookahead = lookahead + self.lookahead_time * np.abs(velocities)
+        target_s = np.mod(s + lookahead, tracker.length)
+        target = np.searchsorted(tracker.cum_s, target_s, side='right') - 1
+        t = (target_s - tracker.cum_s[target]) / tracker.seg_lens[target]
+        dx = tracker.points[target, 0] + t * tracker.seg_vecs[target, 0] - poses[:, 0]
+        dy = tracker.points[target, 1] + t * tracker.seg_vecs[target, 1] - poses[:, 1]
+
+        # curvature of the arc through the lookahead point, tangent to the car's heading
+        lateral = np.cos(poses[:, 2]) * dy - np.sin(poses[:, 2]) * dx
+        curvature = 2. * lateral / np.maximum(dx * dx + dy * dy, 1e-6)
+
+        actions = np.empty((self.num_agents, 2))
+        actions[:, 0] = np.arctan(self.wheelbase * curvature)
+        actions[:, 1] = self.speeds[idx]
+        return actions
+
+
+"""
+Unit tests for the experts
+"""
+
+class ExpertTests(unittest.TestCase):
+    def setUp(self):
+        # ring track of radius 10 m and 2 m either side, counter clockwise, so its left edge is the inner one
+        angles = np.linspace(0., 2*np.pi, num=200, endpoint=False)
+        self.centerline = np.column_stack((10. * np.cos(angles), 10. * np.sin(angles), np.full(200, 2.), np.full(200, 2.)))
+        # raceline weaving up to 1.8 m off the centerline, with a tight bend just after the start line
+        self.radii = 10. + 1.8 * np.cos(3 * angles - 0.3)
+        self.waypoints = self.radii[:, None] * np.column_stack((np.cos(angles), np.sin(angles)))
+
+    def test_clear_raceline(self):
+        clearance = 0.5
+        cleared = clear_raceline(self.waypoints, self.centerline, clearance)
+        offsets = np.hypot(cleared[:, 0], cleared[:, 1]) - 10.
+        # inside the edges by the clearance, up to the error of moving along the raceline's normals
+        self.assertTrue(np.all(np.abs(offsets) <= 2. - clearance + 1e-2))
+        # without smoothing, points already inside stay where they were
+        inside = np.abs(self.radii - 10.) <= 2. - clearance
+        np.testing.assert_allclose(clear_raceline(self.waypoints, self.centerline, clearance, 0)[inside], self.waypoints[inside])
+        # a closing point repeating the first one stays on it
+        closed = clear_raceline(np.vstack((self.waypoints, self.waypoints[:1])), self.centerline, clearance)
+        np.testing.assert_allclose(closed[:-1], cleared)
+        np.testing.assert_allclose(closed[-1], closed[0])
+
+    def test_speed_limits(self):
+        # braking gently enough that slowing down for the bend after the start line begins before it
+        max_braking = 0.2
+        pp = BatchPurePursuit(self.waypoints, np.full(200, 20.), max_lateral_accel=5., max_braking=max_braking)
+        speeds = pp.speeds
+        self.assertLess(speeds.min(), speeds.max())
+        # every point can brake down to the next one, including the last one to the first over the start line
+        next_speeds = np.roll(speeds, -1)
+        self.assertTrue(np.all(speeds ** 2 <= next_speeds ** 2 + 2 * max_braking * pp.tracker.seg_lens + 1e-9))
+
+    def test_plan_steers_to_raceline(self):
+        waypoints = self.centerline[:, :2]
+        pp = BatchPurePursuit(waypoints, np.full(200, 3.), num_agents=2)
+        # heading along the track on the outside (raceline to the left) and on the inside (raceline to the right)
+        poses = np.array([[10.5, 0., np.pi/2], [9.5, 0., np.pi/2]])
+        pp.reset(poses)
+        actions = pp.plan(poses, np.zeros(2))
+        self.assertGreater(actions[0, 0], 0.)
+        self.assertLess(actions[1, 0], 0.)
+        np.testing.assert_allclose(actions[:, 1], 0.9 * 3.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,53 +31,45 @@ import cv2
 import os
 import math
 import numpy as np
-import shapely.geometry as shp
-import matplotlib.pyplot as plt
-from matplotlib.patches import Polygon
-from matplotlib.collections import PatchCollection
 
+from numba import njit
+from collections import namedtuple
 
-def create_track(printing=False):
-    CHECKPOINTS = 16
-    SCALE = 6.0
-    TRACK_RAD = 900/SCALE
-    TRACK_DETAIL_STEP = 21/SCALE
-    TRACK_TURN_RATE = 0.31
+from f110_gym.envs.laser_models import get_dt
 
-    WIDTH = 10.0
+# metres per track generator unit, gives a track ~3.3m wide
+TRACK_SCALE = 1/6.
+# map resolution (m/pixel)
+MAP_RESOLUTION = 0.0625
+# bump whenever the same seed would give a different track, invalidates cached tracks
+GENERATOR_VERSION = 2
 
-    start_alpha = 0.
+# everything the simulator needs to switch to a generated track
+GeneratedTrack = namedtuple('GeneratedTrack', ['seed', 'map_img', 'resolution', 'origin', 'dt', 'centerline'])
 
-    if not os.path.exists('maps'):
-        print('Creating maps/ directory.')
-        os.makedirs('maps')
-    if not os.path.exists('centerline'):
-        print('Creating centerline/ directory.')
-        os.makedirs('centerline')
 
-    # Create checkpoints
-    checkpoints = []
-    for c in range(CHECKPOINTS):
-        alpha = 2*math.pi*c/CHECKPOINTS + np.random.uniform(0, 2*math.pi*1/CHECKPOINTS)
-        rad = np.random.uniform(TRACK_RAD/3, TRACK_RAD)
-        if c==0:
-            alpha = 0
-            rad = 1.5*TRACK_RAD
-        if c==CHECKPOINTS-1:
-            alpha = 2*math.pi*c/CHECKPOINTS
-            start_alpha = 2*math.pi*(-0.5)/CHECKPOINTS
-            rad = 1.5*TRACK_RAD
-        checkpoints.append( (alpha, rad*math.cos(alpha), rad*math.sin(alpha)) )
-    road = []
-
-    # Go from one checkpoint to another to create track
-    x, y, beta = 1.5*TRACK_RAD, 0, 0
+# track generator parameters, in generator units
+CHECKPOINTS = 16
+SCALE = 6.0
+TRACK_RAD = 900/SCALE
+TRACK_DETAIL_STEP = 21/SCALE
+TRACK_TURN_RATE = 0.31
+WIDTH = 10.0
+# maximum number of steps of the walk between checkpoints
+MAX_WALK_STEPS = 2500
+
+
+@njit(cache=True)
+def walk_track(checkpoints, start_alpha):
+    # steers from checkpoint to checkpoint for up to 5 laps, returning (alpha, beta, x, y) of each step
+    track = np.empty((MAX_WALK_STEPS, 4))
+    n_checkpoints = checkpoints.shape[0]
+    x, y, beta = 1.5*TRACK_RAD, 0., 0.
     dest_i = 0
     laps = 0
-    track = []
-    no_freeze = 2500
     visited_other_side = False
-    while True:
+    n = 0
+    while n < MAX_WALK_STEPS:
         alpha = math.atan2(y, x)
         if visited_other_side and alpha > 0:
             laps += 1
@@ -85,131 +77,276 @@ def create_track(printing=False):
         if alpha < 0:
             visited_other_side = True
             alpha += 2*math.pi
+        # find the next checkpoint ahead
         while True:
             failed = True
             while True:
-                dest_alpha, dest_x, dest_y = checkpoints[dest_i % len(checkpoints)]
+                dest_alpha = checkpoints[dest_i % n_checkpoints, 0]
+                dest_x = checkpoints[dest_i % n_checkpoints, 1]
+                dest_y = checkpoints[dest_i % n_checkpoints, 2]
                 if alpha <= dest_alpha:
                     failed = False
                     break
                 dest_i += 1
-                if dest_i % len(checkpoints) == 0:
+                if dest_i % n_checkpoints == 0:
                     break
             if not failed:
                 break
             alpha -= 2*math.pi
-            continue
         r1x = math.cos(beta)
         r1y = math.sin(beta)
         p1x = -r1y
         p1y = r1x
-        dest_dx = dest_x - x
-        dest_dy = dest_y - y
-        proj = r1x*dest_dx + r1y*dest_dy
-        while beta - alpha >  1.5*math.pi:
-             beta -= 2*math.pi
+        proj = r1x*(dest_x - x) + r1y*(dest_y - y)
+        while beta - alpha > 1.5*math.pi:
+            beta -= 2*math.pi
         while beta - alpha < -1.5*math.pi:
-             beta += 2*math.pi
+            beta += 2*math.pi
         prev_beta = beta
         proj *= SCALE
-        if proj >  0.3:
-             beta -= min(TRACK_TURN_RATE, abs(0.001*proj))
+        if proj > 0.3:
+            beta -= min(TRACK_TURN_RATE, abs(0.001*proj))
         if proj < -0.3:
-             beta += min(TRACK_TURN_RATE, abs(0.001*proj))
+            beta += min(TRACK_TURN_RATE, abs(0.001*proj))
         x += p1x*TRACK_DETAIL_STEP
         y += p1y*TRACK_DETAIL_STEP
-        track.append( (alpha,prev_beta*0.5 + beta*0.5,x,y) )
+        track[n, 0] = alpha
+        track[n, 1] = prev_beta*0.5 + beta*0.5
+        track[n, 2] = x
+        track[n, 3] = y
+        n += 1
         if laps > 4:
-             break
-        no_freeze -= 1
-        if no_freeze==0:
-             break
+            break
+    return track[:n]
 
-    # Find closed loop
+
+@njit(cache=True)
+def find_loop(track, start_alpha):
+    # indices of the last full lap, (-1, -1) if there isn't one
     i1, i2 = -1, -1
-    i = len(track)
-    while True:
-        i -= 1
-        if i==0:
-            return False
-        pass_through_start = track[i][0] > start_alpha and track[i-1][0] <= start_alpha
-        if pass_through_start and i2==-1:
-            i2 = i
-        elif pass_through_start and i1==-1:
-            i1 = i
+    for i in range(track.shape[0] - 1, 0, -1):
+        if track[i, 0] > start_alpha and track[i-1, 0] <= start_alpha:
+            if i2 == -1:
+                i2 = i
+            else:
+                i1 = i
+                break
+    if i1 == -1:
+        return -1, -1
+    return i1, i2
+
+
+@njit(cache=True)
+def offset_walls(track_xy, width):
+    """
+    Offsets a closed counter-clockwise centerline by width along its vertex normals
+
+        Args:
+            track_xy (np.ndarray (n, 2)): centerline
+            width (float): offset distance
+
+        Returns:
+            outer, inner (np.ndarray (n + 1, 2)): closed wall polylines (first point repeated at the end)
+            valid (bool): False if the walls would pass through another part of the track
+    """
+    n = track_xy.shape[0]
+    outer = np.empty((n + 1, 2))
+    inner = np.empty((n + 1, 2))
+    for i in range(n):
+        # tangent from the neighbouring points
+        tx = track_xy[(i + 1) % n, 0] - track_xy[i - 1, 0]
+        ty = track_xy[(i + 1) % n, 1] - track_xy[i - 1, 1]
+        norm = math.sqrt(tx*tx + ty*ty)
+        # right hand normal points away from the inside of the loop
+        nx = ty / norm
+        ny = -tx / norm
+        outer[i, 0] = track_xy[i, 0] + width*nx
+        outer[i, 1] = track_xy[i, 1] + width*ny
+        inner[i, 0] = track_xy[i, 0] - width*nx
+        inner[i, 1] = track_xy[i, 1] - width*ny
+    outer[n] = outer[0]
+    inner[n] = inner[0]
+
+    # parts of the track further apart along it than a half turn of radius width
+    # must also be 2 * width apart in space, otherwise their walls overlap
+    min_gap = int(math.ceil(math.pi*width / TRACK_DETAIL_STEP))
+    min_dist2 = 4*width*width
+    valid = True
+    for i in range(n):
+        for j in range(i + min_gap, n - min_gap + i + 1):
+            jj = j % n
+            dx = track_xy[i, 0] - track_xy[jj, 0]
+            dy = track_xy[i, 1] - track_xy[jj, 1]
+            if dx*dx + dy*dy < min_dist2:
+                valid = False
+                break
+        if not valid:
             break
-    if printing: print("Track generation: %i..%i -> %i-tiles track" % (i1, i2, i2-i1))
-    assert i1!=-1
-    assert i2!=-1
+    return outer, inner, valid
+
+
+def create_track(printing=False, rng=None, seed=None):
+    """
+    Generates a random closed track by steering between random checkpoints around a circle.
+    Returns False when the walk doesn't produce a usable loop, which happens quite often.
+
+        Args:
+            printing (bool, default=False): print the generation progress
+            rng (np.random.RandomState/Generator, default=None): random source, global np.random if None
+            seed (int, default=None): seed of a new RandomState, overrides rng
 
+        Returns:
+            track (np.ndarray (n, 2)): centerline
+            track_int, track_ext (np.ndarray (n + 1, 2)): outer and inner wall polylines
+    """
+    if seed is not None:
+        rng = np.random.RandomState(seed)
+    elif rng is None:
+        rng = np.random
+
+    # create checkpoints, drawing the random numbers in the same order as the original generator
+    c = np.arange(CHECKPOINTS)
+    uniforms = rng.uniform(size=(CHECKPOINTS, 2))
+    alpha = 2*math.pi*c/CHECKPOINTS + uniforms[:, 0]*(2*math.pi*1/CHECKPOINTS)
+    rad = TRACK_RAD/3 + uniforms[:, 1]*(TRACK_RAD - TRACK_RAD/3)
+    alpha[0] = 0
+    rad[0] = 1.5*TRACK_RAD
+    alpha[-1] = 2*math.pi*(CHECKPOINTS-1)/CHECKPOINTS
+    rad[-1] = 1.5*TRACK_RAD
+    start_alpha = 2*math.pi*(-0.5)/CHECKPOINTS
+    checkpoints = np.stack((alpha, rad*np.cos(alpha), rad*np.sin(alpha)), axis=1)
+
+    # go from one checkpoint to another to create track
+    track = walk_track(checkpoints, start_alpha)
+
+    # find closed loop
+    i1, i2 = find_loop(track, start_alpha)
+    if i1 == -1:
+        return False
+    if printing: print("Track generation: %i..%i -> %i-tiles track" % (i1, i2, i2-i1))
     track = track[i1:i2-1]
-    first_beta = track[0][1]
-    first_perp_x = math.cos(first_beta)
-    first_perp_y = math.sin(first_beta)
 
-    # Length of perpendicular jump to put together head and tail
+    # length of perpendicular jump to put together head and tail
+    first_beta = track[0, 1]
     well_glued_together = np.sqrt(
-        np.square( first_perp_x*(track[0][2] - track[-1][2]) ) +
-        np.square( first_perp_y*(track[0][3] - track[-1][3]) ))
+        np.square(math.cos(first_beta)*(track[0, 2] - track[-1, 2])) +
+        np.square(math.sin(first_beta)*(track[0, 3] - track[-1, 3])))
     if well_glued_together > TRACK_DETAIL_STEP:
         return False
 
-    # post processing, converting to numpy, finding exterior and interior walls
-    track_xy = [(x, y) for (a1, b1, x, y) in track]
-    track_xy = np.asarray(track_xy)
-    track_poly = shp.Polygon(track_xy)
-    track_xy_offset_in = track_poly.buffer(WIDTH)
-    track_xy_offset_out = track_poly.buffer(-WIDTH)
-    track_xy_offset_in_np = np.array(track_xy_offset_in.exterior)
-    track_xy_offset_out_np = np.array(track_xy_offset_out.exterior)
-    return track_xy, track_xy_offset_in_np, track_xy_offset_out_np
+    # exterior and interior walls
+    track_xy = np.ascontiguousarray(track[:, 2:])
+    track_xy_offset_in, track_xy_offset_out, valid = offset_walls(track_xy, WIDTH)
+    if not valid:
+        return False
+    return track_xy, track_xy_offset_in, track_xy_offset_out
 
 
-def convert_track(track, track_int, track_ext, iter, printing=False):
-    # converts track to image and saves the centerline as waypoints
-    fig, ax = plt.subplots()
-    fig.set_size_inches(20, 20)
-    ax.plot(*track_int.T, color='black', linewidth=3)
-    ax.plot(*track_ext.T, color='black', linewidth=3)
-    plt.tight_layout()
-    ax.set_aspect('equal')
-    ax.set_xlim(-180, 300)
-    ax.set_ylim(-300, 300)
-    plt.axis('off')
-    plt.savefig('maps/map' + str(iter) + '.png', dpi=80)
-
-    map_width, map_height = fig.canvas.get_width_height()
-    if printing: print('map size: ', map_width, map_height)
-
-    # transform the track center line into pixel coordinates
-    xy_pixels = ax.transData.transform(track)
-    origin_x_pix = xy_pixels[0, 0]
-    origin_y_pix = xy_pixels[0, 1]
-
-    xy_pixels = xy_pixels - np.array([[origin_x_pix, origin_y_pix]])
-
-    map_origin_x = -origin_x_pix*0.05
-    map_origin_y = -origin_y_pix*0.05
-
-    # convert image using cv2
-    cv_img = cv2.imread('maps/map' + str(iter) + '.png', -1)
-    # convert to bw
-    cv_img_bw = cv2.cvtColor(cv_img, cv2.COLOR_BGR2GRAY)
-    # saving to img
-    cv2.imwrite('maps/map' + str(iter) + '.png', cv_img_bw)
-    cv2.imwrite('maps/map' + str(iter) + '.pgm', cv_img_bw)
+def rasterise_track(track, track_int, track_ext, resolution=MAP_RESOLUTION, scale=TRACK_SCALE,
+                    wall_width=0.2, margin=2.0):
+    """
+    Draws the track walls straight into an occupancy image, without going through matplotlib or disk.
+    Coordinates are shifted so the first centerline point is at (0, 0).
+
+        Args:
+            track (np.ndarray (n, 2)): centerline from create_track
+            track_int, track_ext (np.ndarray (m, 2)): wall polylines from create_track
+            resolution (float): map resolution (m/pixel)
+            scale (float): metres per track generator unit
+            wall_width (float): thickness of the walls (m)
+            margin (float): free space around the walls (m)
+
+        Returns:
+            map_img (np.ndarray (h, w), uint8): occupancy image, 0 is wall, 255 is free space. Row 0 is the
+                bottom of the map (same orientation as ScanSimulator2D after loading an image)
+            origin (list [x, y, theta]): world coordinates of the bottom left pixel
+            centerline (np.ndarray (n, 2)): centerline waypoints in metres
+    """
+    start = track[0]
+    centerline = (track - start) * scale
+    walls = [(track_int - start) * scale, (track_ext - start) * scale]
+
+    # bounds of the walls plus the free margin
+    all_walls = np.vstack(walls)
+    low = all_walls.min(axis=0) - margin
+    high = all_walls.max(axis=0) + margin
+    width, height = np.ceil((high - low) / resolution).astype(int) + 1
+
+    # draw the walls, cv2 takes (column, row) points, in fixed point for sub-pixel accuracy
+    shift = 4
+    map_img = np.full((height, width), 255, dtype=np.uint8)
+    wall_pixels = [np.round((wall - low) / resolution * (1 << shift)).astype(np.int32) for wall in walls]
+    thickness = max(1, int(round(wall_width / resolution)))
+    cv2.polylines(map_img, wall_pixels, isClosed=True, color=0, thickness=thickness, shift=shift)
+
+    origin = [float(low[0]), float(low[1]), 0.]
+    return map_img, origin, centerline
+
+
+def write_track(map_img, resolution, origin, centerline, iter):
+    """
+    Saves a rasterised track as maps/map<iter>.png/.pgm/.yaml and centerline/map<iter>.csv
+    """
+    if not os.path.exists('maps'):
+        print('Creating maps/ directory.')
+        os.makedirs('maps')
+    if not os.path.exists('centerline'):
+        print('Creating centerline/ directory.')
+        os.makedirs('centerline')
+
+    # image files have row 0 at the top
+    map_img_flipped = np.flipud(map_img)
+    cv2.imwrite('maps/map' + str(iter) + '.png', map_img_flipped)
+    cv2.imwrite('maps/map' + str(iter) + '.pgm', map_img_flipped)
 
     # create yaml file
     yaml = open('maps/map' + str(iter) + '.yaml', 'w')
     yaml.write('image: map' + str(iter) + '.pgm\n')
-    yaml.write('resolution: 0.062500\n')
-    yaml.write('origin: [' + str(map_origin_x) + ',' + str(map_origin_y) + ', 0.000000]\n')
+    yaml.write('resolution: ' + str(resolution) + '\n')
+    yaml.write('origin: [' + str(origin[0]) + ',' + str(origin[1]) + ', 0.000000]\n')
     yaml.write('negate: 0\noccupied_thresh: 0.45\nfree_thresh: 0.196')
     yaml.close()
-    plt.close()
 
     # saving track centerline as a csv in ros coords
     waypoints_csv = open('centerline/map' + str(iter) + '.csv', 'w')
-    for row in xy_pixels:
-        waypoints_csv.write(str(0.05*row[0]) + ', ' + str(0.05*row[1]) + '\n')
+    for row in centerline:
+        waypoints_csv.write(str(row[0]) + ', ' + str(row[1]) + '\n')
     waypoints_csv.close()
+
+
+def convert_track(track, track_int, track_ext, iter, printing=False):
+    # converts track to image and saves the centerline as waypoints
+    map_img, origin, centerline = rasterise_track(track, track_int, track_ext)
+    if printing: print('map size: ', map_img.shape[1], map_img.shape[0])
+    write_track(map_img, MAP_RESOLUTION, origin, centerline, iter)
+
+
+def generate_track(seed, resolution=MAP_RESOLUTION, max_attempts=20):
+    """
+    Generates and rasterises a random track, and computes its distance transform.
+    The same seed always gives the same track.
+
+        Args:
+            seed (int): seed of the track generator
+            resolution (float): map resolution (m/pixel)
+            max_attempts (int): number of tries before giving up, the generator fails quite often
+
+        Returns:
+            track (GeneratedTrack): map image, resolution, origin, distance transform and centerline
+
+        Raises:
+            RuntimeError: when every attempt failed
+    """
+    rng = np.random.RandomState(seed)
+    for _ in range(max_attempts):
+        # only retry the generator's own failures, anything raised is a bug
+        result = create_track(rng=rng)
+        if result is not False:
+            break
+    else:
+        raise RuntimeError(f"Random generator [{seed}] failed {max_attempts} times")
+    track, track_int, track_ext = result
+    map_img, origin, centerline = rasterise_track(track, track_int, track_ext, resolution)
+    # same binarisation as ScanSimulator2D
+    dt = get_dt(np.where(map_img > 128, 255., 0.), resolution)
+    return GeneratedTrack(seed, map_img, resolution, origin, dt, centerline)
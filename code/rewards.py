@@ -0,0 +1,136 @@
+# MIT License
+
+# Copyright (c) 2020 FT Autonomous Team One
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Track-aware reward computation for the F1Tenth wrappers
+"""
+
+import unittest
+import numpy as np
+
+from f110_gym.envs.track_progress import TrackProgress
+
+
+class TrackReward(object):
+    """
+    Computes rewards for K cars on the same map in one vectorised pass,
+    holding the centerline of the map currently loaded in its environment
+
+    reward = speed_weight * |v| + progress_weight * (centerline velocity)
+    and collision_reward replaces the reward of any car in collision.
+    Without a centerline (update_track(None)) there is no progress term, only the speed term
+    """
+
+    def __init__(self, num_agents=1, timestep=0.01, speed_weight=1.0,
+                 progress_weight=0.5, collision_reward=-1.0):
+        self.num_agents = num_agents
+        self.timestep = timestep
+        self.speed_weight = speed_weight
+        self.progress_weight = progress_weight
+        self.collision_reward = collision_reward
+        # centerline progress tracker, only exists once a track is set
+        self.tracker = None
+        self.last_s = np.zeros(num_agents)
+        self.delta_s = np.zeros(num_agents)
+
+    def update_track(self, waypoints):
+        # store the centerline of the new map (None disables the progress term)
+        if waypoints is None:
+            self.tracker = None
+        else:
+            self.tracker = TrackProgress(waypoints, self.num_agents)
+        self.delta_s[:] = 0
+
+    def reset(self, poses_x, poses_y, poses_theta):
+        # find the cars on the centerline after a reset
+        self.delta_s[:] = 0
+        if self.tracker is not None:
+            self.tracker.reset(poses_x, poses_y, poses_theta)
+            self.last_s[:] = self.tracker.s
+
+    def __call__(self, poses_x, poses_y, poses_theta, vels_x, vels_y, collisions):
+        # all inputs are (K,) arrays, returns (K,) rewards
+        reward = self.speed_weight * np.hypot(vels_x, vels_y)
+
+        if self.tracker is not None:
+            s = self.tracker.step(poses_x, poses_y, poses_theta)[0]
+            # signed distance travelled along the centerline, across the start line too
+            length = self.tracker.length
+            np.subtract(s, self.last_s, out=self.delta_s)
+            self.delta_s += length / 2
+            np.mod(self.delta_s, length, out=self.delta_s)
+            self.delta_s -= length / 2
+            self.last_s[:] = s
+            reward += self.progress_weight * self.delta_s / self.timestep
+
+        return np.where(np.asarray(collisions, dtype=bool), self.collision_reward, reward)
+
+    def get_info(self):
+        # track relative info of each car, for the env's info dict
+        if self.tracker is None:
+            return {}
+        info = self.tracker.get_info()
+        info['delta_s'] = self.delta_s.copy()
+        return info
+
+
+"""
+Unit tests for the track reward
+"""
+
+class TrackRewardTests(unittest.TestCase):
+    def setUp(self):
+        # circle of radius 10, counter clockwise, starting at (10, 0)
+        angles = np.linspace(0., 2*np.pi, num=500, endpoint=False)
+        self.radius = 10.
+        self.waypoints = self.radius * np.stack((np.cos(angles), np.sin(angles)), axis=1)
+        self.reward = TrackReward(num_agents=2, timestep=0.01, speed_weight=1.0, progress_weight=0.5)
+
+    def poses(self, angles):
+        # poses on the circle, facing counter clockwise
+        angles = np.asarray(angles)
+        return self.radius * np.cos(angles), self.radius * np.sin(angles), angles + np.pi/2
+
+    def test_progress_across_start_line(self):
+        self.reward.update_track(self.waypoints)
+        # the first car drives forwards across s = 0, the second backwards
+        self.reward.reset(*self.poses([-0.01, 0.01]))
+        reward = self.reward(*self.poses([0.01, -0.01]), [2., -2.], [0., 0.], [False, False])
+        delta_s = 0.02 * self.radius
+        np.testing.assert_allclose(self.reward.delta_s, [delta_s, -delta_s], rtol=1e-3)
+        np.testing.assert_allclose(self.reward.get_info()['delta_s'], [delta_s, -delta_s], rtol=1e-3)
+        np.testing.assert_allclose(reward, [2. + 0.5 * delta_s / 0.01, 2. - 0.5 * delta_s / 0.01], rtol=1e-3)
+
+        # and back again, a collision replacing the reward
+        reward = self.reward(*self.poses([-0.01, 0.01]), [-2., 2.], [0., 0.], [True, False])
+        np.testing.assert_allclose(self.reward.delta_s, [-delta_s, delta_s], rtol=1e-3)
+        np.testing.assert_allclose(reward, [-1., 2. + 0.5 * delta_s / 0.01], rtol=1e-3)
+
+    def test_without_track(self):
+        self.reward.update_track(None)
+        self.reward.reset(*self.poses([0., 1.]))
+        reward = self.reward(*self.poses([0.1, 1.1]), [3., 0.], [4., 1.], [False, True])
+        np.testing.assert_allclose(reward, [5., -1.])
+        self.assertEqual(self.reward.get_info(), {})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,513 @@
+# MIT License
+
+# Copyright (c) 2020 FT Autonomous Team One
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Export of rollouts to sharded datasets on disk, and memory mapped reading of them for offline learning
+"""
+
+import os
+import json
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+import unittest
+import tempfile
+import shutil
+
+from f110_gym.envs.recording import save_npy, save_json
+
+
+class RolloutWriter(object):
+    """
+    Streams transitions of one env or a vector of envs into shards of at most shard_bytes, each a directory
+    of one .npy file per column, listed in manifest.json once written. Columns of a transition:
+        obs: observation the action was taken from (copied, so env buffers can be reused)
+        action, reward (float32), done (bool)
+        truncated (bool): the episode was cut short by a time limit rather than ended ('TimeLimit.truncated')
+        episode (int64): id of the episode, unique in the dataset
+        and one column per key of info_keys, the value of that key in the step's info
+    Transitions of an episode are kept together, so the next observation is the next row's obs, except on the
+    last transition of an episode. The shard an episode ends in lists it, with its first row, its length and
+    that final observation (final_episode, final_start, final_length, final_obs).
+    Episodes are buffered per env until they end, shards are written by a background thread
+    """
+
+    def __init__(self, directory, num_envs=1, shard_bytes=2 ** 28, info_keys=(), metadata=None):
+        """
+        Class constructor
+
+        Args:
+            directory (str): directory of the dataset, appending to a dataset already there
+            num_envs (int, default=1): number of envs stepped together
+            shard_bytes (int, default=2**28): largest size of a shard
+            info_keys (tuple of str, default=()): info values to save with each transition
+            metadata (dict, default=None): saved in the manifest, e.g. how observations are encoded
+
+        Returns:
+            None
+        """
+        self.directory = directory
+        self.num_envs = num_envs
+        self.shard_bytes = shard_bytes
+        self.info_keys = tuple(info_keys)
+        os.makedirs(directory, exist_ok=True)
+
+        # continue an existing dataset
+        self.manifest_path = os.path.join(directory, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+            if metadata is not None:
+                self.manifest['metadata'] = metadata
+        else:
+            self.manifest = {'shards': [], 'columns': None, 'episodes': 0, 'metadata': metadata}
+        # id of the next episode, number of the next shard, and rows so far
+        self.episode = self.manifest['episodes']
+        self.shard_count = len(self.manifest['shards'])
+        self.total_steps = sum(shard['steps'] for shard in self.manifest['shards'])
+
+        # transitions of each env's current episode, and the observation after its latest transition
+        self.episodes = [[] for _ in range(num_envs)]
+        self.last_obs = [None] * num_envs
+
+        # shard being filled, allocated once the columns are known
+        self.columns = None
+        self.shard = None
+        self.size = 0
+        self.finals = []
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.writes = []
+
+    def add(self, obs, next_obs, actions, rewards, dones, infos):
+        """
+        Adds a step of all the envs
+
+        Args:
+            obs (np.ndarray (num_envs, ...)): observations the actions were taken from
+            next_obs (np.ndarray (num_envs, ...)): observations returned by the step, where vector envs that
+                reset after the end of an episode give the final observation in info['terminal_observation']
+            actions (np.ndarray (num_envs, ...)): actions
+            rewards (np.ndarray (num_envs, )): rewards
+            dones (np.ndarray (num_envs, )): end of episode flags
+            infos (list of dict): info of each env
+
+        Returns:
+            None
+        """
+        for i in range(self.num_envs):
+            info = infos[i]
+            self.episodes[i].append([np.array(obs[i]), np.array(actions[i], dtype=np.float32), rewards[i],
+                                     info.get('TimeLimit.truncated', False),
+                                     [np.array(info[key]) for key in self.info_keys]])
+            if dones[i]:
+                self._end_episode(i, info.get('terminal_observation', next_obs[i]), done=True)
+            else:
+                self.last_obs[i] = np.array(next_obs[i])
+
+    def add_step(self, obs, next_obs, action, reward, done, info):
+        """
+        Adds a step of a single env (e.g. F110_Wrapped), same as add with num_envs=1
+        """
+        self.add([obs], [next_obs], [action], [reward], [done], [info])
+
+    def _end_episode(self, env, final_obs, done):
+        """
+        Moves the transitions of an env's episode into shards
+        """
+        transitions = self.episodes[env]
+        self.episodes[env] = []
+        self.last_obs[env] = None
+        if not transitions:
+            return
+        if self.columns is None:
+            self._describe_columns(transitions[0])
+
+        rows = {'obs': np.stack([t[0] for t in transitions]),
+                'action': np.stack([t[1] for t in transitions]),
+                'reward': np.array([t[2] for t in transitions], dtype=np.float32),
+                'done': np.zeros(len(transitions), dtype=bool),
+                'truncated': np.array([t[3] for t in transitions], dtype=bool),
+                'episode': np.full(len(transitions), self.episode, dtype=np.int64)}
+        rows['done'][-1] = done
+        for k, key in enumerate(self.info_keys):
+            rows[key] = np.stack([t[4][k] for t in transitions])
+
+        # fill shards, handing them to the writer as they fill up
+        first_row = self.total_steps
+        start = 0
+        while start < len(transitions):
+            if self.shard is None:
+                self.shard = {name: np.empty((self.shard_steps, ) + tuple(shape), dtype=dtype)
+                              for name, (dtype, shape) in self.columns.items()}
+            count = min(len(transitions) - start, self.shard_steps - self.size)
+            for name, values in rows.items():
+                self.shard[name][self.size:self.size + count] = values[start:start + count]
+            self.size += count
+            self.total_steps += count
+            start += count
+            if start == len(transitions):
+                self.finals.append((self.episode, first_row, len(transitions), np.array(final_obs)))
+                self.episode += 1
+            if self.size == self.shard_steps:
+                self._hand_off()
+
+    def _describe_columns(self, transition):
+        """
+        Dtype and shape of every column, from the first transition, and the number of rows per shard
+        """
+        obs, action, _, _, info_values = transition
+        self.columns = {'obs': (obs.dtype, obs.shape),
+                        'action': (action.dtype, action.shape),
+                        'reward': (np.dtype(np.float32), ()),
+                        'done': (np.dtype(bool), ()),
+                        'truncated': (np.dtype(bool), ()),
+                        'episode': (np.dtype(np.int64), ())}
+        for key, value in zip(self.info_keys, info_values):
+            self.columns[key] = (value.dtype, value.shape)
+        columns = {name: {'dtype': dtype.str, 'shape': list(shape)} for name, (dtype, shape) in self.columns.items()}
+        if self.manifest['columns'] is not None and self.manifest['columns'] != columns:
+            raise ValueError('Transitions have columns {}, the dataset in {} has {}.'.format(
+                columns, self.directory, self.manifest['columns']))
+        self.manifest['columns'] = columns
+        row_bytes = sum(dtype.itemsize * int(np.prod(shape)) for dtype, shape in self.columns.values())
+        self.shard_steps = max(1, self.shard_bytes // row_bytes)
+
+    def _hand_off(self):
+        """
+        Queues the current shard for writing
+        """
+        # named here rather than from the manifest, which the writer thread is appending to
+        name = 'shard_{:06d}'.format(self.shard_count)
+        self.shard_count += 1
+        shard = {column: values[:self.size] for column, values in self.shard.items()}
+        obs_dtype, obs_shape = self.columns['obs']
+        shard['final_episode'] = np.array([final[0] for final in self.finals], dtype=np.int64)
+        shard['final_start'] = np.array([final[1] for final in self.finals], dtype=np.int64)
+        shard['final_length'] = np.array([final[2] for final in self.finals], dtype=np.int64)
+        shard['final_obs'] = np.array([final[3] for final in self.finals], dtype=obs_dtype).reshape((-1, ) + obs_shape)
+        # episodes finished by the end of this shard, an episode running into the next one isn't yet
+        self.writes.append(self.writer.submit(self._write_shard, name, shard, self.size, self.episode))
+        self.shard = None
+        self.size = 0
+        self.finals = []
+
+    def _write_shard(self, name, shard, size, episodes):
+        """
+        Writer thread, saves a shard's columns then adds it to the manifest
+        """
+        path = os.path.join(self.directory, name)
+        os.makedirs(path, exist_ok=True)
+        for column, values in shard.items():
+            save_npy(os.path.join(path, column + '.npy'), values)
+        self.manifest['shards'].append({'name': name, 'steps': size})
+        self.manifest['episodes'] = episodes
+        save_json(self.manifest_path, self.manifest)
+
+    def close(self):
+        """
+        Ends the episodes still running as truncated, writes the last shard and waits for all writes
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        for env in range(self.num_envs):
+            if self.episodes[env]:
+                self.episodes[env][-1][3] = True
+                self._end_episode(env, self.last_obs[env], done=False)
+        if self.size > 0:
+            self._hand_off()
+        self.writer.shutdown(wait=True)
+        # raise any error of the writer thread
+        for write in self.writes:
+            write.result()
+        self.writes = []
+
+
+class RolloutDataset(object):
+    """
+    Reads a dataset written by RolloutWriter, shards are memory mapped so only the rows read are loaded.
+    Rows are indexed globally across shards, batch() gathers any set of rows with their next observations
+    """
+
+    def __init__(self, directory):
+        """
+        Class constructor
+
+        Args:
+            directory (str): directory of the dataset
+
+        Returns:
+            None
+        """
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json'), 'r') as f:
+            self.manifest = json.load(f)
+        self.metadata = self.manifest['metadata']
+        self.shard_names = [shard['name'] for shard in self.manifest['shards']]
+        # first global row of every shard, and the total
+        self.offsets = np.cumsum([0] + [shard['steps'] for shard in self.manifest['shards']])
+        self.shards = [None] * len(self.shard_names)
+
+        # first row and length of every episode, and where its final observation is
+        num_episodes = self.manifest['episodes']
+        self.episode_start = np.zeros(num_episodes, dtype=np.int64)
+        self.episode_length = np.zeros(num_episodes, dtype=np.int64)
+        self.final_shard = np.zeros(num_episodes, dtype=np.int64)
+        self.final_row = np.zeros(num_episodes, dtype=np.int64)
+        for index in range(len(self.shard_names)):
+            shard = self.shard(index)
+            episodes = np.asarray(shard['final_episode'])
+            self.episode_start[episodes] = shard['final_start']
+            self.episode_length[episodes] = shard['final_length']
+            self.final_shard[episodes] = index
+            self.final_row[episodes] = np.arange(len(episodes))
+        # rows of episodes still being written (when reading a dataset being exported) are left out
+        self.length = int(self.episode_start[-1] + self.episode_length[-1]) if num_episodes else 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def columns(self):
+        # names of the transition columns
+        return list(self.manifest['columns'])
+
+    def shard(self, index):
+        """
+        Memory maps the columns of a shard
+
+        Args:
+            index (int): index of the shard
+
+        Returns:
+            columns (dict): column name -> np.ndarray
+        """
+        if self.shards[index] is None:
+            path = os.path.join(self.directory, self.shard_names[index])
+            self.shards[index] = {os.path.splitext(name)[0]: np.load(os.path.join(path, name), mmap_mode='r')
+                                  for name in os.listdir(path) if name.endswith('.npy')}
+        return self.shards[index]
+
+    def read(self, column, start, stop):
+        """
+        Reads a column over a range of rows, across shards
+
+        Args:
+            column (str): name of the column
+            start (int): first row
+            stop (int): row after the last
+
+        Returns:
+            values (np.ndarray): rows start to stop of the column
+        """
+        first = np.searchsorted(self.offsets, start, side='right') - 1
+        last = np.searchsorted(self.offsets, stop, side='left')
+        parts = []
+        for index in range(first, last):
+            begin = max(start, self.offsets[index]) - self.offsets[index]
+            end = min(stop, self.offsets[index + 1]) - self.offsets[index]
+            parts.append(self.shard(index)[column][begin:end])
+        return np.concatenate(parts)
+
+    def gather(self, column, rows):
+        """
+        Reads a column at any rows, only touching the pages of the rows read
+
+        Args:
+            column (str): name of the column
+            rows (np.ndarray (n, ) int): global rows
+
+        Returns:
+            values (np.ndarray (n, ...)): the column at each row
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        dtype, shape = self.manifest['columns'][column]['dtype'], self.manifest['columns'][column]['shape']
+        values = np.empty((len(rows), ) + tuple(shape), dtype=dtype)
+        shards = np.searchsorted(self.offsets, rows, side='right') - 1
+        for index in np.unique(shards):
+            selected = shards == index
+            values[selected] = self.shard(index)[column][rows[selected] - self.offsets[index]]
+        return values
+
+    def next_obs(self, rows):
+        """
+        Observations after the transitions at some rows
+
+        Args:
+            rows (np.ndarray (n, ) int): global rows
+
+        Returns:
+            next_obs (np.ndarray (n, ...)): next row's obs, or the final observation of the row's episode
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        episodes = self.gather('episode', rows)
+        last = rows + 1 == self.episode_start[episodes] + self.episode_length[episodes]
+        next_obs = self.gather('obs', np.where(last, rows, rows + 1))
+        for index in np.unique(self.final_shard[episodes[last]]):
+            selected = last & (self.final_shard[episodes] == index)
+            next_obs[selected] = self.shard(index)['final_obs'][self.final_row[episodes[selected]]]
+        return next_obs
+
+    def batch(self, rows, columns=None):
+        """
+        Reads transitions at any rows, e.g. a random minibatch
+
+        Args:
+            rows (np.ndarray (n, ) int): global rows
+            columns (list of str, default=None): columns to read, all of them if None
+
+        Returns:
+            batch (dict): column name -> np.ndarray (n, ...), and 'next_obs'
+        """
+        columns = self.columns if columns is None else columns
+        batch = {column: self.gather(column, rows) for column in columns}
+        batch['next_obs'] = self.next_obs(rows)
+        return batch
+
+    def sample(self, batch_size, rng=None):
+        """
+        Reads a batch of uniformly random transitions
+
+        Args:
+            batch_size (int): number of transitions
+            rng (np.random.Generator, default=None): random generator, np.random if None
+
+        Returns:
+            batch (dict): see batch
+        """
+        rows = np.random.randint(len(self), size=batch_size) if rng is None else rng.integers(len(self), size=batch_size)
+        # sorted rows read the shards in order
+        return self.batch(np.sort(rows))
+
+    def episode(self, episode):
+        """
+        Reads all the transitions of an episode, in order
+
+        Args:
+            episode (int): id of the episode
+
+        Returns:
+            transitions (dict): column name -> np.ndarray with one row per transition, and 'final_obs'
+        """
+        start = self.episode_start[episode]
+        stop = start + self.episode_length[episode]
+        index = self.final_shard[episode]
+        transitions = {column: self.read(column, start, stop) for column in self.columns}
+        transitions['final_obs'] = np.array(self.shard(index)['final_obs'][self.final_row[episode]])
+        return transitions
+
+
+"""
+Unit tests for the rollout writer and dataset
+"""
+
+class RolloutTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(0)
+        # episode lengths of both envs in turn, some longer than a shard
+        self.lengths = iter(np.tile([7, 3, 12, 1, 5], 20))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def rollout(self, writer, steps):
+        """
+        Steps 2 envs into writer, returns the transitions and final observation of every episode,
+        in the order they end (those still running ending when the writer is closed)
+        """
+        episodes = []
+        running = [[], []]
+        remaining = [next(self.lengths), next(self.lengths)]
+        obs = self.rng.standard_normal((2, 3)).astype(np.float32)
+        for _ in range(steps):
+            next_obs = self.rng.standard_normal((2, 3)).astype(np.float32)
+            actions = self.rng.standard_normal((2, 2)).astype(np.float32)
+            rewards = self.rng.standard_normal(2).astype(np.float32)
+            dones = np.zeros(2, dtype=bool)
+            infos = [{'progress': self.rng.uniform()} for _ in range(2)]
+            for i in range(2):
+                running[i].append((obs[i].copy(), actions[i], rewards[i], infos[i]['progress']))
+                remaining[i] -= 1
+                if remaining[i] == 0:
+                    # vector envs reset at the end of an episode, returning the next episode's first observation
+                    dones[i] = True
+                    infos[i]['terminal_observation'] = next_obs[i].copy()
+                    episodes.append((running[i], next_obs[i].copy(), True))
+                    running[i] = []
+                    remaining[i] = next(self.lengths)
+                    next_obs[i] = self.rng.standard_normal(3)
+            writer.add(obs, next_obs, actions, rewards, dones, infos)
+            obs = next_obs
+        writer.close()
+        return episodes + [(running[i], obs[i].copy(), False) for i in range(2) if running[i]]
+
+    def test_round_trip(self):
+        # rows of 42 bytes, 10 to a shard
+        writer = RolloutWriter(self.directory, num_envs=2, shard_bytes=420, info_keys=('progress', ),
+                               metadata={'encoding': None})
+        episodes = self.rollout(writer, 30)
+        # appending to the dataset
+        writer = RolloutWriter(self.directory, num_envs=2, shard_bytes=420, info_keys=('progress', ))
+        episodes += self.rollout(writer, 20)
+
+        dataset = RolloutDataset(self.directory)
+        self.assertEqual(len(dataset), 100)
+        self.assertEqual(dataset.metadata, {'encoding': None})
+        self.assertEqual(dataset.shard_names, ['shard_{:06d}'.format(i) for i in range(len(dataset.shard_names))])
+        self.assertEqual(len(dataset.shard_names), 10)
+
+        rows = []
+        next_obs = []
+        for e, (transitions, final_obs, done) in enumerate(episodes):
+            episode = dataset.episode(e)
+            obs = np.array([t[0] for t in transitions])
+            np.testing.assert_array_equal(episode['obs'], obs)
+            np.testing.assert_array_equal(episode['action'], [t[1] for t in transitions])
+            np.testing.assert_array_equal(episode['reward'], [t[2] for t in transitions])
+            np.testing.assert_array_equal(episode['progress'], [t[3] for t in transitions])
+            np.testing.assert_array_equal(episode['episode'], e)
+            np.testing.assert_array_equal(episode['final_obs'], final_obs)
+            # only the last transition ends the episode, or is cut short if it never ended
+            self.assertEqual(episode['done'].tolist(), [False] * (len(transitions) - 1) + [done])
+            self.assertEqual(episode['truncated'].tolist(), [False] * (len(transitions) - 1) + [not done])
+            rows.append(dataset.episode_start[e] + np.arange(len(transitions)))
+            next_obs.append(np.vstack((obs[1:], final_obs)))
+        rows = np.concatenate(rows)
+        next_obs = np.concatenate(next_obs)
+        # every row belongs to exactly one episode
+        np.testing.assert_array_equal(np.sort(rows), np.arange(len(dataset)))
+
+        # random rows across shards
+        order = self.rng.permutation(len(rows))
+        np.testing.assert_array_equal(dataset.gather('obs', rows[order]),
+                                      np.concatenate([[t[0] for t in e[0]] for e in episodes])[order])
+        np.testing.assert_array_equal(dataset.next_obs(rows[order]), next_obs[order])
+        batch = dataset.batch(rows[order[:16]], columns=['reward'])
+        np.testing.assert_array_equal(batch['next_obs'], next_obs[order[:16]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# MIT License
+
+# Copyright (c) 2020 FT Autonomous Team One
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Reduction of LiDAR scans to a few angular sectors, for smaller observations
+"""
+
+import math
+import unittest
+import numpy as np
+
+from numba import njit
+
+# statistic of the ranges in each bin
+BIN_MODES = {'min': 0, 'mean': 1, 'percentile': 2}
+
+
+@njit(cache=True)
+def bin_scan(scan, out, values, mode, quantile, log_range):
+    """
+    Reduces a scan to len(out) bins of consecutive beams, as evenly sized as possible
+
+        Args:
+            scan (np.ndarray (n, )): ranges of each beam (m)
+            out (np.ndarray (b, )): output, statistic of each bin, at most one bin per beam
+            values (np.ndarray (n, )): scratch space, overwritten
+            mode (int): 0 min, 1 mean, 2 percentile (see BIN_MODES)
+            quantile (float): quantile in [0, 1] for the percentile mode
+            log_range (bool): take the statistic of log(1 + range) instead of the range
+
+        Returns:
+            None (written into out)
+    """
+    n = scan.shape[0]
+    num_bins = out.shape[0]
+    for i in range(n):
+        values[i] = math.log1p(max(scan[i], 0.)) if log_range else scan[i]
+
+    for b in range(num_bins):
+        start = (b * n) // num_bins
+        end = ((b + 1) * n) // num_bins
+        if mode == 0:
+            result = values[start]
+            for i in range(start + 1, end):
+                result = min(result, values[i])
+        elif mode == 1:
+            result = 0.
+            for i in range(start, end):
+                result += values[i]
+            result /= end - start
+        else:
+            # linearly interpolated quantile, same as np.percentile
+            sorted_values = values[start:end]
+            sorted_values.sort()
+            pos = quantile * (end - start - 1)
+            low = int(math.floor(pos))
+            high = min(low + 1, end - start - 1)
+            result = sorted_values[low] + (pos - low) * (sorted_values[high] - sorted_values[low])
+        out[b] = result
+
+
+"""
+Unit tests for the scan binning
+"""
+
+class BinScanTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.scan = rng.uniform(0.1, 30., 1080)
+        self.values = np.empty(1080)
+
+    def check(self, num_bins, mode, statistic, log_range=False):
+        out = np.empty(num_bins)
+        bin_scan(self.scan, out, self.values, BIN_MODES[mode], 0.1, log_range)
+        values = np.log1p(self.scan) if log_range else self.scan
+        bounds = np.arange(num_bins + 1) * len(self.scan) // num_bins
+        expected = [statistic(values[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+        np.testing.assert_allclose(out, expected, rtol=1e-12)
+
+    def test_modes(self):
+        # bins of unequal sizes, and of one beam each
+        for num_bins in (7, 64, 1080):
+            self.check(num_bins, 'min', np.min)
+            self.check(num_bins, 'mean', np.mean)
+            self.check(num_bins, 'percentile', lambda v: np.percentile(v, 10))
+
+    def test_log_range(self):
+        self.check(27, 'min', np.min, log_range=True)
+        self.check(27, 'mean', np.mean, log_range=True)
+        self.check(27, 'percentile', lambda v: np.percentile(v, 10), log_range=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# MIT License
+
+# Copyright (c) 2020 FT Autonomous Team One
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tables of valid starting poses along a track, for resetting cars without checking the map each time
+"""
+
+import unittest
+import numpy as np
+
+from f110_gym.envs.laser_models import get_dt
+
+
+def lookup_clearance(x, y, dt, resolution, origin):
+    # distance to the nearest wall at each (x, y), 0 outside the map (same cells as laser_models.xy_2_rc)
+    orig_s, orig_c = np.sin(origin[2]), np.cos(origin[2])
+    x_trans = x - origin[0]
+    y_trans = y - origin[1]
+    x_rot = x_trans * orig_c + y_trans * orig_s
+    y_rot = -x_trans * orig_s + y_trans * orig_c
+    c = np.floor(x_rot / resolution).astype(int)
+    r = np.floor(y_rot / resolution).astype(int)
+    inside = (c >= 0) & (c < dt.shape[1]) & (r >= 0) & (r < dt.shape[0])
+    clearance = np.zeros(len(x))
+    clearance[inside] = dt[r[inside], c[inside]]
+    return clearance
+
+
+def start_pose_table(centerline, dt, resolution, origin, clearance, lateral_samples=5):
+    """
+    Builds every start pose a car can be reset to on a track: lateral_samples poses across the track
+    at each centerline point, facing along the centerline, keeping only those at least clearance
+    from any wall (with clearance >= half the car's diagonal the car can't touch a wall whatever its heading).
+
+    A pose offset by d from a centerline point with wall distance D is at least D - d from any wall,
+    so the offsets are spread over +-(D - clearance) and points closer than clearance to a wall are dropped.
+
+        Args:
+            centerline (np.ndarray (n, 2+)): closed centerline, x and y in the first two columns
+            dt (np.ndarray (h, w)): distance transform of the map (m)
+            resolution (float): map resolution (m/cell)
+            origin (list [x, y, theta]): pose of the bottom left cell of the map
+            clearance (float): minimum distance from the car's centre to any wall (m)
+            lateral_samples (int, default=5): number of poses across the track at each centerline point
+
+        Returns:
+            poses (np.ndarray (m, 3)): valid [x, y, theta] start poses
+    """
+    points = np.asarray(centerline, dtype=np.float64)[:, 0:2]
+    # heading of the segment leaving each point
+    tangents = np.roll(points, -1, axis=0) - points
+    theta = np.arctan2(tangents[:, 1], tangents[:, 0])
+    normals = np.stack((-np.sin(theta), np.cos(theta)), axis=1)
+
+    # widest offset at each point that still keeps the clearance
+    max_offset = lookup_clearance(points[:, 0], points[:, 1], dt, resolution, origin) - clearance
+    valid = max_offset >= 0
+
+    # (points, lateral samples) grid of poses
+    fractions = np.linspace(-1, 1, lateral_samples) if lateral_samples > 1 else np.zeros(1)
+    offsets = max_offset[valid, None] * fractions[None, :]
+    xy = points[valid, None, :] + offsets[..., None] * normals[valid, None, :]
+    poses = np.empty(offsets.shape + (3,))
+    poses[..., 0:2] = xy
+    poses[..., 2] = theta[valid, None]
+    return poses.reshape(-1, 3)
+
+
+"""
+Unit tests for the start pose table
+"""
+
+class StartPoseTests(unittest.TestCase):
+    def setUp(self):
+        # ring track between radii 8 and 12 m, centred on (0, 0), centerline counter clockwise
+        self.resolution = 0.05
+        self.origin = [-13., -13., 0.]
+        cells = (np.arange(520) + 0.5) * self.resolution - 13.
+        radii = np.hypot(cells[None, :], cells[:, None])
+        self.dt = get_dt(np.where((radii > 8.) & (radii < 12.), 255, 0), self.resolution)
+        angles = np.linspace(0., 2*np.pi, num=200, endpoint=False)
+        self.centerline = 10. * np.stack((np.cos(angles), np.sin(angles)), axis=1)
+
+    def test_poses_keep_clearance(self):
+        clearance = 0.5
+        poses = start_pose_table(self.centerline, self.dt, self.resolution, self.origin, clearance)
+        self.assertEqual(poses.shape, (5 * 200, 3))
+        # inside the walls by the clearance, up to the map's resolution
+        radii = np.hypot(poses[:, 0], poses[:, 1])
+        walls = np.minimum(radii - 8., 12. - radii)
+        self.assertTrue(np.all(walls >= clearance - self.resolution))
+        self.assertTrue(np.all(lookup_clearance(poses[:, 0], poses[:, 1], self.dt, self.resolution,
+                                                self.origin) >= clearance - self.resolution))
+        # spread over the whole width that keeps it
+        self.assertAlmostEqual(walls.min(), clearance, delta=2 * self.resolution)
+        # facing along the track
+        heading = np.arctan2(poses[:, 1], poses[:, 0]) + np.pi/2
+        np.testing.assert_allclose(np.cos(poses[:, 2] - heading), 1., atol=1e-3)
+
+    def test_narrow_track(self):
+        # a clearance wider than half the track leaves no start poses
+        poses = start_pose_table(self.centerline, self.dt, self.resolution, self.origin, 2.1)
+        self.assertEqual(poses.shape, (0, 3))
+
+if __name__ == '__main__':
+    unittest.main()
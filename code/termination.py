@@ -0,0 +1,149 @@
+# MIT License
+
+# Copyright (c) 2020 FT Autonomous Team One
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Early termination rules for episodes that stopped producing useful experience
+"""
+
+import unittest
+import numpy as np
+
+
+class EpisodeTermination(object):
+    """
+    Ends the episodes of K cars that are stuck, reversing or spinning,
+    each rule only looks at quantities the env already computes every step:
+
+    stuck: less than min_progress (m) travelled along the centerline in stuck_time (s)
+    reversing: longitudinal velocity below -reverse_speed (m/s) for reverse_time (s)
+    spinning: yaw rate above spin_rate (rad/s) for spin_time (s)
+
+    Setting the time of a rule to None disables it
+    """
+
+    def __init__(self, num_agents=1, timestep=0.01, stuck_time=5.0, min_progress=1.0,
+                 reverse_time=2.0, reverse_speed=0.1, spin_time=0.5, spin_rate=8.0):
+        self.timestep = timestep
+        self.stuck_time = stuck_time
+        self.min_progress = min_progress
+        self.reverse_time = reverse_time
+        self.reverse_speed = reverse_speed
+        self.spin_time = spin_time
+        self.spin_rate = spin_rate
+        # progress since the last time a car moved min_progress, and how long that took
+        self.progress = np.zeros(num_agents)
+        self.stuck_timer = np.zeros(num_agents)
+        # how long each car has been reversing/spinning for
+        self.reverse_timer = np.zeros(num_agents)
+        self.spin_timer = np.zeros(num_agents)
+        # which rules ended the episode
+        self.stuck = np.zeros(num_agents, dtype=bool)
+        self.reversing = np.zeros(num_agents, dtype=bool)
+        self.spinning = np.zeros(num_agents, dtype=bool)
+
+    def reset(self):
+        for timer in (self.progress, self.stuck_timer, self.reverse_timer, self.spin_timer):
+            timer[:] = 0
+        for flag in (self.stuck, self.reversing, self.spinning):
+            flag[:] = False
+
+    def __call__(self, delta_s, vels_x, yaw_rates):
+        # all inputs are (K,) arrays: distance along the centerline this step,
+        # longitudinal velocity and yaw rate, returns (K,) bools, True where the episode should end
+        if self.stuck_time is not None:
+            self.progress += delta_s
+            self.stuck_timer += self.timestep
+            moved = self.progress >= self.min_progress
+            self.progress[moved] = 0
+            self.stuck_timer[moved] = 0
+            np.greater(self.stuck_timer, self.stuck_time, out=self.stuck)
+
+        if self.reverse_time is not None:
+            self.reverse_timer = np.where(np.asarray(vels_x) < -self.reverse_speed,
+                                          self.reverse_timer + self.timestep, 0)
+            np.greater(self.reverse_timer, self.reverse_time, out=self.reversing)
+
+        if self.spin_time is not None:
+            self.spin_timer = np.where(np.abs(yaw_rates) > self.spin_rate,
+                                       self.spin_timer + self.timestep, 0)
+            np.greater(self.spin_timer, self.spin_time, out=self.spinning)
+
+        return self.stuck | self.reversing | self.spinning
+
+    def get_info(self):
+        # which rule ended each car's episode, for the env's info dict
+        return {'stuck': self.stuck.copy(), 'reversing': self.reversing.copy(), 'spinning': self.spinning.copy()}
+
+
+"""
+Unit tests for the termination rules
+"""
+
+class EpisodeTerminationTests(unittest.TestCase):
+    def setUp(self):
+        # quarter second steps, every rule needs more than a second to fire
+        self.termination = EpisodeTermination(num_agents=1, timestep=0.25, stuck_time=1.0, min_progress=1.0,
+                                              reverse_time=1.0, reverse_speed=0.1, spin_time=1.0, spin_rate=8.0)
+
+    def first_done(self, delta_s, vels_x, yaw_rates):
+        # index of the first step that ends the episode, None if none does
+        for step, inputs in enumerate(zip(delta_s, vels_x, yaw_rates)):
+            if self.termination(*[np.array([value]) for value in inputs])[0]:
+                return step
+        return None
+
+    def test_stuck(self):
+        # 0.5 m in 5 steps isn't enough progress
+        self.assertEqual(self.first_done([0.1] * 10, [1.] * 10, [0.] * 10), 4)
+        info = self.termination.get_info()
+        self.assertEqual((info['stuck'][0], info['reversing'][0], info['spinning'][0]), (True, False, False))
+        # 1 m every 4 steps restarts the timer in time
+        self.termination.reset()
+        self.assertIsNone(self.first_done([0.25] * 20, [1.] * 20, [0.] * 20))
+
+    def test_reversing(self):
+        moving = [1.] * 20
+        # reversing for a second at a time, or slower than reverse_speed
+        self.assertIsNone(self.first_done(moving, [-0.5] * 4 + [0.5] + [-0.5] * 4 + [-0.05] * 6, [0.] * 20))
+        self.assertEqual(self.first_done(moving, [-0.5] * 10, [0.] * 10), 4)
+        self.assertTrue(self.termination.reversing[0])
+
+    def test_spinning(self):
+        moving = [1.] * 20
+        self.assertIsNone(self.first_done(moving, [1.] * 20, [10.] * 4 + [0.] + [-10.] * 4 + [7.] * 6))
+        self.assertEqual(self.first_done(moving, [1.] * 10, [-10.] * 10), 4)
+        self.assertTrue(self.termination.spinning[0])
+
+    def test_reset(self):
+        # timers and flags start again after a reset
+        self.assertEqual(self.first_done([0.] * 10, [-0.5] * 10, [10.] * 10), 4)
+        self.termination.reset()
+        self.assertFalse(self.termination.stuck[0] or self.termination.reversing[0] or self.termination.spinning[0])
+        self.assertIsNone(self.first_done([0.] * 4, [-0.5] * 4, [10.] * 4))
+
+    def test_disabled_rules(self):
+        termination = EpisodeTermination(timestep=0.25, stuck_time=None, reverse_time=None, spin_time=None)
+        for _ in range(100):
+            self.assertFalse(termination(np.zeros(1), np.array([-1.]), np.array([10.]))[0])
+
+if __name__ == '__main__':
+    unittest.main()
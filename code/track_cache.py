@@ -0,0 +1,127 @@
+# MIT License
+
+# Copyright (c) 2020 FT Autonomous Team One
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+On-disk cache of generated tracks, shared by every env (and run) using the same directory
+"""
+
+import os
+import hashlib
+import zipfile
+import tempfile
+import numpy as np
+
+from pathlib import Path
+
+from code.random_trackgen import generate_track, GeneratedTrack, MAP_RESOLUTION, TRACK_SCALE, GENERATOR_VERSION
+
+
+class TrackCache(object):
+    """
+    Content-addressed store of generated tracks. Each track is one .npz file
+    named by a hash of the generator seed and parameters, holding the map image,
+    distance transform and centerline, so a seed is only ever generated once.
+
+    Safe to share between processes without locking:
+    files are written to a temporary file and renamed into place, so readers
+    only ever see complete tracks, and two workers generating the same track
+    just replace one identical file with another.
+    Reading a track touches its modification time, and the least recently used
+    tracks are deleted once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory='track_cache', max_bytes=2 ** 30):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(seed, resolution=MAP_RESOLUTION):
+        # hash of everything that determines the generated track
+        params = f"v{GENERATOR_VERSION}:seed={int(seed)}:resolution={resolution!r}:scale={TRACK_SCALE!r}"
+        return hashlib.sha1(params.encode()).hexdigest()
+
+    def path(self, key):
+        return self.directory / f"{key}.npz"
+
+    def get(self, seed, resolution=MAP_RESOLUTION):
+        # cached track, or None if it isn't cached (or was evicted while being read)
+        path = self.path(self.key(seed, resolution))
+        try:
+            with np.load(path) as data:
+                track = GeneratedTrack(seed, data['map_img'], float(data['resolution']),
+                                       data['origin'], data['dt'], data['centerline'])
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            return None
+        # mark as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return track
+
+    def put(self, track):
+        # atomically write track to the cache, then make room for it
+        path = self.path(self.key(track.seed, track.resolution))
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, map_img=track.map_img, resolution=track.resolution, origin=track.origin,
+                         dt=track.dt, centerline=track.centerline)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        # delete least recently used tracks until the cache fits in max_bytes
+        entries = []
+        for f in self.directory.glob('*.npz'):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                # deleted by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if f == keep:
+                continue
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def generate(self, seed, resolution=MAP_RESOLUTION, max_attempts=20):
+        # drop-in replacement for generate_track that goes through the cache
+        track = self.get(seed, resolution)
+        if track is None:
+            track = generate_track(seed, resolution, max_attempts)
+            self.put(track)
+        return track
@@ -0,0 +1,122 @@
+# MIT License
+
+# Copyright (c) 2020 FT Autonomous Team One
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Racetracks loaded once and shared between every env, for switching between real tracks without any I/O
+"""
+
+import os
+import yaml
+import tempfile
+import numpy as np
+
+from PIL import Image
+from pathlib import Path
+from collections import namedtuple
+
+from f110_gym.envs.laser_models import get_dt, crop_map
+
+# everything the simulator needs to switch to a racetrack
+LibraryTrack = namedtuple('LibraryTrack', ['name', 'map_img', 'resolution', 'origin', 'dt', 'centerline'])
+
+
+def save_array(path, array):
+    # write array to a .npy file atomically, so concurrent readers never see it half written
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=path.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class TrackLibrary(object):
+    """
+    Loads the map image, distance transform and centerline of every racetrack once,
+    then switching track is just indexing into the library.
+
+    The first time a track is loaded its binarised image and distance transform are written
+    as .npy files to cache_dir (rebuilt if the source map changes), after that they are
+    just memory-mapped read-only. All SubprocVecEnv workers then share the same pages of the
+    OS file cache instead of each holding their own copy of every track.
+    Maps are cropped to their walls plus crop_margin (m), a scan can't see further than max_range anyway
+    """
+
+    def __init__(self, names, directory='./f1tenth_racetracks', cache_dir='track_library', crop_margin=30.):
+        self.names = list(names)
+        self.directory = Path(directory)
+        self.cache_dir = Path(cache_dir)
+        self.crop_margin = crop_margin
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.tracks = [self.load(name) for name in self.names]
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __getitem__(self, index):
+        return self.tracks[index]
+
+    def index(self, name):
+        return self.names.index(name)
+
+    def load(self, name):
+        # memory-map the cached arrays of a track, building them first if missing or stale
+        map_yaml = self.directory / name / f"{name}_map.yaml"
+        with open(map_yaml, 'r') as yaml_stream:
+            map_metadata = yaml.safe_load(yaml_stream)
+        resolution = map_metadata['resolution']
+        map_path = map_yaml.parent / map_metadata['image']
+        centerline_path = self.directory / name / f"{name}_centerline.csv"
+
+        img_path = self.cache_dir / f"{name}_map.npy"
+        dt_path = self.cache_dir / f"{name}_dt.npy"
+        centerline_cache = self.cache_dir / f"{name}_centerline.npy"
+        origin_path = self.cache_dir / f"{name}_origin.npy"
+
+        sources = max(os.path.getmtime(p) for p in (map_yaml, map_path, centerline_path))
+        try:
+            stale = min(os.path.getmtime(p) for p in (img_path, dt_path, centerline_cache, origin_path)) < sources
+        except FileNotFoundError:
+            stale = True
+
+        if stale:
+            # same loading and binarisation as ScanSimulator2D.set_map
+            map_img = np.array(Image.open(map_path).transpose(Image.FLIP_TOP_BOTTOM))
+            map_img = np.where(map_img > 128., 255, 0).astype(np.uint8)
+            map_img, origin = crop_map(map_img, resolution, map_metadata['origin'], self.crop_margin)
+            dt = get_dt(map_img.astype(np.float64), resolution).astype(np.float32)
+            save_array(origin_path, np.array(origin, dtype=np.float64))
+            save_array(img_path, map_img)
+            save_array(dt_path, dt)
+            save_array(centerline_cache, np.genfromtxt(centerline_path, delimiter=','))
+
+        return LibraryTrack(name,
+                            np.load(img_path, mmap_mode='r'),
+                            resolution,
+                            list(np.load(origin_path)),
+                            np.load(dt_path, mmap_mode='r'),
+                            np.load(centerline_cache))
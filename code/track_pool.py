@@ -0,0 +1,89 @@
+# MIT License
+
+# Copyright (c) 2020 FT Autonomous Team One
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Background generation of random tracks, so map switches don't block the env
+"""
+
+import numpy as np
+import multiprocessing
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from code.random_trackgen import generate_track, MAP_RESOLUTION
+
+
+def track_seed(seed, index):
+    # independent seed for the index-th track of an env seeded with seed
+    return int(np.random.SeedSequence([seed, index]).generate_state(1)[0])
+
+
+class TrackPool(object):
+    """
+    Keeps a bounded queue of tracks being generated ahead of demand.
+    Taking a track immediately queues up the generation of another one,
+    so get() only blocks if tracks are consumed faster than they are made.
+
+    Uses worker processes where possible. SubprocVecEnv workers are daemonic
+    and can't start processes of their own, so there it falls back to a thread
+    (track rasterising and the distance transform spend most of their time in cv2/scipy)
+
+    With a TrackCache, tracks are read from it if cached and added to it otherwise
+    """
+
+    def __init__(self, seed, size=2, workers=1, resolution=MAP_RESOLUTION, cache=None):
+        self.seed = seed
+        self.generate = generate_track if cache is None else cache.generate
+        self.size = size
+        self.resolution = resolution
+        # index of the next track to queue
+        self.index = 0
+
+        if multiprocessing.current_process().daemon:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+
+        # fill the queue
+        self.queue = deque()
+        for _ in range(size):
+            self._submit()
+
+    def _submit(self):
+        self.queue.append(self.executor.submit(self.generate,
+                                               track_seed(self.seed, self.index),
+                                               self.resolution))
+        self.index += 1
+
+    def get(self):
+        # pop the oldest track (waiting for it if it isn't ready yet) and queue another
+        future = self.queue.popleft()
+        self._submit()
+        return future.result()
+
+    def close(self):
+        # stop generating, discarding queued tracks
+        for future in self.queue:
+            future.cancel()
+        self.queue.clear()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,57 @@
+# MIT License
+
+# Copyright (c) 2020 FT Autonomous Team One
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Wrappers of vectorised F1Tenth environments, applied in the learner's process
+"""
+
+import numpy as np
+
+from stable_baselines3.common.vec_env import VecEnvWrapper
+
+
+class DecodeScans(VecEnvWrapper):
+    """
+    Normalises the encoded scans of vectorised F110_Wrapped(scan_encoding=...) envs, in the learner's process.
+    Workers then pipe 2 bytes per beam ('mm') or 1 ('log') instead of 4, and the model sees the same
+    observation space as without an encoding. Codes are decoded by a lookup in the table of the normalised
+    observation of every code, built by the workers' F110_Wrapped
+    """
+
+    def __init__(self, venv):
+        self.table = venv.get_attr('scan_decode_table', [0])[0]
+        super().__init__(venv, observation_space=venv.get_attr('decoded_observation_space', [0])[0])
+
+    def decode(self, codes):
+        # normalised observations of codes of any shape
+        return np.take(self.table, codes)
+
+    def reset(self):
+        return self.decode(self.venv.reset())
+
+    def step_wait(self):
+        observations, rewards, dones, infos = self.venv.step_wait()
+        # observations of finished episodes, before their automatic reset
+        for info in infos:
+            if 'terminal_observation' in info:
+                info['terminal_observation'] = self.decode(info['terminal_observation'])
+        return self.decode(observations), rewards, dones, infos
@@ -20,20 +20,29 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
 import gym
+import unittest
+import warnings
 import numpy as np
 
 from gym import spaces
-from pathlib import Path
-
-from code.random_trackgen import create_track, convert_track
+from f110_gym.envs.f110_env import F110Env
+from f110_gym.envs.occupancy import EgocentricGrid
+from f110_gym.envs.scan_codec import ScanCodec
+
+from code.random_trackgen import generate_track, write_track, MAP_RESOLUTION
+from code.track_pool import TrackPool, track_seed
+from code.track_cache import TrackCache
+from code.track_library import TrackLibrary
+from code.rewards import TrackReward
+from code.start_poses import start_pose_table
+from code.termination import EpisodeTermination
+from code.scan_bins import bin_scan, BIN_MODES
 
 mapno = ["Austin","BrandsHatch","Budapest","Catalunya","Hockenheim","IMS","Melbourne","MexicoCity","Montreal","Monza","MoscowRaceway",
          "Nuerburgring","Oschersleben","Sakhir","SaoPaulo","Sepang","Shanghai","Silverstone","Sochi","Spa","Spielberg","YasMarina","Zandvoort"]
 
-randmap = mapno[0]
-globwaypoints = np.genfromtxt(f"./f1tenth_racetracks/{randmap}/{randmap}_centerline.csv", delimiter=',')
-
 def convert_range(value, input_range, output_range):
     # converts value(s) from range to another range
     # ranges ---> [min, max]
@@ -45,19 +54,68 @@ def convert_range(value, input_range, output_range):
 class F110_Wrapped(gym.Wrapper):
     """
     This is a wrapper for the F1Tenth Gym environment intended
-    for only one car, but should be expanded to handle multi-agent scenarios
+    for only one car, but should be expanded to handle multi-agent scenarios.
+    Rewards are the speed plus the progress along the current map's centerline (see TrackReward).
+    Maps without a centerline, such as the one the env was made with, only get the speed term,
+    so their rewards aren't on the same scale as training on maps with one (reset warns about it).
+    Episodes end early when the car is stuck, reversing or spinning (see EpisodeTermination),
+    stuck_time, reverse_time and spin_time (s) set how long that has to last, None disables a rule.
+    Observations are normalised in place into preallocated arrays of type dtype, so an observation returned
+    is only valid until the next call. reset() switches to a second set of arrays, so the last observation
+    of an episode (e.g. SB3's terminal_observation) still holds after the reset that follows it.
+    With scan_history = k > 1, observations are the last k scans (k, 1080), oldest first,
+    or with scan_deltas the k - 1 latest differences between scans followed by the current scan.
+    They are views into a ring buffer of scans, which the next step writes into.
+    With scan_bins = B, each scan is reduced to B angular bins by bin_mode ('min', 'mean' or
+    'percentile' at bin_quantile), and log_range normalises log(1 + range) instead of the range.
+    With occupancy_grid = K, observations are instead a (1, K, K) uint8 image of the map around the car
+    (see EgocentricGrid), cells of grid_cell metres, 0 in walls and other cars up to 255 at grid_range
+    metres or more from them.
+    With scan_encoding ('mm' or 'log', see ScanCodec), the (binned) scans are returned as integer codes
+    instead of being normalised, to be sent cheaply out of SubprocVecEnv workers and normalised by a
+    DecodeScans wrapper around the vectorised envs (see code/vec_wrappers.py)
     """
 
-    def __init__(self, env):
+    def __init__(self, env, stuck_time=5.0, reverse_time=2.0, spin_time=0.5, dtype=np.float32,
+                 scan_history=1, scan_deltas=False, scan_bins=None, bin_mode='min', bin_quantile=0.1,
+                 log_range=False, occupancy_grid=None, grid_cell=0.1, grid_range=1.0, scan_encoding=None):
         super().__init__(env)
 
+        # length of the scan in observations, after binning
+        num_beams = 1080
+        if scan_bins is not None and not 0 < scan_bins <= num_beams:
+            raise ValueError(f"scan_bins must be between 1 and the {num_beams} beams of a scan, not {scan_bins}")
+        self.scan_bins = scan_bins
+        self.bin_mode = BIN_MODES[bin_mode]
+        self.bin_quantile = bin_quantile
+        self.log_range = log_range
+        scan_size = num_beams if scan_bins is None else scan_bins
+
         # normalised action space, steer and speed
         self.action_space = spaces.Box(low=np.array(
-            [-1.0, -1.0]), high=np.array([1.0, 1.0]), dtype=np.float)
+            [-1.0, -1.0], dtype=dtype), high=np.array([1.0, 1.0], dtype=dtype), dtype=dtype)
 
         # normalised observations, just take the lidar scans
         self.observation_space = spaces.Box(
-            low=-1.0, high=1.0, shape=(1080,), dtype=np.float)
+            low=-1.0, high=1.0, shape=(scan_size,), dtype=dtype)
+        self.scan_history = scan_history
+        self.scan_deltas = scan_deltas
+        if scan_history > 1:
+            # scan differences are in [-2, 2], the current scan in [-1, 1]
+            high = np.ones((scan_history, scan_size), dtype=dtype)
+            if scan_deltas:
+                high[:-1] = 2
+            self.observation_space = spaces.Box(low=-high, high=high, dtype=dtype)
+
+        # egocentric image of the distance transform instead of scans
+        self.occupancy_grid = occupancy_grid
+        if occupancy_grid is not None:
+            self.grid = EgocentricGrid(self.env.num_agents, occupancy_grid, grid_cell)
+            self.grid_range = grid_range
+            self.grid_buffer = np.empty((occupancy_grid, occupancy_grid))
+            self.observation_space = spaces.Box(low=0, high=255, shape=(1, occupancy_grid, occupancy_grid),
+                                                dtype=np.uint8)
+            self.grid_obs = np.empty(self.observation_space.shape, dtype=np.uint8)
 
         # store allowed steering/speed/lidar ranges for normalisation
         self.s_min = self.env.params['s_min']
@@ -67,6 +125,49 @@ class F110_Wrapped(gym.Wrapper):
         self.lidar_min = 0
         self.lidar_max = 30  # see ScanSimulator2D max_range
 
+        # lidar normalisation as scan * scale + offset, written into obs_buffer
+        if log_range:
+            self.lidar_scale = 2 / (np.log1p(self.lidar_max) - np.log1p(self.lidar_min))
+            self.lidar_offset = -1 - np.log1p(self.lidar_min) * self.lidar_scale
+        else:
+            self.lidar_scale = 2 / (self.lidar_max - self.lidar_min)
+            self.lidar_offset = -1 - self.lidar_min * self.lidar_scale
+        self.obs_buffer = np.empty(scan_size, dtype=dtype)
+        # binned ranges, before normalisation, and scratch space of bin_scan
+        self.bin_buffer = np.empty(scan_size)
+        self.scan_buffer = np.empty(num_beams)
+
+        # encoded scans, normalised by DecodeScans through a table of the observation of every code
+        self.scan_codec = None
+        if scan_encoding is not None and occupancy_grid is None:
+            if scan_deltas:
+                raise ValueError("scan_deltas can't be encoded, only scans can")
+            self.scan_codec = ScanCodec(scan_encoding, max_range=self.lidar_max)
+            self.decoded_observation_space = self.observation_space
+            ranges = np.log1p(self.scan_codec.table) if log_range else self.scan_codec.table
+            self.scan_decode_table = (ranges * self.lidar_scale + self.lidar_offset).astype(dtype)
+            codes = self.scan_codec.dtype
+            self.observation_space = spaces.Box(low=0, high=np.iinfo(codes).max, shape=self.observation_space.shape,
+                                                dtype=codes)
+            self.code_buffer = np.empty(scan_size, dtype=codes)
+
+        # circular buffer of scans, every row is written twice (at i and i + k) so that
+        # the last k rows always form one contiguous slice, returned without copying
+        if scan_history > 1:
+            self.history = np.zeros((2 * scan_history, scan_size), dtype=self.observation_space.dtype)
+            # row of the latest scan
+            self.history_index = 0
+
+        # second set of the arrays observations are returned in, swapped in by every reset
+        self.buffer_names = ['obs_buffer']
+        if self.scan_codec is not None:
+            self.buffer_names.append('code_buffer')
+        if occupancy_grid is not None:
+            self.buffer_names.append('grid_obs')
+        if scan_history > 1:
+            self.buffer_names.append('history')
+        self.spare_buffers = [np.empty_like(getattr(self, name)) for name in self.buffer_names]
+
         # store car dimensions and some track info
         self.car_length = self.env.params['length']
         self.car_width = self.env.params['width']
@@ -76,11 +177,21 @@ class F110_Wrapped(gym.Wrapper):
         self.start_radius = (self.track_width / 2) - \
             ((self.car_length + self.car_width) / 2)  # just extra wiggle room
 
+        # valid start poses of the current map, built when a map comes with a centerline
+        # car can't touch a wall in any orientation if its centre is half its diagonal away
+        self.start_clearance = np.hypot(self.car_length, self.car_width) / 2
+        self.start_poses = None
+        # centerline of the current map, sampled instead when no pose keeps the clearance
+        self.start_centerline = None
+
         self.step_count = 0
 
-        # set threshold for maximum angle of car, to prevent spinning
-        self.max_theta = 100
-        self.count = 0
+        # speed, progress and collision rewards, follows the centerline of the current map
+        self.reward_engine = TrackReward(timestep=self.env.timestep)
+
+        # end episodes that have stopped going anywhere
+        self.termination = EpisodeTermination(timestep=self.env.timestep, stuck_time=stuck_time,
+                                              reverse_time=reverse_time, spin_time=spin_time)
 
     def step(self, action):
         # convert normalised actions (from RL algorithms) back to actual actions for simulator
@@ -89,38 +200,24 @@ class F110_Wrapped(gym.Wrapper):
 
         self.step_count += 1
 
-        # TODO -> do some reward engineering here and mess around with this
-        reward = 0
-
-        #eoins reward function
-        vel_magnitude = np.linalg.norm(
-            [observation['linear_vels_x'][0], observation['linear_vels_y'][0]])
-        reward = vel_magnitude #/10 maybe include if speed is having too much of an effect
-
-        # reward function that returns percent of lap left, maybe try incorporate speed into the reward too
-        #waypoints = np.genfromtxt(f"./f1tenth_racetracks/{randmap}/{randmap}_centerline.csv", delimiter=',')
-
-        if self.count < len(globwaypoints):
-            wx, wy = globwaypoints[self.count][:2]
-            X, Y = observation['poses_x'][0], observation['poses_y'][0]
-            dist = np.sqrt(np.power((X - wx), 2) + np.power((Y - wy), 2))
-            #print("Dist:", dist, " to waypoint: ", self.count + 1)
-            if dist > 2:
-                self.count += 1
-                complete = (self.count/len(globwaypoints)) * 0.5
-                #print("Percent complete: ", complete)
-                reward += complete
+        # speed reward, plus progress along the current map's centerline, -1 on collision
+        reward = self.reward_engine(observation['poses_x'],
+                                    observation['poses_y'],
+                                    observation['poses_theta'],
+                                    observation['linear_vels_x'],
+                                    observation['linear_vels_y'],
+                                    observation['collisions'])[0]
+        info.update(self.reward_engine.get_info())
+
+        # end episode if car is stuck, reversing or spinning
+        # progress is along the centerline, or just distance travelled on maps without one
+        if self.reward_engine.tracker is not None:
+            delta_s = self.reward_engine.delta_s
         else:
-            self.count = 0
-
-        if observation['collisions'][0]:
-            self.count = 0
-            # reward = -100
-            reward = -1
-
-        # end episode if car is spinning
-        if abs(observation['poses_theta'][0]) > self.max_theta:
+            delta_s = self.env.timestep * np.hypot(observation['linear_vels_x'], observation['linear_vels_y'])
+        if self.termination(delta_s, observation['linear_vels_x'], observation['ang_vels_z'])[0]:
             done = True
+        info.update(self.termination.get_info())
 
         """
         vel_magnitude = np.linalg.norm([observation['linear_vels_x'][0], observation['linear_vels_y'][0]])
@@ -159,9 +256,21 @@ class F110_Wrapped(gym.Wrapper):
                 reward += 1
                 self.env.lap_counts[0] = 0"""
 
-        return self.normalise_observations(observation['scans'][0]), reward, bool(done), info
+        return self.observe(observation), reward, bool(done), info
 
     def reset(self, start_xy=None, direction=None):
+        # with no pose input, start from a random pose in the current map's start pose table
+        if start_xy is None and direction is None and self.start_poses is not None:
+            pose = self.start_poses[np.random.randint(len(self.start_poses))]
+            return self.reset_pose(pose)
+
+        # otherwise from a random centerline point, facing the next one
+        if start_xy is None and direction is None and self.start_centerline is not None:
+            random_index = np.random.randint(len(self.start_centerline))
+            start_xy = self.start_centerline[random_index, :2]
+            next_xy = self.start_centerline[(random_index + 1) % len(self.start_centerline), :2]
+            direction = np.arctan2(next_xy[1] - start_xy[1], next_xy[0] - start_xy[0])
+
         # should start off in slightly different position every time
         # position car anywhere along line from wall to wall facing
         # car will never face backwards, can face forwards at an angle
@@ -187,28 +296,130 @@ class F110_Wrapped(gym.Wrapper):
         t = -np.random.uniform(max(-rand_offset * np.pi / 2, 0) - np.pi / 2,
                                min(-rand_offset * np.pi / 2, 0) + np.pi / 2) + direction
         # reset car with chosen pose
-        observation, _, _, _ = self.env.reset(np.array([[x, y, t]]))
+        return self.reset_pose(np.array([x, y, t]))
+
+    def reset_pose(self, pose):
+        # reset car to pose [x, y, theta]
+        observation, _, _, _ = self.env.reset(np.array([pose]))
+        self.termination.reset()
+        self.reward_engine.reset(observation['poses_x'],
+                                 observation['poses_y'],
+                                 observation['poses_theta'])
+        if self.reward_engine.tracker is None:
+            warnings.warn("No centerline for the current map, rewards leave out the progress term "
+                          "(pass one to update_map)")
         # reward, done, info can't be included in the Gym format
-        return self.normalise_observations(observation['scans'][0])
+        self.swap_buffers()
+        return self.observe(observation, reset=True)
 
     def un_normalise_actions(self, actions):
         # convert actions from range [-1, 1] to normal steering/speed range
         steer = convert_range(actions[0], [-1, 1], [self.s_min, self.s_max])
         speed = convert_range(actions[1], [-1, 1], [self.v_min, self.v_max])
-        return np.array([steer, speed], dtype=np.float)
+        return np.array([steer, speed], dtype=np.float64)
+
+    def normalise_actions(self, actions):
+        # convert steering/speed actions (e.g. of an expert) to the range [-1, 1] of RL algorithms
+        steer = convert_range(actions[..., 0], [self.s_min, self.s_max], [-1, 1])
+        speed = convert_range(actions[..., 1], [self.v_min, self.v_max], [-1, 1])
+        return np.clip(np.stack((steer, speed), axis=-1), -1, 1).astype(self.action_space.dtype)
+
+    def swap_buffers(self):
+        # write the next episode's observations into the other set of arrays, leaving the last one returned intact
+        for i, name in enumerate(self.buffer_names):
+            spare = self.spare_buffers[i]
+            self.spare_buffers[i] = getattr(self, name)
+            setattr(self, name, spare)
+
+    def observe(self, observation, reset=False):
+        # observation of the first car from the env's observation dict
+        if self.occupancy_grid is not None:
+            return self.grid_observation(observation)
+        if self.scan_codec is not None:
+            return self.stack_scans(self.encode_observations(observation['scans'][0]), reset)
+        return self.stack_scans(self.normalise_observations(observation['scans'][0]), reset)
+
+    def grid_observation(self, observation):
+        # egocentric grid of the first car, as an image
+        poses = np.stack((observation['poses_x'], observation['poses_y'], observation['poses_theta']), axis=1)
+        grids = self.grid(poses, self.env.sim.agents[0].scan_simulator, self.car_length, self.car_width)
+        np.minimum(grids[0], self.grid_range, out=self.grid_buffer)
+        np.multiply(self.grid_buffer, 255 / self.grid_range, out=self.grid_obs[0], casting='unsafe')
+        return self.grid_obs
 
     def normalise_observations(self, observations):
-        # convert observations from normal lidar distances range to range [-1, 1]
-        return convert_range(observations, [self.lidar_min, self.lidar_max], [-1, 1])
-
-    def update_map(self, map_name, map_extension, update_render=True):
+        # convert observations from normal lidar distances range to range [-1, 1], without allocating
+        if self.scan_bins is not None:
+            bin_scan(observations, self.bin_buffer, self.scan_buffer, self.bin_mode, self.bin_quantile, self.log_range)
+            observations = self.bin_buffer
+        elif self.log_range:
+            observations = np.log1p(observations, out=self.bin_buffer)
+        np.multiply(observations, self.lidar_scale, out=self.obs_buffer)
+        self.obs_buffer += self.lidar_offset
+        return self.obs_buffer
+
+    def encode_observations(self, observations):
+        # encode (binned) lidar ranges, normalised later by DecodeScans
+        if self.scan_bins is not None:
+            bin_scan(observations, self.bin_buffer, self.scan_buffer, self.bin_mode, self.bin_quantile, self.log_range)
+            observations = self.bin_buffer
+            if self.log_range:
+                # statistics of the log ranges, back to metres to be encoded
+                np.expm1(observations, out=observations)
+        return self.scan_codec.encode(observations, out=self.code_buffer)
+
+    def stack_scans(self, scan, reset=False):
+        # add scan to the scan history, returns a view of the last k scans (or just scan without a history)
+        k = self.scan_history
+        if k == 1:
+            return scan
+        i = self.history_index
+        if reset:
+            # history starts as copies of the first scan, with no change between them
+            self.history[:] = 0 if self.scan_deltas else scan
+            i = k - 1
+        else:
+            if self.scan_deltas:
+                # the previous scan becomes its difference to the new one
+                np.subtract(scan, self.history[i], out=self.history[i])
+                self.history[i + k] = self.history[i]
+            i = (i + 1) % k
+        self.history[i] = scan
+        self.history[i + k] = scan
+        self.history_index = i
+        return self.history[i + 1:i + 1 + k]
+
+    def update_map(self, map_name, map_extension, update_render=True, centerline=None):
         self.env.map_name = map_name
         self.env.map_ext = map_extension
         self.env.update_map(f"{map_name}.yaml", map_extension)
+        # rewards follow the new map's centerline (progress also reported in info)
+        self.reward_engine.update_track(centerline)
+        self.update_start_poses(centerline)
+        if update_render and self.env.renderer:
+            self.env.renderer.close()
+            self.env.renderer = None
+
+    def update_map_array(self, map_img, map_resolution, origin, centerline=None, dt=None, update_render=True):
+        # same as update_map, for a map held in memory (e.g. a generated track)
+        self.env.update_map_array(map_img, map_resolution, origin, dt)
+        self.reward_engine.update_track(centerline)
+        self.update_start_poses(centerline)
         if update_render and self.env.renderer:
             self.env.renderer.close()
             self.env.renderer = None
 
+    def update_start_poses(self, centerline):
+        # precompute the start poses of the map just loaded (None falls back to reset's own sampling)
+        self.start_poses = None
+        self.start_centerline = centerline
+        if centerline is not None:
+            scan_sim = self.env.sim.agents[0].scan_simulator
+            poses = start_pose_table(centerline, scan_sim.dt, scan_sim.map_resolution,
+                                     scan_sim.origin, self.start_clearance)
+            if len(poses):
+                self.start_poses = poses
+
     def seed(self, seed):
         self.current_seed = seed
         np.random.seed(self.current_seed)
@@ -218,48 +429,58 @@ class F110_Wrapped(gym.Wrapper):
 class RandomMap(gym.Wrapper):
     """
     Generates random maps at chosen intervals, when resetting car,
-    and positions car at random point around new track
+    and positions car at random point around new track.
+    Maps are handed to the simulator in memory, save_maps also writes them to maps/ and centerline/.
+    With pool_size > 0, tracks are generated in the background ahead of time (see TrackPool),
+    otherwise they are generated when needed. Both give the same tracks for the same seed.
+    Generated tracks are kept in a TrackCache in cache_dir (None disables it),
+    so seeds used before, by this or any other env, load instead of regenerating
     """
 
     # stop function from trying to generate map after multiple failures
     MAX_CREATE_ATTEMPTS = 20
 
-    def __init__(self, env, step_interval=5000):
+    def __init__(self, env, step_interval=5000, save_maps=False, pool_size=0,
+                 cache_dir='track_cache', cache_bytes=2 ** 30):
         super().__init__(env)
         # initialise step counters
         self.step_interval = step_interval
         self.step_count = 0
+        self.save_maps = save_maps
+        # background track generation, started once the env is seeded
+        self.pool_size = pool_size
+        self.pool = None
+        self.cache = None if cache_dir is None else TrackCache(cache_dir, cache_bytes)
+        # number of tracks generated so far
+        self.track_count = 0
+
+    def next_track(self):
+        # get the next track for this seed, from the pool or generated now
+        if self.pool_size > 0:
+            if self.pool is None:
+                self.pool = TrackPool(self.current_seed, self.pool_size, cache=self.cache)
+            track = self.pool.get()
+        else:
+            generate = generate_track if self.cache is None else self.cache.generate
+            track = generate(track_seed(self.current_seed, self.track_count),
+                             MAP_RESOLUTION,
+                             self.MAX_CREATE_ATTEMPTS)
+        self.track_count += 1
+        return track
 
     def reset(self):
         # check map update interval
         if self.step_count % self.step_interval == 0:
             # create map
-            for _ in range(self.MAX_CREATE_ATTEMPTS):
-                try:
-                    track, track_int, track_ext = create_track()
-                    convert_track(track,
-                                  track_int,
-                                  track_ext,
-                                  self.current_seed)
-                    break
-                except Exception:
-                    print(
-                        f"Random generator [{self.current_seed}] failed, trying again...")
+            track = self.next_track()
+            self.waypoints = track.centerline
+            if self.save_maps:
+                write_track(track.map_img, track.resolution, track.origin, self.waypoints, self.current_seed)
             # update map
-            self.update_map(f"./maps/map{self.current_seed}", ".png")
-            # store waypoints
-            self.waypoints = np.genfromtxt(f"centerline/map{self.current_seed}.csv",
-                                           delimiter=',')
-        # get random starting position from centerline
-        random_index = np.random.randint(len(self.waypoints))
-        start_xy = self.waypoints[random_index]
-        print(start_xy)
-        next_xy = self.waypoints[(random_index + 1) % len(self.waypoints)]
-        # get forward direction by pointing at next point
-        direction = np.arctan2(next_xy[1] - start_xy[1],
-                               next_xy[0] - start_xy[0])
-        # reset environment
-        return self.env.reset(start_xy=start_xy, direction=direction)
+            self.update_map_array(track.map_img, track.resolution, track.origin,
+                                  centerline=self.waypoints, dt=track.dt)
+        # reset environment, at a random pose from the map's start pose table
+        return self.env.reset()
 
     def step(self, action):
         # increment class step counter
@@ -270,56 +491,45 @@ class RandomMap(gym.Wrapper):
     def seed(self, seed):
         # seed class
         self.env.seed(seed)
-        # delete old maps and centerlines
-        for f in Path('centerline').glob('*'):
-            if not ((seed - 100) < int(''.join(filter(str.isdigit, str(f)))) < (seed + 100)):
-                try:
-                    f.unlink()
-                except:
-                    pass
-        for f in Path('maps').glob('*'):
-            if not ((seed - 100) < int(''.join(filter(str.isdigit, str(f)))) < (seed + 100)):
-                try:
-                    f.unlink()
-                except:
-                    pass
+        # restart the track sequence for the new seed
+        self.track_count = 0
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+        return self.env.close()
 
 class RandomF1TenthMap(gym.Wrapper):
     """
-    Places the car in a random map from F1Tenth
+    Places the car in a random map from F1Tenth.
+    All maps are loaded once into a TrackLibrary (which can be shared between wrappers),
+    so switching map doesn't read anything from disk
     """
 
-    # stop function from trying to generate map after multiple failures
-    MAX_CREATE_ATTEMPTS = 20
-
-    def __init__(self, env, step_interval=5000):
+    def __init__(self, env, step_interval=5000, library=None):
         super().__init__(env)
         # initialise step counters
         self.step_interval = step_interval
         self.step_count = 0
+        # maps, distance transforms and centerlines of all the tracks
+        self.library = TrackLibrary(mapno) if library is None else library
 
     def reset(self):
         # check map update interval
         if self.step_count % self.step_interval == 0:
             # update map
-            randmap = mapno[np.random.randint(low=0, high=22)]
-            #self.update_map(f"./maps/map{self.current_seed}", ".png")
-            self.update_map(f"./f1tenth_racetracks/{randmap}/{randmap}_map", ".png")
+            track = self.library[np.random.randint(len(self.library))]
             # store waypoints
-            #self.waypoints = np.genfromtxt(f"centerline/map{self.current_seed}.csv",delimiter=',')
-            self.waypoints = np.genfromtxt(f"./f1tenth_racetracks/{randmap}/{randmap}_centerline.csv", delimiter=',')
-            globwaypoints = self.waypoints
-
-        # get random starting position from centerline
-        random_index = np.random.randint(len(self.waypoints))
-        start_xy = self.waypoints[random_index]  #len = 4
-        start_xy = start_xy[:2]
-        next_xy = self.waypoints[(random_index + 1) % len(self.waypoints)]
-        # get forward direction by pointing at next point
-        direction = np.arctan2(next_xy[1] - start_xy[1],
-                               next_xy[0] - start_xy[0])
-        # reset environment
-        return self.env.reset(start_xy=start_xy, direction=direction)
+            self.waypoints = track.centerline
+            self.update_map_array(track.map_img, track.resolution, track.origin,
+                                  centerline=self.waypoints, dt=track.dt)
+
+        # reset environment, at a random pose from the map's start pose table
+        return self.env.reset()
 
     def step(self, action):
         # increment class step counter
@@ -330,19 +540,6 @@ class RandomF1TenthMap(gym.Wrapper):
     def seed(self, seed):
         # seed class
         self.env.seed(seed)
-        # delete old maps and centerlines
-        for f in Path('centerline').glob('*'):
-            if not ((seed - 100) < int(''.join(filter(str.isdigit, str(f)))) < (seed + 100)):
-                try:
-                    f.unlink()
-                except:
-                    pass
-        for f in Path('maps').glob('*'):
-            if not ((seed - 100) < int(''.join(filter(str.isdigit, str(f)))) < (seed + 100)):
-                try:
-                    f.unlink()
-                except:
-                    pass
 
 
 class ThrottleMaxSpeedReward(gym.RewardWrapper):
@@ -373,3 +570,65 @@ class ThrottleMaxSpeedReward(gym.RewardWrapper):
         # otherwise, proportional reward between two step endpoints
         else:
             return min(reward, self.start_max_reward + (self.step_count - self.start_step) * self.reward_slope)
+
+
+"""
+Unit tests for the wrappers
+"""
+
+class F110WrappedTests(unittest.TestCase):
+    def setUp(self):
+        track = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'f1tenth_racetracks', 'Austin')
+        self.env = F110Env(map=os.path.join(track, 'Austin_map'), map_ext='.png', num_agents=1)
+        centerline = np.loadtxt(os.path.join(track, 'Austin_centerline.csv'), delimiter=',')
+        # two poses along the centerline, facing along it
+        headings = np.arctan2(centerline[1:, 1] - centerline[:-1, 1], centerline[1:, 0] - centerline[:-1, 0])
+        self.poses = [np.array([*centerline[i, :2], headings[i]]) for i in (0, 100)]
+
+    def test_warns_without_centerline(self):
+        env = F110_Wrapped(self.env)
+        with self.assertWarns(UserWarning):
+            env.reset_pose(self.poses[0])
+
+    def test_scan_bins(self):
+        env = F110_Wrapped(self.env, scan_bins=64, bin_mode='mean')
+        self.assertEqual(env.reset_pose(self.poses[0]).shape, (64, ))
+        with self.assertRaises(ValueError):
+            F110_Wrapped(self.env, scan_bins=1081)
+
+    def test_terminal_observation_survives_reset(self):
+        for kwargs in ({}, {'scan_encoding': 'mm'}, {'occupancy_grid': 32}, {'scan_history': 3},
+                       {'scan_history': 3, 'scan_deltas': True}):
+            env = F110_Wrapped(self.env, stuck_time=0.05, **kwargs)
+            env.reset_pose(self.poses[0])
+            # standing still ends the episode as stuck
+            action = env.normalise_actions(np.zeros(2))
+            done = False
+            while not done:
+                obs, _, done, info = env.step(action)
+            self.assertTrue(info['stuck'][0])
+            terminal = obs.copy()
+            first = env.reset_pose(self.poses[1])
+            self.assertFalse(np.shares_memory(obs, first))
+            self.assertFalse(np.array_equal(first, terminal))
+            np.testing.assert_array_equal(obs, terminal)
+
+    def test_start_without_pose_table(self):
+        # no pose keeps this clearance, so resets fall back to sampling around the centerline
+        track = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'f1tenth_racetracks', 'Austin')
+        centerline = np.loadtxt(os.path.join(track, 'Austin_centerline.csv'), delimiter=',')
+        env = F110_Wrapped(self.env)
+        env.start_clearance = 10.
+        env.update_map(os.path.join(track, 'Austin_map'), '.png', centerline=centerline)
+        self.assertIsNone(env.start_poses)
+        headings = np.arctan2(np.roll(centerline[:, 1], -1) - centerline[:, 1], np.roll(centerline[:, 0], -1) - centerline[:, 0])
+        for _ in range(20):
+            env.reset()
+            x, y, theta = env.env.sim.agents[0].state[[0, 1, 4]]
+            # across the track from a centerline point, never facing backwards
+            nearest = np.argmin(np.hypot(centerline[:, 0] - x, centerline[:, 1] - y))
+            self.assertLess(np.hypot(centerline[nearest, 0] - x, centerline[nearest, 1] - y), env.start_radius + 1.)
+            self.assertGreater(np.cos(theta - headings[nearest]), -0.2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+# MIT License
+
+# Copyright (c) 2021 Eoin Gogarty, Charlie Maguire and Manus McAuliffe (Formula Trintiy Autonomous)
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Generates expert demonstrations on every f1tenth_racetracks raceline, for imitation pretraining of the policy.
+Tracks are driven in parallel processes, each one running a few cars (one env each) with a BatchPurePursuit
+planning for all of them, and writing a dataset of its own (see code/rollouts.py)
+"""
+
+import os
+import gym
+import glob
+import time
+import argparse
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from code.wrappers import F110_Wrapped
+from code.experts import BatchPurePursuit, load_raceline, clear_raceline
+from code.rollouts import RolloutWriter
+from code.track_pool import track_seed
+
+
+RACETRACKS_PATH = "./f1tenth_racetracks"
+DATASET_DIRECTORY = "./demonstrations"
+NUM_PROCESS = 4
+CARS_PER_TRACK = 8
+MAX_EPISODE_STEPS = 3000  # episodes are cut short so that they start all around the tracks
+RACELINE_CLEARANCE = 0.5  # distance kept from the track edges (m)
+MAX_LATERAL_ACCEL = 6.0  # raceline speeds are capped to this in corners (m/s^2)
+SCAN_ENCODING = "mm"  # scans are stored as uint16 millimetres, see exporting.py
+INFO_KEYS = ("progress", "arc_length", "lateral_offset", "heading_error")  # track progress of each step
+
+
+def raceline_tracks(racetracks_path):
+    # tracks with a map, a centerline and a raceline
+    tracks = []
+    for path in sorted(glob.glob(f"{racetracks_path}/*/*_raceline.csv")):
+        track = os.path.basename(os.path.dirname(path))
+        if os.path.exists(f"{racetracks_path}/{track}/{track}_map.yaml") and \
+                os.path.exists(f"{racetracks_path}/{track}/{track}_centerline.csv"):
+            tracks.append(track)
+    return tracks
+
+
+def demonstrate(track, steps, seed, output):
+    # drives CARS_PER_TRACK cars on a track for a total of steps steps, runs in a worker process
+    np.random.seed(seed)
+    map_name = f"{RACETRACKS_PATH}/{track}/{track}_map"
+    centerline = np.loadtxt(f"{RACETRACKS_PATH}/{track}/{track}_centerline.csv", delimiter=",", comments="#")
+    waypoints, speeds = load_raceline(f"{RACETRACKS_PATH}/{track}/{track}_raceline.csv")
+    waypoints = clear_raceline(waypoints, centerline, RACELINE_CLEARANCE)
+
+    # one env per car, starting at random poses along the centerline
+    envs = []
+    for _ in range(CARS_PER_TRACK):
+        env = gym.make("f110_gym:f110-v0",
+                       map=map_name,
+                       map_ext=".png",
+                       num_agents=1)
+        env = F110_Wrapped(env, scan_encoding=SCAN_ENCODING)
+        env.update_map(map_name, ".png", centerline=centerline)
+        envs.append(env)
+    expert = BatchPurePursuit(waypoints, speeds, num_agents=CARS_PER_TRACK, max_lateral_accel=MAX_LATERAL_ACCEL)
+
+    metadata = {"track": track,
+                "seed": seed,
+                "expert": expert.config(),
+                "raceline_clearance": RACELINE_CLEARANCE,
+                "max_lateral_accel": MAX_LATERAL_ACCEL,
+                "scan_codec": envs[0].scan_codec.config(),
+                "log_range": envs[0].log_range,
+                "lidar_scale": float(envs[0].lidar_scale),
+                "lidar_offset": float(envs[0].lidar_offset)}
+    writer = RolloutWriter(os.path.join(output, track),
+                           num_envs=CARS_PER_TRACK,
+                           info_keys=INFO_KEYS,
+                           metadata=metadata)
+
+    def car_states():
+        # x, y, theta and speed of every car
+        states = np.stack([env.sim.agents[0].state for env in envs])
+        return states[:, [0, 1, 4]], states[:, 3]
+
+    # observations are copied, the wrapper overwrites its buffer every step
+    obs = np.stack([env.reset() for env in envs])
+    expert.reset(car_states()[0])
+    episode_steps = np.zeros(CARS_PER_TRACK, dtype=int)
+    collisions = 0
+    for _ in range(steps // CARS_PER_TRACK):
+        poses, velocities = car_states()
+        # the actions a policy would have output
+        actions = envs[0].normalise_actions(expert.plan(poses, velocities))
+        next_obs = np.empty_like(obs)
+        rewards = np.empty(CARS_PER_TRACK)
+        dones = np.zeros(CARS_PER_TRACK, dtype=bool)
+        infos = []
+        for i, env in enumerate(envs):
+            next_obs[i], rewards[i], dones[i], info = env.step(actions[i])
+            episode_steps[i] += 1
+            collisions += env.sim.agents[0].in_collision
+            if episode_steps[i] >= MAX_EPISODE_STEPS and not dones[i]:
+                dones[i] = True
+                info["TimeLimit.truncated"] = True
+            if dones[i]:
+                # vector env convention, the final observation is in the info and the env is reset
+                info["terminal_observation"] = next_obs[i].copy()
+                next_obs[i] = env.reset()
+                episode_steps[i] = 0
+            infos.append(info)
+        writer.add(obs, next_obs, actions, rewards, dones, infos)
+        reset = np.flatnonzero(dones)
+        if len(reset):
+            expert.reset(car_states()[0], reset)
+        obs = next_obs
+    writer.close()
+    return track, writer.total_steps, writer.episode, collisions
+
+
+def main(args):
+
+    #             #
+    # DEMONSTRATE #
+    #             #
+
+    tracks = raceline_tracks(RACETRACKS_PATH)
+    if args.tracks:
+        tracks = [track for track in tracks if track in args.tracks]
+    print(f"Demonstrating on {len(tracks)} tracks: {', '.join(tracks)}")
+
+    # one worker process per track at a time, each with its own seed
+    start_time = time.time()
+    with ProcessPoolExecutor(max_workers=NUM_PROCESS) as executor:
+        futures = [executor.submit(demonstrate, track, args.steps, track_seed(args.seed, index), args.output)
+                   for index, track in enumerate(tracks)]
+        for future in futures:
+            track, steps, episodes, collisions = future.result()
+            print(f"{track}: {steps} steps, {episodes} episodes, {collisions} collisions")
+    print(f"Demonstrations took {time.time() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    # parse runtime arguments to script
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n",
+                        "--steps",
+                        help="number of steps per track",
+                        type=int,
+                        default=pow(10, 5))
+    parser.add_argument("-o",
+                        "--output",
+                        help="directory of the datasets, one per track, appended to if they exist",
+                        default=DATASET_DIRECTORY)
+    parser.add_argument("-s",
+                        "--seed",
+                        help="random seed",
+                        type=int,
+                        default=0)
+    parser.add_argument("-t",
+                        "--tracks",
+                        help="only these tracks",
+                        nargs="*")
+    args = parser.parse_args()
+    # call main demonstration function
+    main(args)
@@ -86,7 +86,8 @@ def main(args):
                 # use trained model to predict some action, using observations
                 action, _ = model.predict(obs)
                 obs, _, done, _ = eval_env.step(action)
-                eval_env.render()
+                # drawn on a separate thread, so rendering doesn't slow the episode down
+                eval_env.render(mode='human_async')
             # this section just asks the user if they want to run more episodes
             if episode == (MIN_EVAL_EPISODES - 1):
                 choice = input("Another episode? (Y/N) ")
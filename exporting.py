@@ -0,0 +1,131 @@
+# MIT License
+
+# Copyright (c) 2021 Eoin Gogarty, Charlie Maguire and Manus McAuliffe (Formula Trintiy Autonomous)
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Exports rollouts of a trained model to a dataset for offline RL and behaviour cloning (see code/rollouts.py)
+"""
+
+import gym
+import argparse
+import numpy as np
+
+from stable_baselines3.common.vec_env import SubprocVecEnv
+from stable_baselines3.common.env_util import make_vec_env
+
+from code.wrappers import F110_Wrapped, RandomMap
+from code.vec_wrappers import DecodeScans
+from code.rollouts import RolloutWriter
+from evaluating import load_model
+
+
+TRAIN_DIRECTORY = "./train"
+DATASET_DIRECTORY = "./rollouts"
+NUM_PROCESS = 4
+MAP_PATH = "./f1tenth_gym/examples/example_map"
+MAP_EXTENSION = ".png"
+MAP_CHANGE_INTERVAL = 3000
+SCAN_ENCODING = "mm"  # scans are stored as uint16 millimetres, half the size of the normalised floats
+INFO_KEYS = ("progress", "arc_length", "lateral_offset", "heading_error")  # track progress of each step
+
+
+def main(args):
+
+    #        #
+    # EXPORT #
+    #        #
+
+    # prepare the environment
+    def wrap_env():
+        # starts F110 gym
+        env = gym.make("f110_gym:f110-v0",
+                       map=MAP_PATH,
+                       map_ext=MAP_EXTENSION,
+                       num_agents=1)
+        # wrap basic gym with RL functions, scans stay encoded
+        env = F110_Wrapped(env, scan_encoding=SCAN_ENCODING)
+        env = RandomMap(env, MAP_CHANGE_INTERVAL)
+        return env
+
+    # vectorise environment (parallelise)
+    envs = make_vec_env(wrap_env,
+                        n_envs=NUM_PROCESS,
+                        seed=np.random.randint(pow(2, 32) - 1),
+                        vec_env_cls=SubprocVecEnv)
+    # the dataset keeps the encoded scans, the model is given them decoded
+    decoder = DecodeScans(envs)
+
+    # load model
+    model, _ = load_model(args.load,
+                          TRAIN_DIRECTORY,
+                          decoder,
+                          evaluating=True)
+
+    # how to decode the observations, saved with the dataset
+    lidar_scale, lidar_offset = envs.get_attr("lidar_scale", [0])[0], envs.get_attr("lidar_offset", [0])[0]
+    metadata = {"scan_codec": envs.get_attr("scan_codec", [0])[0].config(),
+                "log_range": envs.get_attr("log_range", [0])[0],
+                "lidar_scale": float(lidar_scale),
+                "lidar_offset": float(lidar_offset),
+                "model": args.load}
+    writer = RolloutWriter(args.output,
+                           num_envs=NUM_PROCESS,
+                           info_keys=INFO_KEYS,
+                           metadata=metadata)
+
+    # stream transitions to the dataset, ctrl-c to stop early
+    obs = envs.reset()
+    try:
+        for step in range(args.steps // NUM_PROCESS):
+            actions, _ = model.predict(decoder.decode(obs))
+            next_obs, rewards, dones, infos = envs.step(actions)
+            writer.add(obs, next_obs, actions, rewards, dones, infos)
+            obs = next_obs
+            if step % 10000 == 0:
+                print(f"Exported {step * NUM_PROCESS} steps, {writer.episode} episodes")
+    except KeyboardInterrupt:
+        pass
+    # episodes still running are saved as truncated
+    writer.close()
+    envs.close()
+    print(f"Exported {writer.total_steps} steps to {args.output}")
+
+
+if __name__ == "__main__":
+    # parse runtime arguments to script
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l",
+                        "--load",
+                        help="load previous model",
+                        nargs="?",
+                        const="latest")
+    parser.add_argument("-n",
+                        "--steps",
+                        help="number of steps to export",
+                        type=int,
+                        default=pow(10, 6))
+    parser.add_argument("-o",
+                        "--output",
+                        help="directory of the dataset, appended to if it exists",
+                        default=DATASET_DIRECTORY)
+    args = parser.parse_args()
+    # call main export function
+    main(args)
@@ -2,4 +2,8 @@ from f110_gym.envs.f110_env import F110Env
 from f110_gym.envs.dynamic_models import *
 from f110_gym.envs.laser_models import *
 from f110_gym.envs.base_classes import *
-from f110_gym.envs.collision_models import *
\ No newline at end of file
+from f110_gym.envs.collision_models import *
+from f110_gym.envs.track_progress import *
+from f110_gym.envs.occupancy import *
+from f110_gym.envs.recording import *
+from f110_gym.envs.scan_codec import *
\ No newline at end of file
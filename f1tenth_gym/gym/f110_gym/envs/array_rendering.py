@@ -0,0 +1,330 @@
+# MIT License
+
+# Copyright (c) 2020 Joseph Auckley, Matthew O'Kelly, Aman Sinha, Hongrui Zheng
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+
+"""
+Software rendering of the env into numpy images, no display server or OpenGL needed
+"""
+
+import cv2
+import numpy as np
+from PIL import Image
+import yaml
+
+from f110_gym.envs.collision_models import get_vertices
+
+import unittest
+import tempfile
+import shutil
+import os
+
+# vehicle shape constants, not imported from rendering.py since importing pyglet.gl needs a display
+CAR_LENGTH = 0.58
+CAR_WIDTH = 0.31
+
+# same palette as the pyglet renderer, RGB
+BACKGROUND_COLOR = (9, 32, 87)
+MAP_COLOR = (183, 193, 222)
+EGO_COLOR = (172, 97, 185)
+AGENT_COLOR = (99, 52, 94)
+RAY_COLOR = (40, 80, 150)
+HIT_COLOR = (255, 255, 255)
+
+# fixed point bits used for sub-pixel polygon and line vertices
+SHIFT = 4
+
+# cars shorter than this many pixels are drawn as dots of this radius instead
+MIN_CAR_PIXELS = 4
+
+
+class ArrayRenderer(object):
+    """
+    Rasterises the map, the cars and optionally the ego's scan into (height, width, 3) uint8 RGB images.
+
+    The walls are only rasterised when the map changes: into a cached background of the whole map, or,
+    when following the ego, into a coverage image at map resolution that is resampled into every frame
+    """
+
+    def __init__(self, width, height, view_width=None, draw_scan=False, fov=4.7):
+        """
+        Class constructor
+
+        Args:
+            width (int): width of the image
+            height (int): height of the image
+            view_width (float, default=None): width of the view in meters, centered on the ego. If None, the whole map is shown
+            draw_scan (bool, default=False): draw the ego's scan rays and their hits
+            fov (float, default=4.7): field of view of the laser
+
+        Returns:
+            None
+        """
+        self.width = width
+        self.height = height
+        self.view_width = view_width
+        self.draw_scan = draw_scan
+        self.fov = fov
+
+        # color lookup from wall coverage (0-255) to RGB
+        alpha = np.linspace(0., 1., 256)[:, None]
+        self.palette = np.round((1. - alpha) * BACKGROUND_COLOR + alpha * MAP_COLOR).astype(np.uint8)
+
+        # wall coverage at map resolution, rows flipped so that row 0 is the top of the map
+        self.coverage = None
+        # (2, 3) affine transforms from world coordinates to map pixels and from map pixels to the image
+        self.world_to_map = None
+        self.map_to_image = None
+        # cached image of the whole map, only used when view_width is None
+        self.background = None
+        self.map_resolution = None
+
+        # beam angles of the last scan size seen
+        self.scan_angles = np.zeros((0, ))
+
+    def update_map(self, map_path, map_ext):
+        """
+        Update the map being drawn by the renderer
+
+        Args:
+            map_path (str): absolute path to the map without extensions
+            map_ext (str): extension for the map image file
+
+        Returns:
+            None
+        """
+        with open(map_path + '.yaml', 'r') as yaml_stream:
+            try:
+                map_metadata = yaml.safe_load(yaml_stream)
+                map_resolution = map_metadata['resolution']
+                origin = map_metadata['origin']
+            except yaml.YAMLError as ex:
+                print(ex)
+
+        map_img = np.array(Image.open(map_path + map_ext).transpose(Image.FLIP_TOP_BOTTOM)).astype(np.float64)
+        self.update_map_array(map_img, map_resolution, origin)
+
+    def update_map_array(self, map_img, map_resolution, origin):
+        """
+        Update the map being drawn by the renderer from an image in memory, and rasterise its walls
+
+        Args:
+            map_img (np.ndarray (n, m)): map image, 0 is obstacle, row 0 is the bottom of the map
+            map_resolution (float): resolution of the map (m/pixel)
+            origin (list [x, y, theta]): pose of the bottom left pixel of the map
+
+        Returns:
+            None
+        """
+        map_height, map_width = map_img.shape[:2]
+        self.map_resolution = map_resolution
+        self.coverage = np.ascontiguousarray(np.flipud(np.asarray(map_img) == 0.0), dtype=np.uint8) * 255
+
+        # world -> map pixel, undoing the origin's rotation and flipping the rows
+        theta = origin[2] if len(origin) > 2 else 0.
+        c, s = np.cos(theta) / map_resolution, np.sin(theta) / map_resolution
+        self.world_to_map = np.array([[c, s, -c * origin[0] - s * origin[1]],
+                                      [s, -c, map_height - s * origin[0] + c * origin[1]]])
+
+        if self.view_width is None:
+            # fit the whole map in the image, any wall in a downsampled pixel lights it up
+            scale = min(self.width / map_width, self.height / map_height)
+            scaled_width = max(1, int(round(map_width * scale)))
+            scaled_height = max(1, int(round(map_height * scale)))
+            scaled = cv2.resize(self.coverage, (scaled_width, scaled_height), interpolation=cv2.INTER_AREA)
+            if scale < 1.:
+                scaled[scaled > 0] = 255
+            coverage = np.zeros((self.height, self.width), dtype=np.uint8)
+            top = (self.height - scaled_height) // 2
+            left = (self.width - scaled_width) // 2
+            coverage[top:top + scaled_height, left:left + scaled_width] = scaled
+            self.background = self.palette[coverage]
+            self.map_to_image = np.array([[scaled_width / map_width, 0., left],
+                                          [0., scaled_height / map_height, top]])
+        else:
+            self.background = None
+
+    def _world_to_image(self, points):
+        """
+        Transform (n, 2) world coordinates into fixed point image coordinates
+        """
+        transform = self.map_to_image[:, :2] @ self.world_to_map
+        transform[:, 2] += self.map_to_image[:, 2]
+        pixels = points @ transform[:, :2].T + transform[:, 2]
+        return np.round(pixels * (1 << SHIFT)).astype(np.int32)
+
+    def render(self, obs):
+        """
+        Draw the latest observation
+
+        Args:
+            obs (dict): observation dict from the gym env
+
+        Returns:
+            frame (np.ndarray (height, width, 3)): RGB image, a new array every call
+        """
+        if self.coverage is None:
+            raise Exception('Map not set for renderer.')
+
+        ego_idx = obs['ego_idx']
+        poses = np.stack((obs['poses_x'], obs['poses_y'], obs['poses_theta']), axis=1)
+
+        if self.view_width is None:
+            frame = self.background.copy()
+        else:
+            # resample the walls around the ego
+            scale = self.width * self.map_resolution / self.view_width
+            center = self.world_to_map[:, :2] @ poses[ego_idx, :2] + self.world_to_map[:, 2]
+            self.map_to_image = np.array([[scale, 0., self.width / 2 - scale * center[0]],
+                                          [0., scale, self.height / 2 - scale * center[1]]])
+            coverage = cv2.warpAffine(self.coverage, self.map_to_image, (self.width, self.height),
+                                      flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+            frame = self.palette[coverage]
+
+        if self.draw_scan and 'scans' in obs:
+            scan = np.asarray(obs['scans'][ego_idx])
+            if self.scan_angles.shape[0] != scan.shape[0]:
+                self.scan_angles = np.linspace(-self.fov / 2., self.fov / 2., scan.shape[0])
+            angles = poses[ego_idx, 2] + self.scan_angles
+            hits = np.empty((scan.shape[0], 2))
+            hits[:, 0] = poses[ego_idx, 0] + scan * np.cos(angles)
+            hits[:, 1] = poses[ego_idx, 1] + scan * np.sin(angles)
+            hits = self._world_to_image(hits)
+            car = self._world_to_image(poses[ego_idx:ego_idx + 1, :2])
+            rays = np.empty((scan.shape[0], 2, 2), dtype=np.int32)
+            rays[:, 0] = car
+            rays[:, 1] = hits
+            cv2.polylines(frame, rays, False, RAY_COLOR, 1, cv2.LINE_8, SHIFT)
+            # hits as single pixels, dropping the ones outside the image
+            hits = hits >> SHIFT
+            inside = (hits[:, 0] >= 0) & (hits[:, 0] < self.width) & (hits[:, 1] >= 0) & (hits[:, 1] < self.height)
+            frame[hits[inside, 1], hits[inside, 0]] = HIT_COLOR
+
+        # ego drawn last so it stays on top
+        order = [i for i in range(poses.shape[0]) if i != ego_idx] + [ego_idx]
+        car_pixels = CAR_LENGTH * self.map_to_image[0, 0] / self.map_resolution
+        for i in order:
+            color = EGO_COLOR if i == ego_idx else AGENT_COLOR
+            if car_pixels < MIN_CAR_PIXELS:
+                center = self._world_to_image(poses[i:i + 1, :2])[0]
+                cv2.circle(frame, (int(center[0]), int(center[1])), MIN_CAR_PIXELS << (SHIFT - 1), color, -1, cv2.LINE_AA, SHIFT)
+            else:
+                vertices = self._world_to_image(get_vertices(poses[i], CAR_LENGTH, CAR_WIDTH))
+                cv2.fillPoly(frame, [vertices], color, cv2.LINE_AA, SHIFT)
+
+        if 'lap_times' in obs:
+            text = 'Lap Time: {laptime:.2f}, Ego Lap Count: {count:.0f}'.format(laptime=obs['lap_times'][0], count=obs['lap_counts'][ego_idx])
+            cv2.putText(frame, text, (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+
+        return frame
+
+
+"""
+Unit tests for the array renderer
+"""
+
+class ArrayRendererTests(unittest.TestCase):
+    def setUp(self):
+        # 10 x 5 m free map at 0.05 m/pixel, walled in, origin rotated to check the transforms
+        self.map_img = np.full((100, 200), 255.)
+        self.map_img[[0, -1], :] = 0.
+        self.map_img[:, [0, -1]] = 0.
+        self.origin = [-2., -1., 0.]
+        self.obs = {'ego_idx': 0,
+                    'poses_x': np.array([3., 1.]),
+                    'poses_y': np.array([1.5, 1.5]),
+                    'poses_theta': np.array([0., np.pi / 2]),
+                    'scans': np.full((2, 1080), 2.),
+                    'lap_times': np.zeros(2),
+                    'lap_counts': np.zeros(2)}
+
+    def test_whole_map(self):
+        renderer = ArrayRenderer(400, 300)
+        renderer.update_map_array(self.map_img, 0.05, self.origin)
+        frame = renderer.render(self.obs)
+        self.assertEqual(frame.shape, (300, 400, 3))
+        self.assertEqual(frame.dtype, np.uint8)
+        # map is scaled by 2 and centered vertically, walls along its border
+        self.assertTrue(np.all(frame[50, 10] == MAP_COLOR))
+        self.assertTrue(np.all(frame[249, 10] == MAP_COLOR))
+        self.assertTrue(np.all(frame[25, 10] == BACKGROUND_COLOR))
+        # ego at (5 m, 2.5 m) from the origin, in the middle of the map
+        self.assertTrue(np.all(frame[150, 200] == EGO_COLOR))
+        self.assertTrue(np.all(frame[150, 120] == AGENT_COLOR))
+        # top of the image is +y
+        obs = dict(self.obs, poses_y=np.array([3., 1.5]))
+        self.assertTrue(np.all(renderer.render(obs)[150 - 60, 200] == EGO_COLOR))
+
+    def test_rotated_origin(self):
+        # the same map rotated by 90 degrees about the origin shows up rotated in the image
+        renderer = ArrayRenderer(400, 300)
+        renderer.update_map_array(self.map_img, 0.05, self.origin)
+        obs = dict(self.obs, poses_x=np.array([3.]), poses_y=np.array([1.5]), poses_theta=np.array([0.]))
+        rotated = ArrayRenderer(400, 300)
+        rotated.update_map_array(self.map_img, 0.05, [-2., -1., np.pi / 2])
+        obs_rotated = dict(obs, poses_x=np.array([-2. - 2.5]), poses_y=np.array([-1. + 5.]), poses_theta=np.array([np.pi / 2]))
+        self.assertTrue(np.array_equal(renderer.render(obs)[:, :, 0] == EGO_COLOR[0],
+                                       rotated.render(obs_rotated)[:, :, 0] == EGO_COLOR[0]))
+
+    def test_small_cars(self):
+        # cars a few pixels long are still visible
+        renderer = ArrayRenderer(80, 60)
+        renderer.update_map_array(self.map_img, 0.05, self.origin)
+        frame = renderer.render(self.obs)
+        self.assertTrue(np.all(frame[30, 40] == EGO_COLOR))
+        self.assertTrue(np.all(frame[30, 24] == AGENT_COLOR))
+
+    def test_follow_and_scan(self):
+        renderer = ArrayRenderer(200, 200, view_width=5., draw_scan=True)
+        renderer.update_map_array(self.map_img, 0.05, self.origin)
+        frame = renderer.render(self.obs)
+        # ego in the middle, 40 pixels per meter
+        self.assertTrue(np.all(frame[100, 100] == EGO_COLOR))
+        # beam straight ahead hits 2 m in front of the ego, and the right wall is 2 m ahead too
+        self.assertTrue(np.all(frame[100, 180] == HIT_COLOR))
+        self.assertTrue(np.all(frame[100, 190] == BACKGROUND_COLOR))
+
+    def test_env_renders_updated_map(self):
+        # the first frame after update_map shows the new map, not the one the env was made with
+        from f110_gym.envs.f110_env import F110Env
+        directory = tempfile.mkdtemp()
+        try:
+            maps = []
+            for name, img in (('box', self.map_img), ('split', np.where(np.arange(200) == 100, 0., self.map_img))):
+                Image.fromarray(np.flipud(img).astype(np.uint8)).save(os.path.join(directory, name + '.png'))
+                with open(os.path.join(directory, name + '.yaml'), 'w') as f:
+                    f.write('resolution: 0.05\norigin: [-2., -1., 0.]\n')
+                maps.append(os.path.join(directory, name))
+            env = F110Env(map=maps[0], map_ext='.png', num_agents=1)
+            env.update_map(maps[1] + '.yaml', '.png')
+            env.reset(np.array([[3., 1.5, 0.]]))
+            frame = env.render('rgb_array')
+            split = F110Env(map=maps[1], map_ext='.png', num_agents=1)
+            split.reset(np.array([[3., 1.5, 0.]]))
+            self.assertTrue(np.array_equal(frame, split.render('rgb_array')))
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,7 +32,7 @@ import numpy as np
 from numba import njit
 
 from f110_gym.envs.dynamic_models import vehicle_dynamics_st, pid
-from f110_gym.envs.laser_models import ScanSimulator2D, check_ttc_jit, ray_cast
+from f110_gym.envs.laser_models import ScanSimulator2D, check_ttc_jit, check_ttc_bound_jit, ray_cast
 from f110_gym.envs.collision_models import get_vertices, collision_multiple
 
 class RaceCar(object):
@@ -103,6 +103,12 @@ class RaceCar(object):
         # current scan
         self.current_scan = np.zeros((num_beams, ))
 
+        # when set, scans that can't trigger the iTTC check aren't traced and are left as nan,
+        # their noise is still drawn so the rng stays in step with a full simulation
+        self.skip_safe_scans = False
+        self.scan_noise = None
+        self.skipped_scan = np.full((num_beams, ), np.nan)
+
         # angles of each scan beam, distance from lidar to edge of car at each beam, and precomputed cosines of each angle
         self.cosines = np.zeros((num_beams, ))
         self.scan_angles = np.zeros((num_beams, ))
@@ -162,6 +168,18 @@ class RaceCar(object):
         """
         self.scan_simulator.set_map(map_path, map_ext)
 
+    def set_map_array(self, map_img, map_resolution, origin, dt=None):
+        """
+        Sets the map for scan simulator from an image in memory
+
+        Args:
+            map_img (np.ndarray (n, m)): grayscale map image, row 0 is the bottom of the map
+            map_resolution (float): resolution of the map (m/cell)
+            origin (list [x, y, theta]): pose of the bottom left cell of the map
+            dt (np.ndarray (n, m), default=None): precomputed distance transform of the map
+        """
+        self.scan_simulator.set_map_array(map_img, map_resolution, origin, dt)
+
     def reset(self, pose):
         """
         Resets the vehicle to a pose
@@ -293,7 +311,11 @@ class RaceCar(object):
             self.state[4] = self.state[4] + 2*np.pi
 
         # update scan
-        self.current_scan = self.scan_simulator.scan(np.append(self.state[0:2], self.state[4]))
+        if self.skip_safe_scans:
+            # ranges are only traced in update_scan if they're needed
+            self.scan_noise = self.scan_simulator.scan_noise()
+        else:
+            self.current_scan = self.scan_simulator.scan(np.append(self.state[0:2], self.state[4]))
 
     def update_opp_poses(self, opp_poses):
         """
@@ -308,6 +330,25 @@ class RaceCar(object):
         self.opp_poses = opp_poses
 
 
+    def scan_is_safe(self, pose):
+        """
+        Checks whether the scan at a pose, with the noise already drawn, can't trigger the iTTC check.
+        Other agents can only shorten a beam down to the distance to their bounding circle
+
+        Args:
+            pose (np.ndarray (3, )): pose of the scan frame
+
+        Returns:
+            safe (bool): whether check_ttc would return False
+        """
+        bound = self.scan_simulator.range_lower_bound(pose)
+        if self.opp_poses is not None and self.opp_poses.shape[0] > 0:
+            half_diagonal = np.hypot(self.params['length'], self.params['width']) / 2.
+            opp_dists = np.hypot(self.opp_poses[:, 0] - pose[0], self.opp_poses[:, 1] - pose[1])
+            bound = min(bound, np.min(opp_dists) - half_diagonal)
+        # small margin for the rounding of the traced ranges
+        return check_ttc_bound_jit(bound - 1e-6, self.scan_noise, self.state[3], self.cosines, self.side_distances, self.ttc_thresh)
+
     def update_scan(self):
         """
         Steps the vehicle's laser scan simulation
@@ -319,7 +360,16 @@ class RaceCar(object):
         Returns:
             None
         """
-        
+
+        if self.skip_safe_scans:
+            pose = np.append(self.state[0:2], self.state[4])
+            if self.scan_is_safe(pose):
+                # same result as check_ttc without tracing the scan
+                self.in_collision = False
+                self.current_scan = self.skipped_scan
+                return
+            self.current_scan = self.scan_simulator.scan_ranges(pose) + self.scan_noise
+
         # check ttc
         self.check_ttc()
 
@@ -377,7 +427,8 @@ class Simulator(object):
 
     def set_map(self, map_path, map_ext):
         """
-        Sets the map of the environment and sets the map for scan simulator of each agent
+        Sets the map of the environment and sets the map for scan simulator of each agent.
+        The map is only loaded and transformed once, the other agents share the same arrays.
 
         Args:
             map_path (str): path to the map yaml file
@@ -386,8 +437,95 @@ class Simulator(object):
         Returns:
             None
         """
-        for agent in self.agents:
-            agent.set_map(map_path, map_ext)
+        self.agents[0].set_map(map_path, map_ext)
+        scan_sim = self.agents[0].scan_simulator
+        for agent in self.agents[1:]:
+            agent.set_map_array(scan_sim.map_img, scan_sim.map_resolution, scan_sim.origin, scan_sim.dt)
+        self._share_dt()
+
+    def set_map_array(self, map_img, map_resolution, origin, dt=None):
+        """
+        Sets the map of the environment from an image in memory, the distance transform is computed once and shared by all agents
+
+        Args:
+            map_img (np.ndarray (n, m)): grayscale map image, row 0 is the bottom of the map
+            map_resolution (float): resolution of the map (m/cell)
+            origin (list [x, y, theta]): pose of the bottom left cell of the map
+            dt (np.ndarray (n, m), default=None): precomputed distance transform of the map
+
+        Returns:
+            None
+        """
+        self.agents[0].set_map_array(map_img, map_resolution, origin, dt)
+        scan_sim = self.agents[0].scan_simulator
+        for agent in self.agents[1:]:
+            agent.set_map_array(scan_sim.map_img, map_resolution, origin, scan_sim.dt)
+        self._share_dt()
+
+    def add_obstacle(self, x, y, theta=0., length=0., width=0., radius=0.):
+        """
+        Adds a rectangular or circular obstacle to the map, the updated distance transform is shared by all agents
+
+        Args:
+            x, y, theta (float): pose of the centre of the obstacle
+            length, width (float, default=0): size of the rectangle (m)
+            radius (float, default=0): radius of the circle, or of the rounded corners (m)
+
+        Returns:
+            obstacle_id (int): id of the obstacle, to remove it
+        """
+        obstacle_id = self.agents[0].scan_simulator.add_obstacle(x, y, theta, length, width, radius)
+        self._share_dt()
+        return obstacle_id
+
+    def remove_obstacle(self, obstacle_id):
+        """
+        Removes an obstacle from the map
+
+        Args:
+            obstacle_id (int): id returned by add_obstacle
+
+        Returns:
+            None
+        """
+        self.agents[0].scan_simulator.remove_obstacle(obstacle_id)
+        self._share_dt()
+
+    def clear_obstacles(self):
+        """
+        Removes all obstacles from the map
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self.agents[0].scan_simulator.clear_obstacles()
+        self._share_dt()
+
+    def set_scan_pyramid(self, factor=8, refine_dist=None):
+        """
+        Makes the scan simulators of all agents ray march on a coarse/fine distance transform pyramid
+
+        Args:
+            factor (int, default=8): number of fine cells along each side of a coarse cell, None disables the pyramid
+            refine_dist (float, default=None): coarse distance under which the fine distance transform is used
+
+        Returns:
+            None
+        """
+        self.agents[0].scan_simulator.set_pyramid(factor, refine_dist)
+        self._share_dt()
+
+    def _share_dt(self):
+        # other agents scan the distance transform (and pyramid) of the first agent
+        scan_sim = self.agents[0].scan_simulator
+        for agent in self.agents[1:]:
+            agent.scan_simulator.dt = scan_sim.dt
+            agent.scan_simulator.pyramid_factor = scan_sim.pyramid_factor
+            agent.scan_simulator.refine_dist = scan_sim.refine_dist
+            agent.scan_simulator.coarse_dt = scan_sim.coarse_dt
 
 
     def update_params(self, params, agent_idx=-1):
@@ -412,6 +550,20 @@ class Simulator(object):
             # index out of bounds, throw error
             raise IndexError('Index given is out of bounds for list of agents.')
 
+    def set_skip_safe_scans(self, skip):
+        """
+        Sets whether the agents skip tracing scans that can't cause a collision, their scans are left as nan.
+        Only changes the observed scans, the simulation and the scan noise rng stay the same.
+
+        Args:
+            skip (bool): whether to skip safe scans
+
+        Returns:
+            None
+        """
+        for agent in self.agents:
+            agent.skip_safe_scans = skip
+
     def check_collision(self):
         """
         Checks for collision between agents using GJK and agents' body vertices
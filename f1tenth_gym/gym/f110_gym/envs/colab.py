@@ -29,8 +29,55 @@ Author: Eoin Gogarty
 import os
 import yaml
 import cv2
+import base64
 import IPython
 import numpy as np
+import unittest
+
+# fixed point scales of the streamed poses, 1/100 pixel and 1/10000 radian
+POSITION_SCALE = 100
+ANGLE_SCALE = 10000
+
+
+def encode_poses(poses):
+    """
+    Packs a batch of poses into base64 for streaming to the browser. Poses are quantised to fixed point,
+    the first frame is sent as int32 and every other frame as the delta from the previous one, in int16 when
+    they fit (int32 otherwise). Deltas are taken between quantised poses, so decoding doesn't drift.
+
+    Args:
+        poses (np.ndarray (frames, num_agents, 3)): poses in pixels and radians, see Colab.adjust_car_poses
+
+    Returns:
+        data (str): base64 of the little endian packed poses
+        delta_bytes (int): size of each delta, 2 or 4
+    """
+    fixed = np.round(poses * np.array([POSITION_SCALE, POSITION_SCALE, ANGLE_SCALE])).astype(np.int32)
+    deltas = np.diff(fixed, axis=0)
+    delta_bytes = 2 if deltas.size == 0 or np.abs(deltas).max() < 2**15 else 4
+    packed = fixed[0].astype('<i4').tobytes() + deltas.astype('<i%d' % delta_bytes).tobytes()
+    return base64.b64encode(packed).decode('ascii'), delta_bytes
+
+
+def decode_poses(data, delta_bytes, num_frames, num_agents):
+    """
+    Inverse of encode_poses, same as the decoder in colab.html
+
+    Args:
+        data (str): base64 of the packed poses
+        delta_bytes (int): size of each delta, 2 or 4
+        num_frames (int): number of frames in the batch
+        num_agents (int): number of agents in each frame
+
+    Returns:
+        poses (np.ndarray (frames, num_agents, 3)): poses in pixels and radians
+    """
+    packed = base64.b64decode(data)
+    first = np.frombuffer(packed, dtype='<i4', count=3 * num_agents).reshape(1, num_agents, 3)
+    deltas = np.frombuffer(packed, dtype='<i%d' % delta_bytes, offset=12 * num_agents).reshape(num_frames - 1, num_agents, 3)
+    fixed = np.cumsum(np.concatenate((first, deltas)), axis=0)
+    return fixed / np.array([POSITION_SCALE, POSITION_SCALE, ANGLE_SCALE])
+
 
 class Colab(object):
 
@@ -69,6 +116,8 @@ class Colab(object):
         html_code = html_code.replace("{","{{")
         html_code = html_code.replace("}","}}")
         html_code = html_code.replace('insert_channel_here', self.channel_id)
+        html_code = html_code.replace('"insert_position_scale_here"', str(POSITION_SCALE))
+        html_code = html_code.replace('"insert_angle_scale_here"', str(ANGLE_SCALE))
         html_code = html_code.replace('"insert_cars_here"', ''.join([f'<div class="car" id="car-{i}"></div>' for i in range(num_agents)]))
         html_code = html_code.replace('"insert_binary_image_here"',"{map_image_binary}")
         html_code = html_code.format(map_image_binary=map_image_binary)
@@ -87,9 +136,11 @@ class Colab(object):
         html_code = html_code.replace('"insert_car_length_here"', str(self.car_length))
         # reset starting poses
         self.start_poses = start_poses
-        html_code = html_code.replace('"insert_start_poses_here"', str(self.adjust_car_poses(*self.start_poses)))
-        # batch poses together
-        self.batch_poses = []
+        html_code = html_code.replace('"insert_start_poses_here"', str(self.adjust_car_poses(*self.start_poses).tolist()))
+        # batch poses together, (frames, num_agents, 3), with room for the repeated frame of 'human' mode
+        self.batch_poses = np.zeros((self.MIN_BATCH + 1, len(self.start_poses[0]), 3))
+        self.batch_size = 0
+        self.batch_start = 0
         self.frame_counter = 0
         # append extra ID to channel ID
         self.channel_id_extra += 1
@@ -98,22 +149,31 @@ class Colab(object):
         display(IPython.display.HTML(html_code))
 
     def update_cars(self, p_x, p_y, p_t, done, mode):
-        self.batch_poses.append([self.frame_counter, self.adjust_car_poses(p_x, p_y, p_t)])
+        self.batch_poses[self.batch_size] = self.adjust_car_poses(p_x, p_y, p_t)
+        self.batch_size += 1
         self.frame_counter += 1
         # repeat frame to slow down simulation to realtime
         if mode == "human":
-          self.batch_poses.append([self.frame_counter, self.adjust_car_poses(p_x, p_y, p_t)])
+          self.batch_poses[self.batch_size] = self.batch_poses[self.batch_size - 1]
+          self.batch_size += 1
           self.frame_counter += 1
-        if (len(self.batch_poses) >= self.MIN_BATCH) or done:
+        if (self.batch_size >= self.MIN_BATCH) or done:
+            # poses are sent packed, see encode_poses
+            data, delta_bytes = encode_poses(self.batch_poses[:self.batch_size])
             js_code = '''
             console.log("Sending poses on {channel_id} [{frames}]");
             const senderChannel = new BroadcastChannel("{channel_id}");
-            senderChannel.postMessage({poses});
-            '''.format(poses=self.batch_poses,
+            senderChannel.postMessage({{first: {first}, frames: {num_frames}, agents: {num_agents}, bytes: {delta_bytes}, data: "{data}"}});
+            '''.format(first=self.batch_start,
+                       num_frames=self.batch_size,
+                       num_agents=self.batch_poses.shape[1],
+                       delta_bytes=delta_bytes,
+                       data=data,
                        frames=self.frame_counter,
                        channel_id=(self.channel_id + '-' + str(self.channel_id_extra)))
             display(IPython.display.Javascript(js_code))
-            self.batch_poses = []
+            self.batch_start = self.frame_counter
+            self.batch_size = 0
 
     def load_map(self):
         # load map config
@@ -131,10 +191,47 @@ class Colab(object):
         self.crop_offset = np.argmax(crop_vertical), np.argmax(crop_horizontal)
 
     def adjust_car_poses(self, poses_x, poses_y, poses_theta):
-        poses = [[x, y] for x, y in zip(poses_x, poses_y)] # organise by car
-        poses_offset = np.array(poses) - self.map_origin[:2]
+        poses = np.stack((poses_x, poses_y), axis=1) # organise by car
+        poses_offset = poses - self.map_origin[:2]
         poses_scaled = poses_offset / self.map_resolution
         poses_cropped = poses_scaled - self.crop_offset
         # check for theta overflow and have to negate angle (not sure why)
-        poses_theta = [- t % np.pi for t in poses_theta]
-        return [[x, y, t] for (x, y), t in zip(poses_cropped, poses_theta)]
\ No newline at end of file
+        poses_theta = np.mod(-np.asarray(poses_theta), np.pi)
+        return np.column_stack((poses_cropped, poses_theta))
+
+
+"""
+Unit tests for the pose streaming
+"""
+
+class PoseStreamTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(12345)
+        # 3 cars driving around, angles wrapping like adjust_car_poses
+        steps = rng.normal(scale=[0.5, 0.5, 0.05], size=(200, 3, 3))
+        self.poses = np.cumsum(steps, axis=0) + [400., 300., 0.]
+        self.poses[:, :, 2] = np.mod(self.poses[:, :, 2], np.pi)
+
+    def test_round_trip(self):
+        data, delta_bytes = encode_poses(self.poses)
+        self.assertEqual(delta_bytes, 2)
+        decoded = decode_poses(data, delta_bytes, 200, 3)
+        # within the fixed point resolution, without drift along the batch
+        self.assertTrue(np.all(np.abs(decoded[:, :, :2] - self.poses[:, :, :2]) <= 0.5 / POSITION_SCALE))
+        self.assertTrue(np.all(np.abs(decoded[:, :, 2] - self.poses[:, :, 2]) <= 0.5 / ANGLE_SCALE))
+
+    def test_large_deltas(self):
+        # a car teleported by a reset doesn't fit int16 deltas
+        self.poses[100:, 0, :2] += 5000.
+        data, delta_bytes = encode_poses(self.poses)
+        self.assertEqual(delta_bytes, 4)
+        decoded = decode_poses(data, delta_bytes, 200, 3)
+        self.assertTrue(np.allclose(decoded, self.poses, atol=1e-2))
+
+    def test_single_frame(self):
+        data, delta_bytes = encode_poses(self.poses[:1])
+        self.assertTrue(np.allclose(decode_poses(data, delta_bytes, 1, 3), self.poses[:1], atol=1e-2))
+
+
+if __name__ == '__main__':
+    unittest.main()
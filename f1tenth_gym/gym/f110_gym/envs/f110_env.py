@@ -31,6 +31,7 @@ from gym.utils import seeding
 
 # base classes
 from f110_gym.envs.base_classes import Simulator
+from f110_gym.envs.track_progress import TrackProgress
 
 # others
 import numpy as np
@@ -96,8 +97,10 @@ class F110Env(gym.Env, utils.EzPickle):
             timestep (float, default=0.01): physics timestep
 
             ego_idx (int, default=0): ego's index in list of agents
+
+            centerline (str or np.ndarray (n, m>=2), default=None): path to a csv file or array of the track's centerline waypoints, first two columns are x and y. If given, the progress, arc length, lateral offset and heading error of each agent along the centerline are added to the info dict.
     """
-    metadata = {'render.modes': ['human', 'human_fast']}
+    metadata = {'render.modes': ['human', 'human_fast', 'human_async', 'rgb_array']}
 
     def __init__(self, **kwargs):        
         # kwargs extraction
@@ -146,6 +149,12 @@ class F110Env(gym.Env, utils.EzPickle):
         except:
             self.ego_idx = 0
 
+        # track centerline for progress tracking
+        try:
+            centerline = kwargs['centerline']
+        except:
+            centerline = None
+
         # radius to consider done
         self.start_thresh = 0.5  # 10cm
 
@@ -181,9 +190,23 @@ class F110Env(gym.Env, utils.EzPickle):
         self.sim = Simulator(self.params, self.num_agents, self.seed)
         self.sim.set_map(self.map_path, self.map_ext)
 
+        # map set from memory (image, resolution, origin), None when the map is loaded from map_path
+        self.map_array = None
+
+        # progress along the centerline
+        self.track_progress = None
+        if centerline is not None:
+            self.update_centerline(centerline)
+
         # rendering
         self.renderer = None
+        self.array_renderer = None
         self.current_obs = None
+        # path drawn over the map by the pyglet renderers, e.g. a planner's waypoints
+        self.render_path = None
+
+        # episode recorder, see set_recorder
+        self.recorder = None
 
     def __del__(self):
         """
@@ -282,6 +305,14 @@ class F110Env(gym.Env, utils.EzPickle):
         self.done, toggle_list = self._check_done()
         info = {'checkpoint_done': toggle_list}
 
+        # progress along the centerline
+        if self.track_progress is not None:
+            self.track_progress.step(self.poses_x, self.poses_y, self.poses_theta)
+            info.update(self.track_progress.get_info())
+
+        if self.recorder is not None:
+            self.recorder.record_step(self, action, obs)
+
         return obs, reward, self.done, info
 
     def reset(self, poses):
@@ -314,6 +345,13 @@ class F110Env(gym.Env, utils.EzPickle):
         # call reset to simulator
         self.sim.reset(poses)
 
+        # find the agents on the centerline
+        if self.track_progress is not None:
+            self.track_progress.reset(poses[:, 0], poses[:, 1], poses[:, 2])
+
+        if self.recorder is not None:
+            self.recorder.start_episode(self, poses)
+
         # get no input observations
         action = np.zeros((self.num_agents, 2))
         obs, reward, self.done, info = self.step(action)
@@ -331,6 +369,88 @@ class F110Env(gym.Env, utils.EzPickle):
             None
         """
         self.sim.set_map(map_path, map_ext)
+        self.map_path = map_path
+        self.map_name = os.path.splitext(map_path)[0]
+        self.map_ext = map_ext
+        self.map_array = None
+        if self.array_renderer is not None:
+            self.array_renderer.update_map(os.path.splitext(map_path)[0], map_ext)
+
+    def update_map_array(self, map_img, map_resolution, origin, dt=None):
+        """
+        Updates the map used by simulation from an image in memory, nothing is read from disk
+
+        Args:
+            map_img (np.ndarray (n, m)): grayscale map image, 0 is obstacle and 255 is free space, row 0 is the bottom of the map
+            map_resolution (float): resolution of the map (m/pixel)
+            origin (list [x, y, theta]): pose of the bottom left pixel of the map
+            dt (np.ndarray (n, m), default=None): precomputed distance transform of the map
+
+        Returns:
+            None
+        """
+        self.sim.set_map_array(map_img, map_resolution, origin, dt)
+        self.map_array = (map_img, map_resolution, origin)
+        if self.array_renderer is not None:
+            self.array_renderer.update_map_array(map_img, map_resolution, origin)
+
+    def add_obstacle(self, x, y, theta=0., length=0., width=0., radius=0.):
+        """
+        Adds an obstacle (e.g. a box or a cone) to the current map, only updating the distance transform around it.
+        Obstacles are cleared when the map changes, and can't be added while recording
+
+        Args:
+            x, y, theta (float): pose of the centre of the obstacle
+            length, width (float, default=0): size of a rectangular obstacle (m)
+            radius (float, default=0): radius of a circular obstacle, or of the rounded corners of a rectangle (m)
+
+        Returns:
+            obstacle_id (int): id of the obstacle, to remove it
+        """
+        if self.recorder is not None:
+            raise ValueError('Cannot add obstacles while recording, the replay would leave them out.')
+        return self.sim.add_obstacle(x, y, theta, length, width, radius)
+
+    def remove_obstacle(self, obstacle_id):
+        """
+        Removes an obstacle from the current map
+
+        Args:
+            obstacle_id (int): id returned by add_obstacle
+
+        Returns:
+            None
+        """
+        self.sim.remove_obstacle(obstacle_id)
+
+    def clear_obstacles(self):
+        """
+        Removes all obstacles from the current map
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self.sim.clear_obstacles()
+
+    def update_centerline(self, centerline):
+        """
+        Updates the centerline used for tracking the agents' progress, should be called with the map
+
+        Args:
+            centerline (str or np.ndarray (n, m>=2)): path to a csv file or array of the centerline waypoints, first two columns are x and y. None disables progress tracking
+
+        Returns:
+            None
+        """
+        if centerline is None:
+            self.track_progress = None
+            return
+        if isinstance(centerline, str):
+            centerline = np.genfromtxt(centerline, delimiter=',')
+        self.track_progress = TrackProgress(centerline, self.num_agents)
 
     def update_params(self, params, index=-1):
         """
@@ -345,6 +465,30 @@ class F110Env(gym.Env, utils.EzPickle):
         """
         self.sim.update_params(params, agent_idx=index)
 
+    def set_recorder(self, recorder):
+        """
+        Attaches a recorder that logs every reset and step of the env
+
+        Args:
+            recorder (EpisodeRecorder): recorder to attach, None detaches the current one
+
+        Returns:
+            None
+        """
+        self.recorder = recorder
+
+    def update_render_path(self, path):
+        """
+        Sets the planned path drawn by the 'human' render modes
+
+        Args:
+            path (np.ndarray (n, 2+)): points of the path in world coordinates, None clears it
+
+        Returns:
+            None
+        """
+        self.render_path = path
+
     def render(self, mode='human', colab_start=False):
         """
         Renders the environment with pyglet. Use mouse scroll in the window to zoom in/out, use mouse click drag to pan. Shows the agents, the map, current fps (bottom left corner), and the race information near as text.
@@ -353,16 +497,30 @@ class F110Env(gym.Env, utils.EzPickle):
             mode (str, default='human'): rendering mode, currently supports:
                 'human': slowed down rendering such that the env is rendered in a way that sim time elapsed is close to real time elapsed
                 'human_fast': render as fast as possible
+                'human_async': render on a separate thread at up to 30 fps, the simulation isn't slowed down by rendering
+                'rgb_array': software rendering into an image, needs no display or OpenGL
 
         Returns:
-            None
+            frame (np.ndarray (VIDEO_H, VIDEO_W, 3)): RGB image for 'rgb_array', None otherwise
         """
-        assert mode in ['human', 'human_fast']
+        assert mode in ['human', 'human_fast', 'human_async', 'rgb_array']
+        # every mode draws the map currently loaded, from its path (map_name can be one of the default maps)
+        map_path = os.path.splitext(self.map_path)[0]
+        if mode == 'rgb_array':
+            if self.array_renderer is None:
+                # first call, rasterise the map
+                from f110_gym.envs.array_rendering import ArrayRenderer
+                self.array_renderer = ArrayRenderer(VIDEO_W, VIDEO_H)
+                if self.map_array is None:
+                    self.array_renderer.update_map(map_path, self.map_ext)
+                else:
+                    self.array_renderer.update_map_array(*self.map_array)
+            return self.array_renderer.render(self.current_obs)
         if IN_COLAB:
             if self.renderer is None:
                 # first call, initialize everything
                 from f110_gym.envs.colab import Colab
-                self.renderer = Colab(self.map_name, self.map_ext, self.num_agents,
+                self.renderer = Colab(map_path, self.map_ext, self.num_agents,
                                      [self.start_xs, self.start_ys, self.start_thetas],
                                      [self.params['width'], self.params['length']])
             elif colab_start:
@@ -372,13 +530,23 @@ class F110Env(gym.Env, utils.EzPickle):
             else:
                 # updating cars
                 self.renderer.update_cars(self.poses_x, self.poses_y, self.poses_theta, self.done, mode)
+        elif mode == 'human_async':
+            if self.renderer is None:
+                # first call, the render thread loads the map itself
+                from f110_gym.envs.rendering import AsyncRenderer
+                self.renderer = AsyncRenderer(WINDOW_W, WINDOW_H, map_path=map_path, map_ext=self.map_ext,
+                                              map_array=self.map_array)
+            self.renderer.update_obs(dict(self.current_obs, planned_path=self.render_path))
         else:
             if self.renderer is None:
                 # first call, initialize everything
                 from f110_gym.envs.rendering import EnvRenderer
                 self.renderer = EnvRenderer(WINDOW_W, WINDOW_H)
-                self.renderer.update_map(self.map_name, self.map_ext)
-            self.renderer.update_obs(self.current_obs)
+                if self.map_array is None:
+                    self.renderer.update_map(map_path, self.map_ext)
+                else:
+                    self.renderer.update_map_array(*self.map_array)
+            self.renderer.update_obs(dict(self.current_obs, planned_path=self.render_path))
             self.renderer.dispatch_events()
             self.renderer.on_draw()
             self.renderer.flip()
@@ -36,6 +36,8 @@ import yaml
 
 import unittest
 import timeit
+import tempfile
+import shutil
 
 def get_dt(bitmap, resolution):
     """
@@ -52,6 +54,41 @@ def get_dt(bitmap, resolution):
     dt = resolution * edt(bitmap)
     return dt
 
+@njit(cache=True)
+def obstacle_dt(dt, row_start, row_end, col_start, col_end, x, y, theta, half_length, half_width, radius, orig_x, orig_y, orig_c, orig_s, resolution):
+    """
+    Lowers the distance transform to the distance to an obstacle, within a window of cells.
+    Obstacles are rectangles with rounded corners: radius 0 is a rectangle, length and width 0 a circle
+
+        Args:
+            dt (numpy.ndarray (n, m)): distance transform to update in place
+            row_start, row_end, col_start, col_end (int): window of cells to update
+            x, y, theta (float): pose of the centre of the obstacle
+            half_length, half_width (float): half size of the rectangle (m)
+            radius (float): radius around the rectangle (m)
+            orig_x, orig_y (float): coordinates of the map origin (m)
+            orig_c, orig_s (float): cosine and sine of the map origin's rotation
+            resolution (float): resolution of the map (m/cell)
+
+        Returns:
+            None (dt updated in place)
+    """
+    c = np.cos(theta)
+    s = np.sin(theta)
+    for r in range(row_start, row_end):
+        for col in range(col_start, col_end):
+            # world coordinates of the cell centre, inverse of xy_2_rc
+            x_rot = (col + 0.5) * resolution
+            y_rot = (r + 0.5) * resolution
+            dx = orig_x + x_rot * orig_c - y_rot * orig_s - x
+            dy = orig_y + x_rot * orig_s + y_rot * orig_c - y
+            # distance outside the rectangle, in its frame
+            lx = max(abs(dx * c + dy * s) - half_length, 0.)
+            ly = max(abs(-dx * s + dy * c) - half_width, 0.)
+            dist = max(np.sqrt(lx * lx + ly * ly) - radius, 0.)
+            if dist < dt[r, col]:
+                dt[r, col] = dist
+
 @njit(cache=True)
 def xy_2_rc(x, y, orig_x, orig_y, orig_c, orig_s, height, width, resolution):
     """
@@ -202,6 +239,7 @@ def check_ttc_jit(scan, vel, scan_angles, cosines, side_distances, ttc_thresh):
         in_collision (bool): whether vehicle is in collision with environment
         collision_angle (float): at which angle the collision happened
     """
+    in_collision = False
     if vel != 0.0:
         num_beams = scan.shape[0]
         for i in range(num_beams):
@@ -210,11 +248,36 @@ def check_ttc_jit(scan, vel, scan_angles, cosines, side_distances, ttc_thresh):
             if (ttc < ttc_thresh) and (ttc >= 0.0):
                 in_collision = True
                 break
-    else:
-        in_collision = False
 
     return in_collision
 
+@njit(cache=True)
+def check_ttc_bound_jit(lower_bound, noise, vel, cosines, side_distances, ttc_thresh):
+    """
+    Checks that check_ttc_jit can't find a collision in any scan whose ranges are all at least lower_bound,
+    before noise is added. Used to skip tracing scans that nobody reads and that can't cause a collision.
+
+    Args:
+        lower_bound (float): lower bound of every range of the scan before noise
+        noise (np.ndarray(num_beams, )): noise that will be added to the scan
+        vel (float): current velocity
+        cosines (np.ndarray(num_beams, )): precomped cosines of the scan angles
+        side_distances (np.ndarray(num_beams, )): precomped distances at each beam from the laser to the sides of the car
+        ttc_thresh (float): threshold for iTTC for collision
+
+    Returns:
+        safe (bool): whether check_ttc_jit is guaranteed to return False
+    """
+    if vel == 0.0:
+        return True
+    num_beams = noise.shape[0]
+    for i in range(num_beams):
+        # ttc only increases with the range, so checking the lower bound is enough
+        margin = lower_bound + noise[i] - side_distances[i]
+        if margin <= 0.0 or margin < ttc_thresh * vel * cosines[i]:
+            return False
+    return True
+
 @njit(cache=True)
 def cross(v1, v2):
     """
@@ -310,6 +373,148 @@ def ray_cast(pose, scan, scan_angles, vertices):
 
     return scan
 
+@njit(cache=True)
+def trace_ray_pyramid(x, y, theta_index, sines, cosines, eps, orig_x, orig_y, orig_c, orig_s, height, width, resolution, dt, coarse_dt, factor, refine_dist, max_range):
+    """
+    Same as trace_ray, but reads the coarse distance transform first and while it's at least refine_dist
+    steps by it without touching the full resolution one, which is only read close to walls (or off the map).
+    Each coarse cell holds the minimum over its factor x factor fine cells, so no point of the cell is closer
+    to a wall than that: the ray can leave the coarse cell and still go that far, which takes longer steps
+    than the fine distance transform when travelling along walls
+
+        Args:
+            coarse_dt (numpy.ndarray (n/factor, m/factor)): min-pooled distance transform
+            factor (int): number of fine cells along each side of a coarse cell
+            refine_dist (float): coarse distance under which the fine distance transform is used
+
+        Returns:
+            total_distance (float): the distance to first obstacle on the current scan beam
+            iterations (int): number of steps along the ray
+            fine_reads (int): number of reads of the full resolution distance transform
+    """
+    theta_index_ = int(theta_index)
+    s = sines[theta_index_]
+    c = cosines[theta_index_]
+    # direction of the ray and size of the coarse cells in the map frame
+    c_map = c * orig_c + s * orig_s
+    s_map = -c * orig_s + s * orig_c
+    block = factor * resolution
+
+    dist_to_nearest = distance_transform(x, y, orig_x, orig_y, orig_c, orig_s, height, width, resolution, dt)
+    total_dist = dist_to_nearest
+    iterations = 0
+    fine_reads = 1
+
+    while dist_to_nearest > eps and total_dist <= max_range:
+        x += dist_to_nearest * c
+        y += dist_to_nearest * s
+        iterations += 1
+
+        r, col = xy_2_rc(x, y, orig_x, orig_y, orig_c, orig_s, height, width, resolution)
+        if r >= 0:
+            dist_to_nearest = coarse_dt[r // factor, col // factor]
+        if r < 0 or dist_to_nearest < refine_dist:
+            dist_to_nearest = dt[r, col]
+            fine_reads += 1
+        else:
+            # distance along the ray to the edge of the coarse cell
+            x_map = (x - orig_x) * orig_c + (y - orig_y) * orig_s
+            y_map = -(x - orig_x) * orig_s + (y - orig_y) * orig_c
+            exit_dist = np.inf
+            if c_map > 0:
+                exit_dist = ((col // factor + 1) * block - x_map) / c_map
+            elif c_map < 0:
+                exit_dist = ((col // factor) * block - x_map) / c_map
+            if s_map > 0:
+                exit_dist = min(exit_dist, ((r // factor + 1) * block - y_map) / s_map)
+            elif s_map < 0:
+                exit_dist = min(exit_dist, ((r // factor) * block - y_map) / s_map)
+            dist_to_nearest += max(exit_dist, 0.)
+        total_dist += dist_to_nearest
+
+    if total_dist > max_range:
+        total_dist = max_range
+
+    return total_dist, iterations, fine_reads
+
+@njit(cache=True)
+def get_scan_pyramid(pose, theta_dis, fov, num_beams, theta_index_increment, sines, cosines, eps, orig_x, orig_y, orig_c, orig_s, height, width, resolution, dt, coarse_dt, factor, refine_dist, max_range):
+    """
+    Same as get_scan, ray marching with the coarse/fine distance transform pyramid (see trace_ray_pyramid)
+
+        Args:
+            pose (numpy.ndarray(3, )): current pose of the scan frame in the map
+            coarse_dt (numpy.ndarray (n/factor, m/factor)): min-pooled distance transform
+            factor (int): number of fine cells along each side of a coarse cell
+            refine_dist (float): coarse distance under which the fine distance transform is used
+
+        Returns:
+            scan (numpy.ndarray(n, )): resulting laser scan at the pose, n=num_beams
+    """
+    scan = np.empty((num_beams,))
+
+    theta_index = theta_dis * (pose[2] - fov/2.)/(2. * np.pi)
+    theta_index = np.fmod(theta_index, theta_dis)
+    while (theta_index < 0):
+        theta_index += theta_dis
+
+    for i in range(0, num_beams):
+        scan[i] = trace_ray_pyramid(pose[0], pose[1], theta_index, sines, cosines, eps, orig_x, orig_y, orig_c, orig_s, height, width, resolution, dt, coarse_dt, factor, refine_dist, max_range)[0]
+        theta_index += theta_index_increment
+        while theta_index >= theta_dis:
+            theta_index -= theta_dis
+
+    return scan
+
+def min_pool(dt, factor):
+    """
+    Coarse level of the distance transform pyramid, each cell is the minimum of a factor x factor block
+
+        Args:
+            dt (numpy.ndarray (n, m)): distance transform
+            factor (int): size of the blocks
+
+        Returns:
+            coarse_dt (numpy.ndarray (ceil(n/factor), ceil(m/factor))): minimum of each block
+    """
+    height, width = dt.shape
+    padded = np.full((-(-height // factor) * factor, -(-width // factor) * factor), np.inf)
+    padded[:height, :width] = dt
+    return padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor).min(axis=(1, 3))
+
+def crop_map(map_img, resolution, origin, margin):
+    """
+    Crops a map to the bounding box of its obstacles plus a margin, the distance transform inside it doesn't change
+
+        Args:
+            map_img (numpy.ndarray (n, m)): grayscale map image, row 0 is the bottom of the map
+            resolution (float): resolution of the map (m/cell)
+            origin (list [x, y, theta]): pose of the bottom left cell of the map
+            margin (float): free space kept around the obstacles (m)
+
+        Returns:
+            map_img (numpy.ndarray (k, l)): cropped map image
+            origin (list [x, y, theta]): pose of the bottom left cell of the cropped map
+    """
+    occupied = np.asarray(map_img) <= 128.
+    rows = np.flatnonzero(occupied.any(axis=1))
+    cols = np.flatnonzero(occupied.any(axis=0))
+    if len(rows) == 0:
+        return map_img, origin
+    margin_cells = int(np.ceil(margin / resolution))
+    row_start = max(rows[0] - margin_cells, 0)
+    row_end = min(rows[-1] + 1 + margin_cells, map_img.shape[0])
+    col_start = max(cols[0] - margin_cells, 0)
+    col_end = min(cols[-1] + 1 + margin_cells, map_img.shape[1])
+
+    # move the origin to the new bottom left cell, in the map's rotated frame
+    dx = col_start * resolution
+    dy = row_start * resolution
+    c = np.cos(origin[2])
+    s = np.sin(origin[2])
+    new_origin = [origin[0] + dx * c - dy * s, origin[1] + dx * s + dy * c, origin[2]]
+    return np.ascontiguousarray(map_img[row_start:row_end, col_start:col_end]), new_origin
+
 class ScanSimulator2D(object):
     """
     2D LIDAR scan simulator class
@@ -342,6 +547,14 @@ class ScanSimulator2D(object):
         self.map_width = None
         self.map_resolution = None
         self.dt = None
+        # distance transform of the map without obstacles, only kept while there are obstacles
+        self.base_dt = None
+        self.obstacles = {}
+        self.next_obstacle_id = 0
+        # coarse level of the distance transform pyramid, only used once set_pyramid is called
+        self.pyramid_factor = None
+        self.refine_dist = None
+        self.coarse_dt = None
         
         # white noise generator
         self.rng = np.random.default_rng(seed=seed)
@@ -353,7 +566,8 @@ class ScanSimulator2D(object):
     
     def set_map(self, map_path, map_ext):
         """
-        Set the bitmap of the scan simulator by path
+        Set the bitmap of the scan simulator by path.
+        The image is cropped to its obstacles plus max_range (see crop_map), which scans can't tell apart
 
             Args:
                 map_path (str): path to the map yaml file
@@ -367,25 +581,44 @@ class ScanSimulator2D(object):
 
         # load map image
         map_img_path = os.path.splitext(map_path)[0] + map_ext
-        self.map_img = np.array(Image.open(map_img_path).transpose(Image.FLIP_TOP_BOTTOM))
-        self.map_img = self.map_img.astype(np.float64)
-
-        # grayscale -> binary
-        self.map_img[self.map_img <= 128.] = 0.
-        self.map_img[self.map_img > 128.] = 255.
-
-        self.map_height = self.map_img.shape[0]
-        self.map_width = self.map_img.shape[1]
+        map_img = np.array(Image.open(map_img_path).transpose(Image.FLIP_TOP_BOTTOM))
 
         # load map yaml
         with open(map_path, 'r') as yaml_stream:
             try:
                 map_metadata = yaml.safe_load(yaml_stream)
-                self.map_resolution = map_metadata['resolution']
-                self.origin = map_metadata['origin']
+                map_resolution = map_metadata['resolution']
+                origin = map_metadata['origin']
             except yaml.YAMLError as ex:
                 print(ex)
 
+        map_img, origin = crop_map(map_img, map_resolution, origin, self.max_range)
+        return self.set_map_array(map_img, map_resolution, origin)
+
+    def set_map_array(self, map_img, map_resolution, origin, dt=None):
+        """
+        Set the bitmap of the scan simulator from an image already in memory
+
+            Args:
+                map_img (numpy.ndarray (n, m)): grayscale map image, row 0 is the bottom of the map (image files are flipped when loaded)
+                map_resolution (float): resolution of the map (m/cell)
+                origin (list [x, y, theta]): pose of the bottom left cell of the map
+                dt (numpy.ndarray (n, m), default=None): precomputed distance transform of the map, computed here if None. When given, map_img is kept as is (no copy)
+
+            Returns:
+                flag (bool): if loading is successful
+        """
+        # grayscale -> binary, only needed for the distance transform
+        if dt is None:
+            self.map_img = np.where(np.asarray(map_img) > 128., 255., 0.)
+        else:
+            self.map_img = map_img
+
+        self.map_height = self.map_img.shape[0]
+        self.map_width = self.map_img.shape[1]
+        self.map_resolution = map_resolution
+        self.origin = origin
+
         # calculate map parameters
         self.orig_x = self.origin[0]
         self.orig_y = self.origin[1]
@@ -393,10 +626,141 @@ class ScanSimulator2D(object):
         self.orig_c = np.cos(self.origin[2])
 
         # get the distance transform
-        self.dt = get_dt(self.map_img, self.map_resolution)
+        if dt is None:
+            dt = get_dt(self.map_img, self.map_resolution)
+        self.dt = dt
+
+        # obstacles belong to the previous map
+        self.base_dt = None
+        self.obstacles = {}
+        self._update_pyramid()
 
         return True
 
+    def set_pyramid(self, factor=8, refine_dist=None):
+        """
+        Ray march long empty stretches on a coarse, min-pooled copy of the distance transform,
+        which is factor^2 times smaller and stays in cache, only refining close to walls.
+        Kept up to date through map and obstacle changes
+
+            Args:
+                factor (int, default=8): number of fine cells along each side of a coarse cell, None disables the pyramid
+                refine_dist (float, default=None): coarse distance under which the fine distance transform is used,
+                    defaults to twice the coarse cell size
+
+            Returns:
+                None
+        """
+        self.pyramid_factor = factor
+        self.refine_dist = refine_dist
+        self._update_pyramid()
+
+    def _update_pyramid(self, rows=None, cols=None):
+        # rebuild the coarse distance transform, or only the coarse cells covering a window of fine cells
+        if self.pyramid_factor is None or self.dt is None:
+            self.coarse_dt = None
+            return
+        f = self.pyramid_factor
+        if self.refine_dist is None:
+            self.refine_dist = 2. * f * self.map_resolution
+        if rows is None or self.coarse_dt is None:
+            self.coarse_dt = min_pool(self.dt, f)
+            return
+        row_start, row_end = rows.start // f, -(-rows.stop // f)
+        col_start, col_end = cols.start // f, -(-cols.stop // f)
+        if row_start < row_end and col_start < col_end:
+            self.coarse_dt[row_start:row_end, col_start:col_end] = min_pool(
+                self.dt[row_start * f:row_end * f, col_start * f:col_end * f], f)
+
+    def add_obstacle(self, x, y, theta=0., length=0., width=0., radius=0.):
+        """
+        Adds an obstacle to the map, a rectangle (length, width) or a circle (radius), or a rectangle with rounded corners.
+        Only the part of the distance transform the obstacle can change is updated,
+        cells further than max_range or than the furthest cell of the map from a wall are never affected.
+        The map's own distance transform is left untouched, so it can be shared with other simulators
+
+            Args:
+                x, y, theta (float): pose of the centre of the obstacle
+                length, width (float, default=0): size of the rectangle (m)
+                radius (float, default=0): radius of the circle, or of the rounded corners (m)
+
+            Returns:
+                obstacle_id (int): id of the obstacle, to remove it
+        """
+        if self.map_height is None:
+            raise ValueError('Map is not set for scan simulator.')
+        if self.base_dt is None:
+            # keep the map's distance transform, obstacles go in a copy
+            self.base_dt = self.dt
+            self.dt = np.array(self.dt, dtype=np.float64)
+            self.base_dt_max = float(np.max(self.base_dt))
+
+        obstacle_id = self.next_obstacle_id
+        self.next_obstacle_id += 1
+        self.obstacles[obstacle_id] = (x, y, theta, length / 2., width / 2., radius)
+        self._draw_obstacle(self.obstacles[obstacle_id])
+        self._update_pyramid(*self._obstacle_window(self.obstacles[obstacle_id]))
+        return obstacle_id
+
+    def remove_obstacle(self, obstacle_id):
+        """
+        Removes an obstacle from the map, restoring the distance transform around it
+
+            Args:
+                obstacle_id (int): id returned by add_obstacle
+
+            Returns:
+                None
+        """
+        obstacle = self.obstacles.pop(obstacle_id)
+        rows, cols = self._obstacle_window(obstacle)
+        self.dt[rows, cols] = self.base_dt[rows, cols]
+        # other obstacles may reach into the restored window
+        for other in self.obstacles.values():
+            self._draw_obstacle(other, (rows, cols))
+        self._update_pyramid(rows, cols)
+
+    def clear_obstacles(self):
+        """
+        Removes all obstacles, going back to the map's distance transform
+
+            Args:
+                None
+
+            Returns:
+                None
+        """
+        if self.base_dt is not None:
+            self.dt = self.base_dt
+            self._update_pyramid()
+        self.base_dt = None
+        self.obstacles = {}
+
+    def _obstacle_window(self, obstacle):
+        # window of cells whose distance to the walls an obstacle can change
+        x, y, theta, half_length, half_width, radius = obstacle
+        reach = np.sqrt(half_length**2 + half_width**2) + radius + min(self.max_range, self.base_dt_max)
+        # bounding box of the square around the obstacle, in map cells
+        corners = np.array([[-reach, -reach], [-reach, reach], [reach, -reach], [reach, reach]]) + [x, y]
+        x_trans = corners[:, 0] - self.orig_x
+        y_trans = corners[:, 1] - self.orig_y
+        cols = (x_trans * self.orig_c + y_trans * self.orig_s) / self.map_resolution
+        rows = (-x_trans * self.orig_s + y_trans * self.orig_c) / self.map_resolution
+        row_start = min(max(int(np.floor(rows.min())), 0), self.map_height)
+        row_end = min(max(int(np.ceil(rows.max())) + 1, 0), self.map_height)
+        col_start = min(max(int(np.floor(cols.min())), 0), self.map_width)
+        col_end = min(max(int(np.ceil(cols.max())) + 1, 0), self.map_width)
+        return slice(row_start, row_end), slice(col_start, col_end)
+
+    def _draw_obstacle(self, obstacle, window=None):
+        # lower the distance transform around an obstacle, within window if given
+        rows, cols = self._obstacle_window(obstacle)
+        if window is not None:
+            rows = slice(max(rows.start, window[0].start), min(rows.stop, window[0].stop))
+            cols = slice(max(cols.start, window[1].start), min(cols.stop, window[1].stop))
+        obstacle_dt(self.dt, rows.start, rows.stop, cols.start, cols.stop, *obstacle,
+                    self.orig_x, self.orig_y, self.orig_c, self.orig_s, self.map_resolution)
+
     def reset_rng(self, seed):
         """
         Resets the generator object's random sequence by re-constructing the generator.
@@ -423,13 +787,60 @@ class ScanSimulator2D(object):
             Raises:
                 ValueError: when scan is called before a map is set
         """
-        if self.map_height is None:
-            raise ValueError('Map is not set for scan simulator.')
-        scan = get_scan(pose, self.theta_dis, self.fov, self.num_beams, self.theta_index_increment, self.sines, self.cosines, self.eps, self.orig_x, self.orig_y, self.orig_c, self.orig_s, self.map_height, self.map_width, self.map_resolution, self.dt, self.max_range)
-        noise = self.rng.normal(0., self.std_dev, size=self.num_beams)
+        scan = self.scan_ranges(pose)
+        noise = self.scan_noise()
         final_scan = scan + noise
         return final_scan
 
+    def scan_ranges(self, pose):
+        """
+        Traces the beams of a scan without adding noise, scan() is scan_ranges() + scan_noise()
+
+            Args:
+                pose (numpy.ndarray (3, )): pose of the scan frame (x, y, theta)
+
+            Returns:
+                scan (numpy.ndarray (n, )): noiseless ranges of the laserscan, n=num_beams
+
+            Raises:
+                ValueError: when scan is called before a map is set
+        """
+        if self.map_height is None:
+            raise ValueError('Map is not set for scan simulator.')
+        if self.coarse_dt is None:
+            scan = get_scan(pose, self.theta_dis, self.fov, self.num_beams, self.theta_index_increment, self.sines, self.cosines, self.eps, self.orig_x, self.orig_y, self.orig_c, self.orig_s, self.map_height, self.map_width, self.map_resolution, self.dt, self.max_range)
+        else:
+            scan = get_scan_pyramid(pose, self.theta_dis, self.fov, self.num_beams, self.theta_index_increment, self.sines, self.cosines, self.eps, self.orig_x, self.orig_y, self.orig_c, self.orig_s, self.map_height, self.map_width, self.map_resolution, self.dt, self.coarse_dt, self.pyramid_factor, self.refine_dist, self.max_range)
+        return scan
+
+    def scan_noise(self):
+        """
+        Draws the noise of the next scan from the generator
+
+            Args:
+                None
+
+            Returns:
+                noise (numpy.ndarray (n, )): white noise, n=num_beams
+        """
+        return self.rng.normal(0., self.std_dev, size=self.num_beams)
+
+    def range_lower_bound(self, pose):
+        """
+        Lower bound of every range of a scan before noise. Rays are marched from the distance to the nearest
+        obstacle at the scan origin onwards, so no range is shorter, unless capped by max_range
+
+            Args:
+                pose (numpy.ndarray (3, )): pose of the scan frame (x, y, theta)
+
+            Returns:
+                bound (float): lower bound of the ranges (m)
+        """
+        if self.map_height is None:
+            raise ValueError('Map is not set for scan simulator.')
+        dist = distance_transform(pose[0], pose[1], self.orig_x, self.orig_y, self.orig_c, self.orig_s, self.map_height, self.map_width, self.map_resolution, self.dt)
+        return min(dist, self.max_range)
+
     def get_increment(self):
         return self.angle_increment
 
@@ -549,6 +960,136 @@ class ScanTests(unittest.TestCase):
         self.assertFalse(np.allclose(scan1, scan3))
         self.assertTrue(np.allclose(scan4, scan6))
 
+    def test_obstacles(self):
+        # empty 20m x 20m room, obstacles should match a full distance transform of the map with them drawn in
+        resolution = 0.05
+        origin = [-10., -10., 0.]
+        room = np.full((400, 400), 255.)
+        room[[0, -1], :] = 0.
+        room[:, [0, -1]] = 0.
+        scan_sim = ScanSimulator2D(self.num_beams, self.fov)
+        scan_sim.set_map_array(room, resolution, origin)
+        base_dt = scan_sim.dt.copy()
+
+        box = scan_sim.add_obstacle(2., 1., 0.3, length=1., width=0.5)
+        cone = scan_sim.add_obstacle(-3., -2., radius=0.2)
+        rows, cols = np.mgrid[0:400, 0:400]
+        x = origin[0] + (cols + 0.5) * resolution
+        y = origin[1] + (rows + 0.5) * resolution
+        lx = (x - 2.) * np.cos(0.3) + (y - 1.) * np.sin(0.3)
+        ly = -(x - 2.) * np.sin(0.3) + (y - 1.) * np.cos(0.3)
+        in_box = (np.abs(lx) <= 0.5) & (np.abs(ly) <= 0.25)
+        in_cone = np.hypot(x + 3., y + 2.) <= 0.2
+        full_dt = get_dt(np.where(in_box | in_cone, 0., room), resolution)
+        self.assertLess(np.max(np.abs(scan_sim.dt - full_dt)), 2 * resolution)
+
+        # scans see the box, 2m ahead minus half its length
+        scan = scan_sim.scan(np.array([-2., 1., 0.]))
+        self.assertAlmostEqual(scan[self.num_beams // 2], 3.5, delta=0.1)
+
+        # removing one restores the map around it, the other stays
+        scan_sim.remove_obstacle(box)
+        full_dt = get_dt(np.where(in_cone, 0., room), resolution)
+        self.assertLess(np.max(np.abs(scan_sim.dt - full_dt)), 2 * resolution)
+        scan_sim.clear_obstacles()
+        self.assertTrue(np.array_equal(scan_sim.dt, base_dt))
+
+    def test_crop_and_pyramid(self):
+        # 20m x 20m room with a few boxes inside a larger empty image
+        resolution = 0.05
+        origin = [-15., -15., 0.3]
+        big = np.full((600, 600), 255.)
+        big[100:500, [100, 499]] = 0.
+        big[[100, 499], 100:500] = 0.
+        big[250:280, 300:310] = 0.
+        big[350:360, 150:200] = 0.
+        scan_sim = ScanSimulator2D(self.num_beams, self.fov, std_dev=0.)
+        scan_sim.set_map_array(big, resolution, origin)
+        poses = [np.array([x, y, th]) for x, y, th in [(-2.013, 1.027, 0.), (3.031, -4.009, 2.), (0.017, 0.042, -1.)]]
+        # poses in the world frame, the map is rotated
+        c, s = np.cos(0.3), np.sin(0.3)
+        poses = [np.array([origin[0] + (p[0] + 15.) * c - (p[1] + 15.) * s,
+                           origin[1] + (p[0] + 15.) * s + (p[1] + 15.) * c, p[2]]) for p in poses]
+        scans = [scan_sim.scan(p) for p in poses]
+
+        # cropping keeps the distance transform around the room, scans don't change
+        cropped, cropped_origin = crop_map(big, resolution, origin, 1.)
+        self.assertEqual(cropped.shape, (440, 440))
+        scan_sim.set_map_array(cropped, resolution, cropped_origin)
+        for pose, scan in zip(poses, scans):
+            self.assertTrue(np.allclose(scan_sim.scan(pose), scan))
+
+        # coarse cells are a lower bound of the fine ones
+        scan_sim.set_pyramid(8)
+        self.assertEqual(scan_sim.coarse_dt.shape, (55, 55))
+        self.assertTrue(np.all(np.repeat(np.repeat(scan_sim.coarse_dt, 8, 0), 8, 1)[:440, :440] <= scan_sim.dt))
+        for pose, scan in zip(poses, scans):
+            self.assertLess(np.median(np.abs(scan_sim.scan(pose) - scan)), resolution)
+
+        # pyramid follows obstacles
+        scan_sim.add_obstacle(*poses[0][:2], radius=0.5)
+        self.assertTrue(np.all(np.repeat(np.repeat(scan_sim.coarse_dt, 8, 0), 8, 1)[:440, :440] <= scan_sim.dt))
+        self.assertLess(np.max(scan_sim.scan(poses[0])), 1e-3 + 0.1)
+
+    def test_pyramid_skips_fine_reads(self):
+        # 40m x 40m room with small pillars, rays cross long empty stretches between them
+        resolution = 0.05
+        room = np.full((800, 800), 255.)
+        room[[0, -1], :] = 0.
+        room[:, [0, -1]] = 0.
+        rng = np.random.default_rng(0)
+        for r, c in rng.integers(10, 780, size=(40, 2)):
+            room[r:r + 8, c:c + 8] = 0.
+        scan_sim = ScanSimulator2D(self.num_beams, self.fov, std_dev=0.)
+        scan_sim.set_map_array(room, resolution, [-20., -20., 0.])
+        scan_sim.set_pyramid(8)
+        poses = [p for p in rng.uniform(-18., 18., size=(40, 2)) if distance_transform(
+            p[0], p[1], scan_sim.orig_x, scan_sim.orig_y, scan_sim.orig_c, scan_sim.orig_s, 800, 800, resolution,
+            scan_sim.dt) > 0.5]
+
+        # an infinite refine_dist always reads the fine level, like trace_ray
+        counts = np.zeros((2, 2))
+        ranges = np.zeros((2, len(poses), 100))
+        for i, (x, y) in enumerate(poses):
+            for j, theta_index in enumerate(range(0, scan_sim.theta_dis, scan_sim.theta_dis // 100)):
+                for k, refine_dist in enumerate((np.inf, scan_sim.refine_dist)):
+                    dist, iterations, fine_reads = trace_ray_pyramid(
+                        x, y, theta_index, scan_sim.sines, scan_sim.cosines, scan_sim.eps, scan_sim.orig_x,
+                        scan_sim.orig_y, scan_sim.orig_c, scan_sim.orig_s, 800, 800, resolution, scan_sim.dt,
+                        scan_sim.coarse_dt, 8, refine_dist, scan_sim.max_range)
+                    ranges[k, i, j] = dist
+                    counts[k] += (iterations, fine_reads)
+        self.assertLess(np.median(np.abs(ranges[1] - ranges[0])), resolution)
+        # no more steps, and far fewer fine reads
+        self.assertLessEqual(counts[1, 0], counts[0, 0])
+        self.assertLess(counts[1, 1], 0.6 * counts[0, 1])
+
+    def test_set_map_crops(self):
+        # 20m x 20m room in the middle of a 100m x 100m image
+        resolution = 0.1
+        origin = [-50., -50., 0.]
+        big = np.full((1000, 1000), 255, dtype=np.uint8)
+        big[400:600, [400, 599]] = 0
+        big[[400, 599], 400:600] = 0
+        big[450:460, 520:540] = 0
+        directory = tempfile.mkdtemp()
+        try:
+            # image files have row 0 at the top
+            Image.fromarray(np.flipud(big)).save(os.path.join(directory, 'room.png'))
+            with open(os.path.join(directory, 'room.yaml'), 'w') as f:
+                f.write('resolution: 0.1\norigin: [-50., -50., 0.]\n')
+            scan_sim = ScanSimulator2D(self.num_beams, self.fov, std_dev=0.)
+            scan_sim.set_map(os.path.join(directory, 'room.yaml'), '.png')
+        finally:
+            shutil.rmtree(directory)
+
+        # walls plus max_range on every side
+        self.assertEqual((scan_sim.map_height, scan_sim.map_width), (800, 800))
+        self.assertTrue(np.allclose(scan_sim.origin, [-40., -40., 0.]))
+        full_sim = ScanSimulator2D(self.num_beams, self.fov, std_dev=0.)
+        full_sim.set_map_array(big, resolution, origin)
+        for pose in (np.array([0.51, -1.23, 0.4]), np.array([-5.07, 6.11, 2.5])):
+            self.assertTrue(np.allclose(scan_sim.scan(pose), full_sim.scan(pose)))
 
 def main():
     num_beams = 1080
@@ -0,0 +1,228 @@
+# MIT License
+
+# Copyright (c) 2020 Joseph Auckley, Matthew O'Kelly, Aman Sinha, Hongrui Zheng
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""
+Egocentric occupancy grids sampled from the map's distance transform
+"""
+
+import numpy as np
+from numba import njit
+
+from f110_gym.envs.collision_models import get_vertices
+
+import unittest
+
+@njit(cache=True)
+def sample_dt(x, y, dt, orig_x, orig_y, orig_c, orig_s, resolution):
+    """
+    Bilinear interpolation of the distance transform at a world coordinate
+
+        Args:
+            x, y (float): world coordinates of the point (m)
+            dt (np.ndarray (h, w)): distance transform of the map
+            orig_x, orig_y (float): coordinates of the map origin (m)
+            orig_c, orig_s (float): cosine and sine of the map origin's rotation
+            resolution (float): map resolution (m/cell)
+
+        Returns:
+            distance (float): distance to the closest obstacle (m), 0 outside the map
+    """
+    x_trans = x - orig_x
+    y_trans = y - orig_y
+    # continuous cell coordinates, relative to the cell centres
+    u = (x_trans * orig_c + y_trans * orig_s) / resolution - 0.5
+    v = (-x_trans * orig_s + y_trans * orig_c) / resolution - 0.5
+    height = dt.shape[0]
+    width = dt.shape[1]
+    if u < -0.5 or v < -0.5 or u > width - 0.5 or v > height - 0.5:
+        return 0.
+    c0 = min(max(int(np.floor(u)), 0), width - 1)
+    r0 = min(max(int(np.floor(v)), 0), height - 1)
+    c1 = min(c0 + 1, width - 1)
+    r1 = min(r0 + 1, height - 1)
+    fu = min(max(u - c0, 0.), 1.)
+    fv = min(max(v - r0, 0.), 1.)
+    top = dt[r0, c0] * (1. - fu) + dt[r0, c1] * fu
+    bottom = dt[r1, c0] * (1. - fu) + dt[r1, c1] * fu
+    return top * (1. - fv) + bottom * fv
+
+@njit(cache=True)
+def in_convex_polygon(x, y, vertices):
+    """
+    Check if a point is inside a convex polygon, vertices in either winding order
+
+        Args:
+            x, y (float): point
+            vertices (np.ndarray (n, 2)): vertices of the polygon in order
+
+        Returns:
+            inside (bool): if the point is inside or on the border
+    """
+    n = vertices.shape[0]
+    positive = False
+    negative = False
+    for i in range(n):
+        ax = vertices[i, 0]
+        ay = vertices[i, 1]
+        bx = vertices[(i + 1) % n, 0]
+        by = vertices[(i + 1) % n, 1]
+        cross = (bx - ax) * (y - ay) - (by - ay) * (x - ax)
+        if cross > 0:
+            positive = True
+        elif cross < 0:
+            negative = True
+        if positive and negative:
+            return False
+    return True
+
+@njit(cache=True)
+def egocentric_grids(poses, length, width, dt, orig_x, orig_y, orig_c, orig_s, resolution, cell_size, out):
+    """
+    Samples a square grid of the map's distance transform around each agent, rotated to its heading,
+    cells covered by the body of another agent are set to 0
+
+        Args:
+            poses (np.ndarray (n, 3)): poses of all agents
+            length, width (float): size of the car bodies (m)
+            dt (np.ndarray (h, w)): distance transform of the map
+            orig_x, orig_y (float): coordinates of the map origin (m)
+            orig_c, orig_s (float): cosine and sine of the map origin's rotation
+            resolution (float): map resolution (m/cell)
+            cell_size (float): size of the grid cells (m)
+            out (np.ndarray (n, k, k)): output grids, row 0 is ahead of the agent and column 0 to its left
+
+        Returns:
+            None (written into out)
+    """
+    num_agents = poses.shape[0]
+    grid_size = out.shape[1]
+    half = (grid_size - 1) / 2.
+
+    # footprints of all agents
+    vertices = np.empty((num_agents, 4, 2))
+    for i in range(num_agents):
+        vertices[i] = get_vertices(poses[i], length, width)
+
+    for i in range(num_agents):
+        cos = np.cos(poses[i, 2])
+        sin = np.sin(poses[i, 2])
+        for r in range(grid_size):
+            forward = (half - r) * cell_size
+            for c in range(grid_size):
+                left = (half - c) * cell_size
+                x = poses[i, 0] + cos * forward - sin * left
+                y = poses[i, 1] + sin * forward + cos * left
+                value = sample_dt(x, y, dt, orig_x, orig_y, orig_c, orig_s, resolution)
+                for j in range(num_agents):
+                    if j != i and in_convex_polygon(x, y, vertices[j]):
+                        value = 0.
+                        break
+                out[i, r, c] = value
+
+
+class EgocentricGrid(object):
+    """
+    Egocentric grids of the map around each agent, for image based policies.
+    Cheaper than ray marching enough beams to cover the same area, and batched over agents.
+    """
+
+    def __init__(self, num_agents=1, grid_size=64, cell_size=0.1):
+        """
+        Init function
+
+        Args:
+            num_agents (int, default=1): number of agents
+            grid_size (int, default=64): number of cells along each side of the grid
+            cell_size (float, default=0.1): size of each cell (m)
+        """
+        self.grid_size = grid_size
+        self.cell_size = cell_size
+        self.grids = np.empty((num_agents, grid_size, grid_size))
+
+    def __call__(self, poses, scan_simulator, length, width):
+        """
+        Samples the grids of all agents
+
+        Args:
+            poses (np.ndarray (num_agents, 3)): poses of all agents
+            scan_simulator (ScanSimulator2D): scan simulator holding the map and its distance transform
+            length, width (float): size of the car bodies (m)
+
+        Returns:
+            grids (np.ndarray (num_agents, grid_size, grid_size)): distance to the closest obstacle in each cell (m),
+                0 in walls and other cars. Reused by the next call
+        """
+        egocentric_grids(np.ascontiguousarray(poses, dtype=np.float64), length, width, scan_simulator.dt,
+                         scan_simulator.orig_x, scan_simulator.orig_y, scan_simulator.orig_c,
+                         scan_simulator.orig_s, scan_simulator.map_resolution, self.cell_size, self.grids)
+        return self.grids
+
+
+"""
+Unit tests for the egocentric grids
+"""
+
+class EgocentricGridTests(unittest.TestCase):
+    def setUp(self):
+        # 20m x 20m box with walls on the border, 0.1m resolution, origin at (-10, -10)
+        self.resolution = 0.1
+        rows, cols = np.mgrid[0:200, 0:200]
+        self.dt = np.minimum(np.minimum(rows, 199 - rows), np.minimum(cols, 199 - cols)) * self.resolution
+
+    def grids(self, poses, cell_size=0.1, grid_size=41):
+        out = np.empty((poses.shape[0], grid_size, grid_size))
+        egocentric_grids(poses, 0.58, 0.31, self.dt, -10., -10., 1., 0., self.resolution, cell_size, out)
+        return out
+
+    def test_sample_matches_cells(self):
+        # at cell centres the interpolation gives the cell value
+        for r, c in [(0, 0), (13, 57), (100, 100), (199, 3)]:
+            x = -10. + (c + 0.5) * self.resolution
+            y = -10. + (r + 0.5) * self.resolution
+            self.assertAlmostEqual(sample_dt(x, y, self.dt, -10., -10., 1., 0., self.resolution), self.dt[r, c])
+        # outside the map
+        self.assertEqual(sample_dt(-11., 0., self.dt, -10., -10., 1., 0., self.resolution), 0.)
+
+    def test_rotation(self):
+        # car facing +y next to the left wall (x = -10) sees the wall on its left, in column 0
+        grid = self.grids(np.array([[-9., 0., np.pi / 2]]), cell_size=0.05)[0]
+        self.assertTrue(np.all(grid[:, 0] < 0.1))
+        self.assertTrue(np.all(grid[:, -1] > 1.0))
+        # same view from the top wall, facing +x
+        rotated = self.grids(np.array([[0., 9., 0.]]), cell_size=0.05)[0]
+        self.assertTrue(np.allclose(grid, rotated, atol=1e-6))
+
+    def test_opponent_footprint(self):
+        # opponent 1m straight ahead covers the middle column 10 cells above the centre
+        grids = self.grids(np.array([[0., 0., 0.], [1., 0., 0.]]))
+        self.assertTrue(np.all(grids[0, 8:13, 20] == 0.))
+        self.assertTrue(np.all(grids[0, 10, 19:22] == 0.))
+        self.assertTrue(grids[0, 6, 20] > 0.)
+        # own body is not an obstacle
+        self.assertTrue(grids[0, 20, 20] > 0.)
+        # and the opponent sees the ego car 1m behind it
+        self.assertTrue(np.all(grids[1, 28:33, 20] == 0.))
+
+if __name__ == '__main__':
+    unittest.main()
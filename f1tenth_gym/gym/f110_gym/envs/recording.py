@@ -0,0 +1,633 @@
+# MIT License
+
+# Copyright (c) 2020 Joseph Auckley, Matthew O'Kelly, Aman Sinha, Hongrui Zheng
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+
+"""
+Chunked episode recording of states, actions and scans, written to disk on a background thread
+"""
+
+import numpy as np
+import hashlib
+import json
+import os
+import queue
+import threading
+import atexit
+
+from f110_gym.envs.scan_codec import ScanCodec, MM_QUANTUM
+
+import unittest
+import tempfile
+import shutil
+
+# F110Env members saved in snapshots, together with the agents' states and scan noise generators
+ENV_SNAPSHOT_MEMBERS = ('current_time', 'lap_times', 'lap_counts', 'near_start', 'near_starts', 'num_toggles', 'toggle_list',
+                        'start_xs', 'start_ys', 'start_thetas', 'start_rot', 'collisions', 'poses_x', 'poses_y', 'poses_theta', 'done')
+
+
+def to_json(value):
+    """
+    Converts numpy arrays and scalars to plain python values for json
+    """
+    value = np.asarray(value)
+    return value.tolist() if value.ndim > 0 else value.item()
+
+
+def env_snapshot(env):
+    """
+    Captures everything a simulation step of an F110Env depends on, so that it can be continued later
+    with restore_snapshot. Doesn't include the map, obstacles or the centerline progress tracker.
+
+    Args:
+        env (F110Env): environment to capture
+
+    Returns:
+        snapshot (dict): json serialisable state of the env
+    """
+    agents = []
+    for agent in env.sim.agents:
+        agents.append({'state': to_json(agent.state),
+                       'steer_buffer': to_json(agent.steer_buffer),
+                       'accel': to_json(agent.accel),
+                       'steer_angle_vel': to_json(agent.steer_angle_vel),
+                       'in_collision': to_json(agent.in_collision),
+                       'rng': agent.scan_simulator.rng.bit_generator.state})
+    return {'env': {name: to_json(getattr(env, name)) for name in ENV_SNAPSHOT_MEMBERS},
+            'agents': agents}
+
+
+def restore_snapshot(env, snapshot):
+    """
+    Restores an F110Env to a snapshot taken by env_snapshot, the env must have the same map and agents
+
+    Args:
+        env (F110Env): environment to restore
+        snapshot (dict): snapshot to restore
+
+    Returns:
+        None
+    """
+    for name, value in snapshot['env'].items():
+        setattr(env, name, np.array(value) if isinstance(value, list) else value)
+    for agent, state in zip(env.sim.agents, snapshot['agents']):
+        agent.state = np.array(state['state'])
+        agent.steer_buffer = np.array(state['steer_buffer'], dtype=np.float64)
+        agent.accel = state['accel']
+        agent.steer_angle_vel = state['steer_angle_vel']
+        agent.in_collision = state['in_collision']
+        agent.scan_simulator.rng.bit_generator.state = state['rng']
+
+
+def save_npy(path, array):
+    """
+    Writes an array to a .npy file atomically, readers never see a partial file
+
+    Args:
+        path (str): path of the .npy file
+        array (np.ndarray): array to write
+
+    Returns:
+        None
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def save_json(path, data):
+    """
+    Writes json atomically, readers never see a partial file
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class EpisodeRecorder(object):
+    """
+    Records every step of an F110Env into append-only chunks on disk, attached with F110Env.set_recorder.
+
+    Steps are copied into preallocated chunk buffers. Full chunks are handed to a writer thread that saves one
+    .npy file per field into chunk_{index}/ and then updates index.json, so the step loop never waits on the disk
+    unless the writer falls a whole chunk behind. Only two chunks are ever held in memory.
+
+    Every chunk has the fields, with one row per step and K agents:
+        episode (int64): index of the episode the step belongs to
+        step (int32): step within the episode, the reset is step 0
+        action (K, 2) float64: [steer, velocity] action applied at this step, zeros at the reset
+        state (K, 7) float64: vehicle state after the step, see RaceCar.state
+        collision (K,) uint8: collision flags
+        lap_time (K,) float32, lap_count (K,) int16: lap data
+        scan (K, num_beams) float32, or codes of the scan_encoding (see ScanCodec), only with record_scans
+
+    index.json also lists the episodes with what's needed to replay them: first step, reset poses, seed, map
+    and vehicle params. Maps loaded from memory are saved once to maps/. Every snapshot_interval steps of an
+    episode, an env_snapshot is saved to the chunk's snapshots.json, for seeking in replays.
+    """
+
+    def __init__(self, directory, chunk_steps=10000, record_scans=True, scan_encoding=None, snapshot_interval=1000):
+        """
+        Class constructor
+
+        Args:
+            directory (str): directory the log is written to, appending to a log already there
+            chunk_steps (int, default=10000): number of steps per chunk
+            record_scans (bool, default=True): record the scans of all agents
+            scan_encoding (str, default=None): store scans as 'mm' or 'log' codes instead of float32, see ScanCodec
+            snapshot_interval (int, default=1000): steps between snapshots of the env, 0 disables them
+
+        Returns:
+            None
+        """
+        self.directory = directory
+        self.chunk_steps = chunk_steps
+        self.record_scans = record_scans
+        self.scan_codec = None if scan_encoding is None else ScanCodec(scan_encoding)
+        self.snapshot_interval = snapshot_interval
+        os.makedirs(directory, exist_ok=True)
+
+        # last map saved from memory, and its key in maps/
+        self.map_source = None
+        self.map_key = None
+
+        # continue an existing log
+        self.index_path = os.path.join(directory, 'index.json')
+        codec_config = None if self.scan_codec is None else self.scan_codec.config()
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'chunks': [], 'episodes': [], 'scan_codec': codec_config}
+        # scans of one log all have the same encoding
+        if self.index.get('scan_codec') != codec_config:
+            raise ValueError('Log in {} stores scans as {}, not {}.'.format(directory, self.index.get('scan_codec'), codec_config))
+        self.chunk_index = len(self.index['chunks'])
+        self.episode = len(self.index['episodes']) - 1
+        self.episode_step = 0
+        self.total_steps = sum(chunk['steps'] for chunk in self.index['chunks'])
+
+        # chunk being filled, buffers are allocated on the first step once the number of agents and beams are known
+        self.allocated = False
+        self.buffers = None
+        self.size = 0
+        # episodes started and snapshots taken since the last chunk was handed to the writer
+        self.new_episodes = []
+        self.new_snapshots = []
+
+        # buffer sets free to be filled, and full chunks waiting to be written
+        self.free = queue.Queue()
+        self.pending = queue.Queue()
+        self.error = None
+        self.writer = threading.Thread(target=self._write_chunks, daemon=True)
+        self.writer.start()
+        self.closed = False
+        atexit.register(self.close)
+
+    def _allocate(self, num_agents, num_beams):
+        """
+        Allocates a set of chunk buffers
+        """
+        buffers = {'episode': np.zeros((self.chunk_steps, ), dtype=np.int64),
+                   'step': np.zeros((self.chunk_steps, ), dtype=np.int32),
+                   'action': np.zeros((self.chunk_steps, num_agents, 2)),
+                   'state': np.zeros((self.chunk_steps, num_agents, 7)),
+                   'collision': np.zeros((self.chunk_steps, num_agents), dtype=np.uint8),
+                   'lap_time': np.zeros((self.chunk_steps, num_agents), dtype=np.float32),
+                   'lap_count': np.zeros((self.chunk_steps, num_agents), dtype=np.int16)}
+        if self.record_scans:
+            scan_dtype = np.float32 if self.scan_codec is None else self.scan_codec.dtype
+            buffers['scan'] = np.zeros((self.chunk_steps, num_agents, num_beams), dtype=scan_dtype)
+        return buffers
+
+    def start_episode(self, env, poses):
+        """
+        Called by F110Env.reset before its first step
+
+        Args:
+            env (F110Env): environment being recorded
+            poses (np.ndarray (num_agents, 3)): poses the agents are reset to
+
+        Returns:
+            None
+        """
+        # obstacle events aren't recorded, the replay would run on the bare map
+        if env.sim.agents[0].scan_simulator.obstacles:
+            raise ValueError('Cannot record an episode with obstacles on the map.')
+        self.episode += 1
+        self.episode_step = 0
+        self.new_episodes.append({'episode': self.episode,
+                                  'first_step': self.total_steps,
+                                  'poses': to_json(np.asarray(poses, dtype=np.float64)),
+                                  'seed': to_json(env.seed),
+                                  'num_agents': env.num_agents,
+                                  'ego_idx': env.ego_idx,
+                                  'timestep': env.timestep,
+                                  'params': [{key: to_json(value) for key, value in agent.params.items()} for agent in env.sim.agents],
+                                  'map': self._map_entry(env)})
+
+    def _map_entry(self, env):
+        """
+        Describes the env's current map for the episode index, saving maps loaded from memory to maps/.
+        The dtype of their distance transform is kept so that the replay rebuilds the same one
+        """
+        if env.map_array is None:
+            return {'path': env.map_path, 'ext': env.map_ext}
+
+        map_img, map_resolution, origin = env.map_array
+        if map_img is not self.map_source:
+            # maps are only hashed and saved when they change
+            map_img = np.ascontiguousarray(map_img)
+            self.map_key = hashlib.sha1(map_img.tobytes()).hexdigest()[:16]
+            path = os.path.join(self.directory, 'maps', self.map_key + '.npy')
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                save_npy(path, map_img)
+            self.map_source = env.map_array[0]
+        dt_dtype = env.sim.agents[0].scan_simulator.dt.dtype.name
+        return {'array': self.map_key, 'resolution': to_json(map_resolution), 'origin': to_json(origin), 'dt_dtype': dt_dtype}
+
+    def record_step(self, env, action, obs):
+        """
+        Called by F110Env.step after each simulation step, copies the step into the current chunk
+
+        Args:
+            env (F110Env): environment being recorded
+            action (np.ndarray (num_agents, 2)): action applied
+            obs (dict): observation returned by the step
+
+        Returns:
+            None
+        """
+        if self.error is not None:
+            raise self.error
+        if self.closed:
+            raise ValueError('Recording to a closed EpisodeRecorder.')
+        if not self.allocated:
+            # one set being filled while the other is written
+            for _ in range(2):
+                self.free.put(self._allocate(env.num_agents, len(obs['scans'][0])))
+            self.allocated = True
+        if self.buffers is None:
+            # only blocks if the writer is a whole chunk behind
+            self.buffers = self.free.get()
+
+        row = self.size
+        buffers = self.buffers
+        buffers['episode'][row] = self.episode
+        buffers['step'][row] = self.episode_step
+        buffers['action'][row] = action
+        for i, agent in enumerate(env.sim.agents):
+            buffers['state'][row, i] = agent.state
+        buffers['collision'][row] = obs['collisions']
+        buffers['lap_time'][row] = obs['lap_times']
+        buffers['lap_count'][row] = obs['lap_counts']
+        if self.record_scans:
+            if self.scan_codec is not None:
+                self.scan_codec.encode(obs['scans'], out=buffers['scan'][row])
+            else:
+                buffers['scan'][row] = obs['scans']
+
+        if self.snapshot_interval > 0 and self.episode_step > 0 and self.episode_step % self.snapshot_interval == 0:
+            self.new_snapshots.append({'episode': self.episode,
+                                       'step': self.episode_step,
+                                       'snapshot': env_snapshot(env)})
+
+        self.size += 1
+        self.episode_step += 1
+        self.total_steps += 1
+        if self.size == self.chunk_steps:
+            self._hand_off()
+
+    def _hand_off(self):
+        """
+        Queues the current chunk for writing, the next step fills a free buffer set
+        """
+        self.pending.put((self.chunk_index, self.buffers, self.size, self.new_episodes, self.new_snapshots))
+        self.chunk_index += 1
+        self.buffers = None
+        self.size = 0
+        self.new_episodes = []
+        self.new_snapshots = []
+
+    def _write_chunks(self):
+        """
+        Writer thread, saves queued chunks and returns their buffers to the free queue
+        """
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            if item[0] == 'wait':
+                # everything queued before this has been written
+                item[1].set()
+                continue
+            chunk_index, buffers, size, episodes, snapshots = item
+            try:
+                name = 'chunk_{:06d}'.format(chunk_index)
+                os.makedirs(os.path.join(self.directory, name), exist_ok=True)
+                for field, array in buffers.items():
+                    save_npy(os.path.join(self.directory, name, field + '.npy'), array[:size])
+                save_json(os.path.join(self.directory, name, 'snapshots.json'), snapshots)
+                # the index is only updated once all of the chunk's files exist
+                self.index['chunks'].append({'name': name, 'steps': size})
+                self.index['episodes'].extend(episodes)
+                save_json(self.index_path, self.index)
+            except Exception as ex:
+                self.error = ex
+            self.free.put(buffers)
+
+    def flush(self):
+        """
+        Writes out the partial chunk and waits for all chunks to be on disk
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        if self.size > 0:
+            self._hand_off()
+        self._wait()
+
+    def _wait(self):
+        """
+        Blocks until the writer has emptied its queue
+        """
+        done = threading.Event()
+        self.pending.put(('wait', done))
+        done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Flushes and stops the writer thread
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        self.pending.put(None)
+        self.writer.join()
+        atexit.unregister(self.close)
+
+
+class EpisodeLog(object):
+    """
+    Reads a log written by EpisodeRecorder, chunks are memory mapped so only the steps read are loaded
+    """
+
+    def __init__(self, directory):
+        """
+        Class constructor
+
+        Args:
+            directory (str): directory of the log
+
+        Returns:
+            None
+        """
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.chunk_names = [chunk['name'] for chunk in index['chunks']]
+        # first global step of every chunk, and the total
+        self.offsets = np.cumsum([0] + [chunk['steps'] for chunk in index['chunks']])
+        self.episodes = index['episodes']
+        self.scan_codec = None if index.get('scan_codec') is None else ScanCodec.from_config(index['scan_codec'])
+        self.chunks = {}
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def chunk(self, index):
+        """
+        Memory maps the fields of a chunk
+
+        Args:
+            index (int): index of the chunk
+
+        Returns:
+            fields (dict): field name -> np.ndarray
+        """
+        if index not in self.chunks:
+            path = os.path.join(self.directory, self.chunk_names[index])
+            self.chunks[index] = {os.path.splitext(name)[0]: np.load(os.path.join(path, name), mmap_mode='r')
+                                  for name in os.listdir(path) if name.endswith('.npy')}
+        return self.chunks[index]
+
+    def read(self, field, start, stop, decode=True):
+        """
+        Reads a field over a range of global steps, across chunks
+
+        Args:
+            field (str): name of the field
+            start (int): first step
+            stop (int): step after the last
+            decode (bool, default=True): decode encoded scans, otherwise they are returned as codes of self.scan_codec
+
+        Returns:
+            values (np.ndarray): rows start to stop of the field, scans in meters
+        """
+        first = np.searchsorted(self.offsets, start, side='right') - 1
+        last = np.searchsorted(self.offsets, stop, side='left')
+        parts = []
+        for index in range(first, last):
+            begin = max(start, self.offsets[index]) - self.offsets[index]
+            end = min(stop, self.offsets[index + 1]) - self.offsets[index]
+            parts.append(self.chunk(index)[field][begin:end])
+        values = np.concatenate(parts)
+        if field == 'scan' and decode and self.scan_codec is not None:
+            values = self.scan_codec.decode(values, out=np.empty(values.shape, dtype=np.float32))
+        return values
+
+    def episode(self, episode, decode=True):
+        """
+        Reads all the fields of an episode
+
+        Args:
+            episode (int): index of the episode
+            decode (bool, default=True): decode encoded scans, see read
+
+        Returns:
+            fields (dict): field name -> np.ndarray with one row per step of the episode, and
+                'poses' (np.ndarray (num_agents, 3)) the episode was reset to
+        """
+        start, stop = self.episode_range(episode)
+        fields = {field: self.read(field, start, stop, decode) for field in self.chunk(0)}
+        fields['poses'] = np.array(self.episodes[episode]['poses'])
+        return fields
+
+    def episode_range(self, episode):
+        """
+        Global steps of an episode
+
+        Args:
+            episode (int): index of the episode
+
+        Returns:
+            start (int): first step of the episode
+            stop (int): step after its last
+        """
+        start = self.episodes[episode]['first_step']
+        if episode + 1 < len(self.episodes):
+            stop = self.episodes[episode + 1]['first_step']
+        else:
+            stop = len(self)
+        return start, stop
+
+    def snapshots(self, episode):
+        """
+        Snapshots taken during an episode
+
+        Args:
+            episode (int): index of the episode
+
+        Returns:
+            snapshots (list[dict]): snapshots sorted by step, each with the episode 'step' it was taken
+                after and the 'snapshot' itself
+        """
+        start, stop = self.episode_range(episode)
+        first = np.searchsorted(self.offsets, start, side='right') - 1
+        last = np.searchsorted(self.offsets, stop, side='left')
+        snapshots = []
+        for index in range(first, last):
+            path = os.path.join(self.directory, self.chunk_names[index], 'snapshots.json')
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    snapshots.extend(snapshot for snapshot in json.load(f) if snapshot['episode'] == episode)
+        return sorted(snapshots, key=lambda snapshot: snapshot['step'])
+
+
+"""
+Unit tests for the episode recorder
+"""
+
+class RecorderTests(unittest.TestCase):
+    def setUp(self):
+        from f110_gym.envs.f110_env import F110Env
+        from PIL import Image
+        self.directory = tempfile.mkdtemp()
+        # walled 20 x 20 m map, and the same with a wall across it
+        map_img = np.full((400, 400), 255, dtype=np.uint8)
+        map_img[[0, -1], :] = 0
+        map_img[:, [0, -1]] = 0
+        self.map_directory = tempfile.mkdtemp()
+        self.map_paths = []
+        for name, img in (('box', map_img), ('split', np.where(np.arange(400)[:, None] == 300, 0, map_img))):
+            map_path = os.path.join(self.map_directory, name)
+            Image.fromarray(img.astype(np.uint8)).save(map_path + '.png')
+            with open(map_path + '.yaml', 'w') as f:
+                f.write('resolution: 0.05\norigin: [-10., -10., 0.]\n')
+            self.map_paths.append(map_path + '.yaml')
+        self.env = F110Env(map=os.path.join(self.map_directory, 'box'), map_ext='.png', num_agents=2)
+        self.poses = np.array([[0., 0., 0.], [2., 0.5, 0.]])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.map_directory)
+
+    def run_episodes(self, recorder, episodes=3, steps=50):
+        self.env.set_recorder(recorder)
+        states = []
+        for _ in range(episodes):
+            self.env.reset(self.poses)
+            states.append([np.stack([agent.state.copy() for agent in self.env.sim.agents])])
+            for i in range(steps):
+                self.env.step(np.array([[0.1, 2.], [-0.1, 1.]]))
+                states[-1].append(np.stack([agent.state.copy() for agent in self.env.sim.agents]))
+        return states
+
+    def test_round_trip(self):
+        recorder = EpisodeRecorder(self.directory, chunk_steps=64)
+        states = self.run_episodes(recorder)
+        recorder.close()
+        log = EpisodeLog(self.directory)
+        # 3 episodes of a reset and 50 steps, over chunks of 64 steps
+        self.assertEqual(len(log), 153)
+        self.assertEqual(len(log.chunk_names), 3)
+        self.assertEqual(len(log.episodes), 3)
+        for i in range(3):
+            episode = log.episode(i)
+            self.assertTrue(np.array_equal(episode['state'], np.array(states[i])))
+            self.assertTrue(np.array_equal(episode['step'], np.arange(51)))
+            self.assertTrue(np.all(episode['action'][0] == 0.))
+            self.assertTrue(np.all(episode['action'][1:] == [[0.1, 2.], [-0.1, 1.]]))
+            self.assertTrue(np.array_equal(episode['poses'], self.poses))
+            self.assertEqual(episode['scan'].shape, (51, 2, 1080))
+
+    def test_encoded_scans_and_append(self):
+        recorder = EpisodeRecorder(self.directory, chunk_steps=64, scan_encoding='mm')
+        self.run_episodes(recorder, episodes=1)
+        scan = self.env.current_obs['scans'][0].copy()
+        recorder.close()
+        # a second recorder appends to the same log, with the same encoding only
+        with self.assertRaises(ValueError):
+            EpisodeRecorder(self.directory, chunk_steps=64, scan_encoding='log')
+        recorder = EpisodeRecorder(self.directory, chunk_steps=64, scan_encoding='mm')
+        self.run_episodes(recorder, episodes=1)
+        recorder.close()
+        log = EpisodeLog(self.directory)
+        self.assertEqual(len(log), 102)
+        self.assertEqual(log.chunk(0)['scan'].dtype, np.uint16)
+        self.assertTrue(np.allclose(log.episode(0)['scan'][-1, 0], scan, atol=MM_QUANTUM / 2 + 1e-6))
+        self.assertEqual(log.episode(0, decode=False)['scan'].dtype, np.uint16)
+        self.assertTrue(np.array_equal(log.episode(1)['step'], np.arange(51)))
+
+    def test_map_switch(self):
+        # episodes are indexed with the map loaded when they start, not the one the env was made with
+        recorder = EpisodeRecorder(self.directory, chunk_steps=64)
+        self.run_episodes(recorder, episodes=1)
+        self.env.update_map(self.map_paths[1], '.png')
+        self.run_episodes(recorder, episodes=1)
+        recorder.close()
+        log = EpisodeLog(self.directory)
+        self.assertEqual([episode['map']['path'] for episode in log.episodes], self.map_paths)
+
+    def test_refuses_obstacles(self):
+        # obstacle events aren't logged, so episodes with obstacles can't be recorded
+        obstacle = self.env.add_obstacle(3., 0., radius=0.3)
+        recorder = EpisodeRecorder(self.directory)
+        self.env.set_recorder(recorder)
+        with self.assertRaises(ValueError):
+            self.env.reset(self.poses)
+        self.env.remove_obstacle(obstacle)
+        self.env.reset(self.poses)
+        with self.assertRaises(ValueError):
+            self.env.add_obstacle(3., 0., radius=0.3)
+        recorder.close()
+        self.env.set_recorder(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
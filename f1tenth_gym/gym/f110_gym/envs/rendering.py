@@ -35,9 +35,10 @@ from pyglet.gl import *
 import numpy as np
 from PIL import Image
 import yaml
+import threading
+import time
 
-# helpers
-from f110_gym.envs.collision_models import get_vertices
+from f110_gym.envs.laser_models import crop_map
 
 # zooming constants
 ZOOM_IN_FACTOR = 1.2
@@ -47,17 +48,54 @@ ZOOM_OUT_FACTOR = 1/ZOOM_IN_FACTOR
 CAR_LENGTH = 0.58
 CAR_WIDTH = 0.31
 
+# overlay constants
+TRAJECTORY_LENGTH = 500
+# a car moving further than this (m) between two updates was reset, its trajectory is restarted
+TRAJECTORY_JUMP = 5.
+
+# colors
+EGO_COLOR = [172, 97, 185]
+AGENT_COLOR = [99, 52, 94]
+SCAN_COLOR = [40, 80, 150]
+TRAJECTORY_COLOR = [230, 180, 60]
+PATH_COLOR = [80, 220, 120]
+
+# observation entries used by the renderer, copied into the async renderer's snapshots
+SNAPSHOT_KEYS = ('poses_x', 'poses_y', 'poses_theta', 'lap_times', 'lap_counts')
+OPTIONAL_SNAPSHOT_KEYS = ('scans', 'planned_path')
+
+
+def write_vertices(vertex_list, data):
+    """
+    Copy a numpy array into the vertices of a (stream) vertex list in place, without going through Python lists
+
+    Args:
+        vertex_list (pyglet.graphics.vertexdomain.VertexList): vertex list to update
+        data (np.ndarray): new vertices, any shape with vertex_list's number of elements
+
+    Returns:
+        None
+    """
+    # the array is re-fetched each time since it moves when the batch reallocates its buffers
+    np.ctypeslib.as_array(vertex_list.vertices)[:] = data.ravel()
+
 class EnvRenderer(pyglet.window.Window):
     """
     A window class inherited from pyglet.window.Window, handles the camera/projection interaction, resizing window, and rendering the environment
     """
-    def __init__(self, width, height, *args, **kwargs):
+    def __init__(self, width, height, *args, map_edges_only=False, show_scans=False, show_trajectories=True,
+                 trajectory_length=TRAJECTORY_LENGTH, fov=4.7, **kwargs):
         """
         Class constructor
 
         Args:
             width (int): width of the window
             height (int): height of the window
+            map_edges_only (bool, default=False): only draw the obstacle pixels on the boundary of walls
+            show_scans (bool, default=False): draw every car's scan rays, toggled with the S key
+            show_trajectories (bool, default=True): draw the recent trajectory of every car, toggled with the T key
+            trajectory_length (int, default=500): number of updates kept in each trajectory
+            fov (float, default=4.7): field of view of the laser
 
         Returns:
             None
@@ -83,14 +121,43 @@ class EnvRenderer(pyglet.window.Window):
         # current batch that keeps track of all graphics
         self.batch = pyglet.graphics.Batch()
 
-        # current env map
+        # current env map, all obstacle pixels are drawn from a single vertex list
         self.map_points = None
+        self.map_vlist = None
+        self.map_edges_only = map_edges_only
         
         # current env agent poses, (num_agents, 3), columns are (x, y, theta)
         self.poses = None
 
         # current env agent vertices, (num_agents, 4, 2), 2nd and 3rd dimensions are the 4 corners in 2D
         self.vertices = None
+        # all car quads in one vertex list
+        self.cars = None
+
+        # overlays, drawn below the map and cars from their own batches so they can be toggled.
+        # each is a preallocated vertex list of GL_LINES, updated in place from numpy arrays
+        self.scan_batch = pyglet.graphics.Batch()
+        self.trajectory_batch = pyglet.graphics.Batch()
+        self.path_batch = pyglet.graphics.Batch()
+        self.show_scans = show_scans
+        self.show_trajectories = show_trajectories
+        self.fov = fov
+
+        # scan rays, (num_agents, num_beams, 2, 2) pairs of car position and beam end
+        self.scan_rays = None
+        self.scan_vlist = None
+        self.scan_angles = None
+
+        # trajectories, (num_agents, trajectory_length, 2, 2) ring buffer of line segments
+        self.trajectory_length = trajectory_length
+        self.trajectories = None
+        self.trajectory_vlist = None
+        self.trajectory_index = 0
+
+        # planned path, (path_capacity, 2) points, unused points repeat the last one
+        self.path = None
+        self.path_segments = None
+        self.path_vlist = None
 
         # current score label
         self.score_label = pyglet.text.Label(
@@ -126,31 +193,48 @@ class EnvRenderer(pyglet.window.Window):
                 map_metadata = yaml.safe_load(yaml_stream)
                 map_resolution = map_metadata['resolution']
                 origin = map_metadata['origin']
-                origin_x = origin[0]
-                origin_y = origin[1]
             except yaml.YAMLError as ex:
                 print(ex)
 
-        # load map image
+        # load map image, only obstacles are drawn so the free space around them is cropped
         map_img = np.array(Image.open(map_path + map_ext).transpose(Image.FLIP_TOP_BOTTOM)).astype(np.float64)
-        map_height = map_img.shape[0]
-        map_width = map_img.shape[1]
-
-        # convert map pixels to coordinates
-        range_x = np.arange(map_width)
-        range_y = np.arange(map_height)
-        map_x, map_y = np.meshgrid(range_x, range_y)
-        map_x = (map_x * map_resolution + origin_x).flatten()
-        map_y = (map_y * map_resolution + origin_y).flatten()
-        map_z = np.zeros(map_y.shape)
-        map_coords = np.vstack((map_x, map_y, map_z))
+        map_img, origin = crop_map(map_img, map_resolution, origin, 0.)
+        self.update_map_array(map_img, map_resolution, origin)
+
+    def update_map_array(self, map_img, map_resolution, origin):
+        """
+        Update the map being drawn by the renderer from an image in memory.
 
+        Args:
+            map_img (np.ndarray (n, m)): map image, 0 is obstacle, row 0 is the bottom of the map
+            map_resolution (float): resolution of the map (m/pixel)
+            origin (list [x, y, theta]): pose of the bottom left pixel of the map
+
+        Returns:
+            None
+        """
         # mask and only leave the obstacle points
-        map_mask = map_img == 0.0
-        map_mask_flat = map_mask.flatten()
-        map_points = 50. * map_coords[:, map_mask_flat].T
-        for i in range(map_points.shape[0]):
-            self.batch.add(1, GL_POINTS, None, ('v3f/stream', [map_points[i, 0], map_points[i, 1], map_points[i, 2]]), ('c3B/stream', [183, 193, 222]))
+        map_mask = np.asarray(map_img) == 0.0
+        if self.map_edges_only:
+            # drop obstacle pixels surrounded by obstacles on all 4 sides
+            padded = np.pad(map_mask, 1, constant_values=False)
+            interior = padded[1:-1, 1:-1] & padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+            map_mask = map_mask & ~interior
+
+        # convert obstacle pixels to coordinates
+        rows, cols = np.nonzero(map_mask)
+        map_points = np.zeros((rows.shape[0], 3))
+        map_points[:, 0] = cols * map_resolution + origin[0]
+        map_points[:, 1] = rows * map_resolution + origin[1]
+        map_points = 50. * map_points
+
+        # replace the previous map with a single vertex list
+        if self.map_vlist is not None:
+            self.map_vlist.delete()
+        num_points = map_points.shape[0]
+        self.map_vlist = self.batch.add(num_points, GL_POINTS, None,
+                                        ('v3f/static', map_points.ravel().tolist()),
+                                        ('c3B/static', [183, 193, 222] * num_points))
         self.map_points = map_points
 
     def on_resize(self, width, height):
@@ -256,6 +340,23 @@ class EnvRenderer(pyglet.window.Window):
         super().on_close()
         raise Exception('Rendering window was closed.')
 
+    def on_key_press(self, symbol, modifiers):
+        """
+        Callback function on key presses, S toggles the scan rays and T the trajectories
+
+        Args:
+            symbol (int): key pressed
+            modifiers (int): modifier keys held down
+
+        Returns:
+            None
+        """
+        super().on_key_press(symbol, modifiers)
+        if symbol == pyglet.window.key.S:
+            self.show_scans = not self.show_scans
+        elif symbol == pyglet.window.key.T:
+            self.show_trajectories = not self.show_trajectories
+
     def on_draw(self):
         """
         Function when the pyglet is drawing. The function draws the batch created that includes the map points, the agent polygons, and the information text, and the fps display.
@@ -289,7 +390,12 @@ class EnvRenderer(pyglet.window.Window):
         # Set orthographic projection matrix
         glOrtho(self.left, self.right, self.bottom, self.top, 1, -1)
 
-        # Draw all batches
+        # Draw all batches, overlays first so they stay below the cars
+        if self.show_scans:
+            self.scan_batch.draw()
+        if self.show_trajectories:
+            self.trajectory_batch.draw()
+        self.path_batch.draw()
         self.batch.draw()
         self.fps_display.draw()
         # Remove default modelview matrix
@@ -307,30 +413,223 @@ class EnvRenderer(pyglet.window.Window):
         """
 
         self.ego_idx = obs['ego_idx']
-        poses_x = obs['poses_x']
-        poses_y = obs['poses_y']
-        poses_theta = obs['poses_theta']
-
-        num_agents = len(poses_x)
-        if self.poses is None:
-            self.cars = []
-            for i in range(num_agents):
-                if i == self.ego_idx:
-                    vertices_np = get_vertices(np.array([0., 0., 0.]), CAR_LENGTH, CAR_WIDTH)
-                    vertices = list(vertices_np.flatten())
-                    car = self.batch.add(4, GL_QUADS, None, ('v2f', vertices), ('c3B', [172, 97, 185, 172, 97, 185, 172, 97, 185, 172, 97, 185]))
-                    self.cars.append(car)
-                else:
-                    vertices_np = get_vertices(np.array([0., 0., 0.]), CAR_LENGTH, CAR_WIDTH)
-                    vertices = list(vertices_np.flatten())
-                    car = self.batch.add(4, GL_QUADS, None, ('v2f', vertices), ('c3B', [99, 52, 94, 99, 52, 94, 99, 52, 94, 99, 52, 94]))
-                    self.cars.append(car)
-
-        poses = np.stack((poses_x, poses_y, poses_theta)).T
-        for j in range(poses.shape[0]):
-            vertices_np = 50. * get_vertices(poses[j, :], CAR_LENGTH, CAR_WIDTH)
-            vertices = list(vertices_np.flatten())
-            self.cars[j].vertices = vertices
+        poses = np.stack((obs['poses_x'], obs['poses_y'], obs['poses_theta']), axis=1)
+        num_agents = poses.shape[0]
+
+        if self.cars is None:
+            colors = np.tile(AGENT_COLOR, (num_agents, 4))
+            colors[self.ego_idx] = EGO_COLOR * 4
+            self.cars = self.batch.add(4 * num_agents, GL_QUADS, None,
+                                       ('v2f/stream', [0.] * (8 * num_agents)),
+                                       ('c3B/static', colors.ravel().tolist()))
+
+        # car corners, same order as get_vertices
+        cosines = np.cos(poses[:, 2])[:, None]
+        sines = np.sin(poses[:, 2])[:, None]
+        corners_x = np.array([-CAR_LENGTH / 2, -CAR_LENGTH / 2, CAR_LENGTH / 2, CAR_LENGTH / 2])
+        corners_y = np.array([CAR_WIDTH / 2, -CAR_WIDTH / 2, -CAR_WIDTH / 2, CAR_WIDTH / 2])
+        self.vertices = np.empty((num_agents, 4, 2))
+        self.vertices[:, :, 0] = poses[:, 0:1] + cosines * corners_x - sines * corners_y
+        self.vertices[:, :, 1] = poses[:, 1:2] + sines * corners_x + cosines * corners_y
+        write_vertices(self.cars, 50. * self.vertices)
         self.poses = poses
 
-        self.score_label.text = 'Lap Time: {laptime:.2f}, Ego Lap Count: {count:.0f}'.format(laptime=obs['lap_times'][0], count=obs['lap_counts'][obs['ego_idx']])
\ No newline at end of file
+        if 'scans' in obs:
+            self._update_scans(np.asarray(obs['scans']))
+        self._update_trajectories()
+        if 'planned_path' in obs:
+            self.update_path(obs['planned_path'])
+
+        self.score_label.text = 'Lap Time: {laptime:.2f}, Ego Lap Count: {count:.0f}'.format(laptime=obs['lap_times'][0], count=obs['lap_counts'][obs['ego_idx']])
+
+    def _update_scans(self, scans):
+        """
+        Updates the scan rays of every car
+
+        Args:
+            scans (np.ndarray (num_agents, num_beams)): scans of every car
+
+        Returns:
+            None
+        """
+        num_agents, num_beams = scans.shape
+        if self.scan_rays is None or self.scan_rays.shape[:2] != scans.shape:
+            if self.scan_vlist is not None:
+                self.scan_vlist.delete()
+            self.scan_rays = np.zeros((num_agents, num_beams, 2, 2), dtype=np.float32)
+            self.scan_angles = np.linspace(-self.fov / 2., self.fov / 2., num_beams)
+            self.scan_vlist = self.scan_batch.add(2 * num_agents * num_beams, GL_LINES, None,
+                                                  ('v2f/stream', [0.] * (4 * num_agents * num_beams)),
+                                                  ('c3B/static', SCAN_COLOR * (2 * num_agents * num_beams)))
+
+        angles = self.poses[:, 2:3] + self.scan_angles
+        self.scan_rays[:, :, 0, :] = 50. * self.poses[:, None, :2]
+        self.scan_rays[:, :, 1, 0] = 50. * (self.poses[:, 0:1] + scans * np.cos(angles))
+        self.scan_rays[:, :, 1, 1] = 50. * (self.poses[:, 1:2] + scans * np.sin(angles))
+        write_vertices(self.scan_vlist, self.scan_rays)
+
+    def _update_trajectories(self):
+        """
+        Adds the current car positions to the trajectories
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        num_agents = self.poses.shape[0]
+        positions = 50. * self.poses[:, :2]
+        if self.trajectories is None:
+            self.trajectories = np.empty((num_agents, self.trajectory_length, 2, 2), dtype=np.float32)
+            self.trajectories[:] = positions[:, None, None, :]
+            self.trajectory_vlist = self.trajectory_batch.add(2 * num_agents * self.trajectory_length, GL_LINES, None,
+                                                              ('v2f/stream', [0.] * (4 * num_agents * self.trajectory_length)),
+                                                              ('c3B/static', TRAJECTORY_COLOR * (2 * num_agents * self.trajectory_length)))
+
+        # restart the trajectories of cars that jumped (were reset), collapsing them onto the car
+        last = self.trajectories[:, self.trajectory_index - 1, 1]
+        jumped = np.hypot(*(positions - last).T) > 50. * TRAJECTORY_JUMP
+        self.trajectories[jumped] = positions[jumped, None, None, :]
+
+        # overwrite the oldest segment with one from the last position to the current one
+        self.trajectories[:, self.trajectory_index, 0] = self.trajectories[:, self.trajectory_index - 1, 1]
+        self.trajectories[:, self.trajectory_index, 1] = positions
+        self.trajectory_index = (self.trajectory_index + 1) % self.trajectory_length
+        write_vertices(self.trajectory_vlist, self.trajectories)
+
+    def update_path(self, path):
+        """
+        Updates the planned path being drawn, e.g. a planner's waypoints or lookahead
+
+        Args:
+            path (np.ndarray (n, 2+)): points of the path in world coordinates, None clears it
+
+        Returns:
+            None
+        """
+        if path is None:
+            path = np.zeros((1, 2))
+        path = np.asarray(path)[:, :2]
+        if self.path is None or path.shape[0] > self.path.shape[0]:
+            # only reallocate when the path grows past the capacity
+            if self.path_vlist is not None:
+                self.path_vlist.delete()
+            capacity = max(2, path.shape[0])
+            self.path = np.empty((capacity, 2), dtype=np.float32)
+            self.path_segments = np.empty((capacity - 1, 2, 2), dtype=np.float32)
+            self.path_vlist = self.path_batch.add(2 * (capacity - 1), GL_LINES, None,
+                                                  ('v2f/stream', [0.] * (4 * (capacity - 1))),
+                                                  ('c3B/static', PATH_COLOR * (2 * (capacity - 1))))
+
+        self.path[:path.shape[0]] = 50. * path
+        self.path[path.shape[0]:] = self.path[path.shape[0] - 1]
+        self.path_segments[:, 0] = self.path[:-1]
+        self.path_segments[:, 1] = self.path[1:]
+        write_vertices(self.path_vlist, self.path_segments)
+
+
+class AsyncRenderer(object):
+    """
+    Runs an EnvRenderer on its own thread, so that rendering doesn't throttle the simulation.
+
+    update_obs() only copies the observation into a single latest-value slot, replacing whatever the
+    render thread hasn't drawn yet. The render thread owns the pyglet window and draws the newest
+    snapshot at most max_fps times per second, skipping the intermediate ones.
+    """
+    def __init__(self, width, height, max_fps=30., map_path=None, map_ext=None, map_array=None, **kwargs):
+        """
+        Class constructor, starts the render thread
+
+        Args:
+            width (int): width of the window
+            height (int): height of the window
+            max_fps (float, default=30.): frame rate cap of the render thread
+            map_path (str, default=None): absolute path to the map without extensions
+            map_ext (str, default=None): extension for the map image file
+            map_array (tuple (map_img, map_resolution, origin), default=None): map in memory, used instead of map_path if given
+            kwargs: passed on to EnvRenderer
+
+        Returns:
+            None
+        """
+        self.frame_time = 1. / max_fps
+        # (sequence number, snapshot), replaced as a whole so the render thread never sees a partial update
+        self.latest = (0, None)
+        self.running = True
+        # exception raised on the render thread, e.g. the window being closed
+        self.error = None
+
+        self.thread = threading.Thread(target=self._run,
+                                       args=(width, height, map_path, map_ext, map_array, kwargs),
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self, width, height, map_path, map_ext, map_array, kwargs):
+        """
+        Render loop, everything touching the window or OpenGL happens here
+        """
+        window = None
+        try:
+            window = EnvRenderer(width, height, **kwargs)
+            if map_array is None:
+                window.update_map(map_path, map_ext)
+            else:
+                window.update_map_array(*map_array)
+
+            drawn = 0
+            next_frame = time.perf_counter()
+            while self.running:
+                window.dispatch_events()
+                sequence, snapshot = self.latest
+                if sequence != drawn:
+                    drawn = sequence
+                    window.update_obs(snapshot)
+                    window.on_draw()
+                    window.flip()
+
+                # cap the frame rate
+                next_frame = max(next_frame + self.frame_time, time.perf_counter())
+                time.sleep(max(0., next_frame - time.perf_counter()))
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.running = False
+            if window is not None and window.context is not None:
+                pyglet.window.Window.close(window)
+
+    def update_obs(self, obs):
+        """
+        Hands the latest observation over to the render thread, returns immediately
+
+        Args:
+            obs (dict): observation dict from the gym env
+
+        Returns:
+            None
+
+        Raises:
+            Exception: the exception that stopped the render thread, e.g. the window being closed
+        """
+        if not self.running:
+            raise self.error if self.error is not None else Exception('Renderer was closed.')
+        snapshot = {key: np.array(obs[key]) for key in SNAPSHOT_KEYS}
+        for key in OPTIONAL_SNAPSHOT_KEYS:
+            if key in obs:
+                snapshot[key] = None if obs[key] is None else np.array(obs[key])
+        snapshot['ego_idx'] = obs['ego_idx']
+        self.latest = (self.latest[0] + 1, snapshot)
+
+    def close(self):
+        """
+        Stops the render thread and closes its window
+
+        Args:
+            None
+
+        Returns:
+            None
+        """
+        self.running = False
+        if self.thread is not threading.current_thread():
+            self.thread.join()
@@ -0,0 +1,307 @@
+# MIT License
+
+# Copyright (c) 2020 Joseph Auckley, Matthew O'Kelly, Aman Sinha, Hongrui Zheng
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+
+"""
+Deterministic replay of episodes recorded by EpisodeRecorder
+"""
+
+import numpy as np
+import os
+
+from f110_gym.envs.recording import EpisodeLog, restore_snapshot
+from f110_gym.envs.laser_models import get_dt
+
+import unittest
+
+
+class Replay(object):
+    """
+    Re-simulates recorded episodes from their reset poses and actions, reproducing the recorded states exactly.
+
+    Nothing is rendered, and with skip_scans the scans of steps nobody looks at aren't traced unless they could
+    trigger a collision (see RaceCar.scan_is_safe). The noise of every scan is still drawn, so the simulation is
+    the same as with full scans. seek() starts from the latest snapshot saved by the recorder before the target
+    step, so reaching a late step of a long episode only re-simulates up to snapshot_interval steps.
+    """
+
+    def __init__(self, log, env=None, skip_scans=True):
+        """
+        Class constructor
+
+        Args:
+            log (EpisodeLog or str): log, or directory of the log, to replay
+            env (F110Env, default=None): environment to replay in, one is made for the first episode's map if None
+            skip_scans (bool, default=True): skip the scans of the steps stepped over by seek()
+
+        Returns:
+            None
+        """
+        self.log = log if isinstance(log, EpisodeLog) else EpisodeLog(log)
+        self.env = env
+        self.skip_scans = skip_scans
+
+        # episode being replayed and its recorded actions
+        self.episode = None
+        self.actions = None
+        self.snapshots = None
+        # step of the episode the env is at, 0 is the reset
+        self.step_index = None
+        self.obs = None
+        # map currently loaded in the env
+        self.map = None
+
+    def _load_map(self, entry):
+        """
+        Loads a map from the episode index into the env, unless it's already loaded
+        """
+        if entry == self.map:
+            return
+        if 'path' in entry:
+            self.env.update_map(entry['path'], entry['ext'])
+        else:
+            map_img = np.load(os.path.join(self.log.directory, 'maps', entry['array'] + '.npy'))
+            # same distance transform as when recording, e.g. the float32 one of the track library
+            bitmap = np.where(map_img > 128., 255., 0.)
+            dt = get_dt(bitmap, entry['resolution']).astype(entry.get('dt_dtype', 'float64'))
+            self.env.update_map_array(bitmap, entry['resolution'], entry['origin'], dt)
+        self.map = entry
+
+    def load_episode(self, episode):
+        """
+        Resets the env to the start of a recorded episode
+
+        Args:
+            episode (int): index of the episode in the log
+
+        Returns:
+            obs (dict): observation after the reset
+        """
+        info = self.log.episodes[episode]
+        if self.env is None:
+            from f110_gym.envs.f110_env import F110Env
+            kwargs = {'seed': info['seed'], 'num_agents': info['num_agents'], 'ego_idx': info['ego_idx'],
+                      'timestep': info['timestep'], 'params': info['params'][0]}
+            if 'path' in info['map']:
+                kwargs.update(map=os.path.splitext(info['map']['path'])[0], map_ext=info['map']['ext'])
+                self.map = info['map']
+            self.env = F110Env(**kwargs)
+        # replayed steps aren't recorded again
+        self.env.set_recorder(None)
+        self._load_map(info['map'])
+        for i, params in enumerate(info['params']):
+            self.env.update_params(params, index=i)
+
+        self.episode = episode
+        self.actions = self.log.read('action', *self.log.episode_range(episode))
+        self.snapshots = self.log.snapshots(episode)
+        return self._reset()
+
+    def _reset(self):
+        """
+        Resets the env to the recorded poses, the rng of every agent's scans is reset with it
+        """
+        self.env.sim.set_skip_safe_scans(False)
+        self.obs = self.env.reset(np.array(self.log.episodes[self.episode]['poses']))[0]
+        self.step_index = 0
+        return self.obs
+
+    def __len__(self):
+        # number of steps of the episode, including the reset
+        return self.actions.shape[0]
+
+    def step(self, scan=True):
+        """
+        Re-simulates the next recorded step
+
+        Args:
+            scan (bool, default=True): trace the scans of this step, if False they may be nan
+
+        Returns:
+            obs (dict): observation of the step
+        """
+        if self.step_index + 1 >= len(self):
+            raise IndexError('Episode {} has no step after {}.'.format(self.episode, self.step_index))
+        self.env.sim.set_skip_safe_scans(self.skip_scans and not scan)
+        self.step_index += 1
+        self.obs = self.env.step(self.actions[self.step_index])[0]
+        return self.obs
+
+    def seek(self, step):
+        """
+        Moves the env to a step of the episode, with the scans of that step traced
+
+        Args:
+            step (int): step of the episode, 0 is the reset
+
+        Returns:
+            obs (dict): observation of the step
+        """
+        if step < 0 or step >= len(self):
+            raise IndexError('Episode {} has no step {}.'.format(self.episode, step))
+
+        # latest snapshot strictly before the step, so that the step itself is simulated with its scans
+        snapshot = None
+        for candidate in self.snapshots:
+            if candidate['step'] < step:
+                snapshot = candidate
+        if step < self.step_index or step == 0:
+            self._reset()
+        if snapshot is not None and snapshot['step'] > self.step_index:
+            restore_snapshot(self.env, snapshot['snapshot'])
+            self.step_index = snapshot['step']
+
+        while self.step_index < step:
+            self.step(scan=self.step_index + 1 == step)
+        return self.obs
+
+    def divergence(self, stop=None):
+        """
+        Replays the episode from its reset and compares the states with the recorded ones
+
+        Args:
+            stop (int, default=None): step to stop at, the whole episode if None
+
+        Returns:
+            step (int): first step whose states differ from the recording, None if they all match
+        """
+        start, end = self.log.episode_range(self.episode)
+        stop = end - start if stop is None else stop
+        states = self.log.read('state', start, start + stop)
+        self._reset()
+        for step in range(stop):
+            if step > 0:
+                self.step(scan=False)
+            replayed = np.stack([agent.state for agent in self.env.sim.agents])
+            if not np.array_equal(replayed, states[step]):
+                return step
+        return None
+
+
+"""
+Unit tests for replays
+"""
+
+class ReplayTests(unittest.TestCase):
+    def setUp(self):
+        from f110_gym.envs.f110_env import F110Env
+        from f110_gym.envs.recording import EpisodeRecorder
+        from PIL import Image
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        # walled 20 x 20 m map with a wall in the middle
+        map_img = np.full((400, 400), 255, dtype=np.uint8)
+        map_img[[0, -1], :] = 0
+        map_img[:, [0, -1]] = 0
+        map_img[150:250, 240:250] = 0
+        map_path = os.path.join(self.directory, 'box')
+        Image.fromarray(map_img).save(map_path + '.png')
+        with open(map_path + '.yaml', 'w') as f:
+            f.write('resolution: 0.05\norigin: [-10., -10., 0.]\n')
+        self.env = F110Env(map=map_path, map_ext='.png', num_agents=2)
+
+        # two episodes of random driving, the first ending against the wall in the middle
+        rng = np.random.default_rng(0)
+        self.log_directory = os.path.join(self.directory, 'log')
+        recorder = EpisodeRecorder(self.log_directory, chunk_steps=128, snapshot_interval=50)
+        self.env.set_recorder(recorder)
+        self.scans = []
+        for episode in range(2):
+            self.env.reset(np.array([[-2., 0., 0.], [-4., 1., 0.]]))
+            self.scans.append([self.env.current_obs['scans'][0].copy()])
+            for step in range(300):
+                action = np.column_stack((rng.uniform(-0.2, 0.2, 2), rng.uniform(1., 4., 2)))
+                obs, _, done, _ = self.env.step(action)
+                self.scans[-1].append(obs['scans'][0].copy())
+                if done:
+                    break
+        recorder.close()
+        self.env.set_recorder(None)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_exact_replay(self):
+        replay = Replay(self.log_directory)
+        for episode in range(2):
+            replay.load_episode(episode)
+            self.assertIsNone(replay.divergence())
+        # the recorded episode ended in a collision, which the replay skipping scans reproduced
+        log = EpisodeLog(self.log_directory)
+        self.assertTrue(np.any(log.episode(0)['collision'][-1]))
+
+    def test_seek(self):
+        replay = Replay(self.log_directory)
+        replay.load_episode(1)
+        states = replay.log.episode(1)['state']
+        # forwards past a few snapshots, backwards, then onto a snapshot step
+        for step in [170, 30, 100, len(replay) - 1, 0]:
+            obs = replay.seek(step)
+            self.assertTrue(np.array_equal(np.stack([agent.state for agent in replay.env.sim.agents]), states[step]))
+            self.assertTrue(np.array_equal(obs['scans'][0], self.scans[1][step]))
+
+    def test_skipped_scans(self):
+        replay = Replay(self.log_directory)
+        replay.load_episode(1)
+        obs = replay.step(scan=False)
+        self.assertTrue(np.all(np.isnan(obs['scans'][0])))
+        obs = replay.step()
+        self.assertTrue(np.array_equal(obs['scans'][0], self.scans[1][2]))
+
+    def test_float32_dt(self):
+        from f110_gym.envs.recording import EpisodeRecorder
+        # in-memory map with a float32 distance transform, like the track library's
+        map_img = np.full((400, 400), 255, dtype=np.uint8)
+        map_img[[0, -1], :] = 0
+        map_img[:, [0, -1]] = 0
+        map_img[150:250, 240:250] = 0
+        dt = get_dt(map_img.astype(np.float64), 0.05).astype(np.float32)
+        self.env.update_map_array(map_img, 0.05, [-10., -10., 0.], dt)
+        log_directory = os.path.join(self.directory, 'float32')
+        recorder = EpisodeRecorder(log_directory)
+        self.env.set_recorder(recorder)
+        self.env.reset(np.array([[-2., 0., 0.], [-4., 1., 0.]]))
+        scans = [self.env.current_obs['scans'][0].copy()]
+        for step in range(100):
+            obs, _, _, _ = self.env.step(np.array([[0.05, 3.], [-0.05, 2.]]))
+            scans.append(obs['scans'][0].copy())
+        recorder.close()
+        self.env.set_recorder(None)
+
+        # replayed in the same env, back on the file map
+        self.env.update_map(os.path.join(self.directory, 'box.yaml'), '.png')
+        replay = Replay(log_directory, env=self.env)
+        replay.load_episode(0)
+        self.assertEqual(replay.env.sim.agents[0].scan_simulator.dt.dtype, np.float32)
+        self.assertIsNone(replay.divergence())
+        obs = replay.seek(0)
+        self.assertTrue(np.array_equal(obs['scans'][0], scans[0]))
+        for step in range(1, len(scans)):
+            obs = replay.step()
+            self.assertTrue(np.array_equal(obs['scans'][0], scans[step]))
+
+
+if __name__ == '__main__':
+    unittest.main()
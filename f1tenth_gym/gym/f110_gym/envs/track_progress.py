@@ -0,0 +1,363 @@
+# MIT License
+
+# Copyright (c) 2020 Joseph Auckley, Matthew O'Kelly, Aman Sinha, Hongrui Zheng
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+
+"""
+Progress tracking of vehicles along a closed track centerline
+"""
+
+import numpy as np
+from numba import njit
+from scipy.spatial import cKDTree
+
+import unittest
+
+@njit(cache=True)
+def project_on_segment(x, y, idx, points, seg_vecs, seg_len2):
+    """
+    Project a point onto one segment of the centerline
+
+        Args:
+            x (float): x coordinate of the point
+            y (float): y coordinate of the point
+            idx (int): index of the segment
+            points (numpy.ndarray (n, 2)): start points of each segment
+            seg_vecs (numpy.ndarray (n, 2)): vector from the start to the end of each segment
+            seg_len2 (numpy.ndarray (n, )): squared length of each segment
+
+        Returns:
+            t (float): normalised position of the projection along the segment, in [0, 1]
+            dist2 (float): squared distance from the point to its projection
+    """
+    dx = x - points[idx, 0]
+    dy = y - points[idx, 1]
+    t = (dx * seg_vecs[idx, 0] + dy * seg_vecs[idx, 1]) / seg_len2[idx]
+    if t < 0.:
+        t = 0.
+    elif t > 1.:
+        t = 1.
+    ex = dx - t * seg_vecs[idx, 0]
+    ey = dy - t * seg_vecs[idx, 1]
+    return t, ex*ex + ey*ey
+
+@njit(cache=True)
+def windowed_nearest_segment(x, y, start_idx, window, points, seg_vecs, seg_len2):
+    """
+    Find the nearest segment of a closed centerline, only searching the segments within a window around a starting index
+
+        Args:
+            x (float): x coordinate of the point
+            y (float): y coordinate of the point
+            start_idx (int): segment index the search is centered on, usually the previous nearest segment
+            window (int): number of segments searched on each side of start_idx
+            points, seg_vecs, seg_len2: centerline geometry, see project_on_segment
+
+        Returns:
+            best_idx (int): index of the nearest segment
+            best_t (float): normalised position of the projection along the nearest segment
+            best_dist2 (float): squared distance to the nearest segment
+    """
+    num_segs = points.shape[0]
+    best_idx = start_idx
+    best_t = 0.
+    best_dist2 = np.inf
+    # the window can't cover more than the full loop
+    if 2 * window + 1 > num_segs:
+        window = num_segs // 2
+    for offset in range(-window, window + 1):
+        idx = (start_idx + offset) % num_segs
+        t, dist2 = project_on_segment(x, y, idx, points, seg_vecs, seg_len2)
+        if dist2 < best_dist2:
+            best_idx = idx
+            best_t = t
+            best_dist2 = dist2
+    return best_idx, best_t, best_dist2
+
+@njit(cache=True)
+def segment_frame(x, y, theta, idx, t, points, seg_vecs, seg_lens, seg_headings, cum_s):
+    """
+    Get the track relative coordinates of a pose, given its nearest segment
+
+        Args:
+            x, y, theta (float): pose of the vehicle
+            idx (int): nearest segment index
+            t (float): normalised position of the projection along the segment
+            points, seg_vecs: centerline geometry, see project_on_segment
+            seg_lens (numpy.ndarray (n, )): length of each segment
+            seg_headings (numpy.ndarray (n, )): heading of each segment
+            cum_s (numpy.ndarray (n, )): arc length at the start of each segment
+
+        Returns:
+            s (float): arc length along the centerline of the projected point
+            lateral (float): signed distance to the centerline, positive to the left of the direction of travel
+            heading_err (float): heading of the vehicle relative to the centerline, wrapped to [-pi, pi)
+    """
+    # the end of a segment is the start of the next one, keeps s in [0, length)
+    if t >= 1.:
+        idx = (idx + 1) % points.shape[0]
+        t = 0.
+    s = cum_s[idx] + t * seg_lens[idx]
+    dx = x - points[idx, 0]
+    dy = y - points[idx, 1]
+    lateral = (seg_vecs[idx, 0] * dy - seg_vecs[idx, 1] * dx) / seg_lens[idx]
+    heading_err = np.fmod(theta - seg_headings[idx] + np.pi, 2. * np.pi)
+    if heading_err < 0.:
+        heading_err += 2. * np.pi
+    return s, lateral, heading_err - np.pi
+
+@njit(cache=True)
+def track_step(poses_x, poses_y, poses_theta, indices, window, lost_dist2, points, seg_vecs, seg_len2, seg_lens, seg_headings, cum_s, s_out, lateral_out, heading_out):
+    """
+    Windowed nearest segment search for multiple vehicles, writes the track relative coordinates of each vehicle into the output arrays
+
+        Args:
+            poses_x, poses_y, poses_theta (numpy.ndarray (num_agents, )): poses of the vehicles
+            indices (numpy.ndarray (num_agents, )): previous nearest segment of each vehicle, updated in place
+            window (int): number of segments searched on each side of the previous index
+            lost_dist2 (float): squared distance above which a vehicle is considered lost
+            points, seg_vecs, seg_len2, seg_lens, seg_headings, cum_s: centerline geometry, see segment_frame
+            s_out, lateral_out, heading_out (numpy.ndarray (num_agents, )): output arrays
+
+        Returns:
+            lost (numpy.ndarray (num_agents, )): whether the windowed search lost each vehicle, these entries are left untouched
+    """
+    num_agents = poses_x.shape[0]
+    lost = np.zeros((num_agents, ), dtype=np.bool_)
+    for i in range(num_agents):
+        idx, t, dist2 = windowed_nearest_segment(poses_x[i], poses_y[i], indices[i], window, points, seg_vecs, seg_len2)
+        if dist2 > lost_dist2:
+            lost[i] = True
+            continue
+        indices[i] = idx
+        s_out[i], lateral_out[i], heading_out[i] = segment_frame(poses_x[i], poses_y[i], poses_theta[i], idx, t, points, seg_vecs, seg_lens, seg_headings, cum_s)
+    return lost
+
+
+class TrackProgress(object):
+    """
+    Tracks the progress of vehicles along a closed centerline.
+
+    The centerline geometry (segments, cumulative arc length, headings) is precomputed once.
+    Each step, the nearest segment of each vehicle is found by searching a small window
+    around its previous nearest segment, so the cost per step doesn't depend on the length of the track.
+    A KD-tree over the centerline points is used as a fallback when a vehicle is lost
+    (after a reset, or when it moves further than the window in one step).
+
+    Data Members:
+        num_agents (int): number of vehicles tracked
+        window (int): number of segments searched on each side of the previous nearest segment
+        lost_dist (float): distance to the windowed nearest segment above which the global search is used
+        points (np.ndarray (n, 2)): centerline points, each one the start of a segment, last segment wraps to the first point
+        point_indices (np.ndarray (n, )): row of the waypoints each point comes from, repeated waypoints are dropped
+        length (float): total length of the closed centerline
+        indices (np.ndarray (num_agents, )): current nearest segment of each vehicle
+        s (np.ndarray (num_agents, )): current arc length along the centerline of each vehicle
+        lateral_offset (np.ndarray (num_agents, )): current signed distance of each vehicle to the centerline, positive to the left
+        heading_error (np.ndarray (num_agents, )): current heading of each vehicle relative to the centerline
+    """
+
+    def __init__(self, waypoints, num_agents=1, window=10, lost_dist=3.0):
+        """
+        Init function
+
+        Args:
+            waypoints (np.ndarray (n, m>=2)): centerline waypoints, first two columns are x and y, the track is assumed to be closed
+            num_agents (int, default=1): number of vehicles tracked
+            window (int, default=10): number of segments searched on each side of the previous nearest segment
+            lost_dist (float, default=3.0): distance to the windowed nearest segment above which the global search is used
+
+        Returns:
+            None
+        """
+        self.num_agents = num_agents
+        self.window = window
+        self.lost_dist = lost_dist
+
+        # drop repeated points, including a closing point equal to the first one
+        points = np.ascontiguousarray(waypoints[:, 0:2], dtype=np.float64)
+        next_points = np.roll(points, -1, axis=0)
+        keep = np.any(points != next_points, axis=1)
+        self.points = np.ascontiguousarray(points[keep])
+        self.point_indices = np.flatnonzero(keep)
+        if self.points.shape[0] < 3:
+            raise ValueError('Centerline needs at least 3 distinct points.')
+
+        # segment geometry, segment i goes from point i to point i+1 (wrapping around)
+        self.seg_vecs = np.roll(self.points, -1, axis=0) - self.points
+        self.seg_len2 = np.sum(self.seg_vecs**2, axis=1)
+        self.seg_lens = np.sqrt(self.seg_len2)
+        self.seg_headings = np.arctan2(self.seg_vecs[:, 1], self.seg_vecs[:, 0])
+        self.cum_s = np.concatenate(([0.], np.cumsum(self.seg_lens)[:-1]))
+        self.length = np.sum(self.seg_lens)
+
+        # spatial index for the global search
+        self.tree = cKDTree(self.points)
+
+        # per agent state
+        self.indices = np.zeros((num_agents, ), dtype=np.int64)
+        self.s = np.zeros((num_agents, ))
+        self.lateral_offset = np.zeros((num_agents, ))
+        self.heading_error = np.zeros((num_agents, ))
+
+    def _global_search(self, x, y, theta, i):
+        """
+        Finds the nearest segment of one vehicle without using its previous index, using the KD-tree
+
+        Args:
+            x, y, theta (float): pose of the vehicle
+            i (int): index of the vehicle
+
+        Returns:
+            None
+        """
+        # the nearest segment starts or ends at one of the nearest points
+        _, nearest = self.tree.query([x, y], k=min(4, self.points.shape[0]))
+        best_idx, best_t, best_dist2 = 0, 0., np.inf
+        for point_idx in np.atleast_1d(nearest):
+            idx, t, dist2 = windowed_nearest_segment(x, y, int(point_idx), 1, self.points, self.seg_vecs, self.seg_len2)
+            if dist2 < best_dist2:
+                best_idx, best_t, best_dist2 = idx, t, dist2
+        self.indices[i] = best_idx
+        self.s[i], self.lateral_offset[i], self.heading_error[i] = segment_frame(x, y, theta, best_idx, best_t, self.points, self.seg_vecs, self.seg_lens, self.seg_headings, self.cum_s)
+
+    def reset(self, poses_x, poses_y, poses_theta, agents=None):
+        """
+        Resets the tracked vehicles to new poses, using the global search
+
+        Args:
+            poses_x, poses_y, poses_theta (array-like (num_agents, )): new poses of the vehicles
+            agents (iterable of int, default=None): only reset these vehicles, all of them if None
+
+        Returns:
+            None
+        """
+        for i in range(self.num_agents) if agents is None else agents:
+            self._global_search(poses_x[i], poses_y[i], poses_theta[i], i)
+
+    def step(self, poses_x, poses_y, poses_theta):
+        """
+        Updates the track relative coordinates of all vehicles
+
+        Args:
+            poses_x, poses_y, poses_theta (array-like (num_agents, )): current poses of the vehicles
+
+        Returns:
+            s (np.ndarray (num_agents, )): arc length along the centerline of each vehicle
+            lateral_offset (np.ndarray (num_agents, )): signed distance to the centerline of each vehicle
+            heading_error (np.ndarray (num_agents, )): heading relative to the centerline of each vehicle
+        """
+        poses_x = np.asarray(poses_x, dtype=np.float64)
+        poses_y = np.asarray(poses_y, dtype=np.float64)
+        poses_theta = np.asarray(poses_theta, dtype=np.float64)
+        lost = track_step(poses_x, poses_y, poses_theta, self.indices, self.window, self.lost_dist**2,
+                          self.points, self.seg_vecs, self.seg_len2, self.seg_lens, self.seg_headings, self.cum_s,
+                          self.s, self.lateral_offset, self.heading_error)
+        for i in np.flatnonzero(lost):
+            self._global_search(poses_x[i], poses_y[i], poses_theta[i], i)
+        return self.s, self.lateral_offset, self.heading_error
+
+    def progress(self):
+        """
+        Fraction of a lap along the centerline of each vehicle
+
+        Args:
+            None
+
+        Returns:
+            progress (np.ndarray (num_agents, )): position along the centerline in [0, 1)
+        """
+        return self.s / self.length
+
+    def get_info(self):
+        """
+        Track relative information of each vehicle, in the format of the env's info dict
+
+        Args:
+            None
+
+        Returns:
+            info (dict): progress, arc length, lateral offset and heading error of each vehicle
+        """
+        return {'progress': self.progress(),
+                'arc_length': self.s.copy(),
+                'lateral_offset': self.lateral_offset.copy(),
+                'heading_error': self.heading_error.copy()}
+
+
+"""
+Unit tests for the track progress tracker
+"""
+
+class TrackProgressTests(unittest.TestCase):
+    def setUp(self):
+        # circle of radius 10, counter clockwise
+        angles = np.linspace(0., 2*np.pi, num=500, endpoint=False)
+        self.radius = 10.
+        self.waypoints = self.radius * np.stack((np.cos(angles), np.sin(angles)), axis=1)
+
+    def test_progress_around_circle(self):
+        tracker = TrackProgress(self.waypoints)
+        tracker.reset([self.radius], [0.], [np.pi/2])
+        for angle in np.linspace(0.1, 1.5*np.pi, num=100):
+            # slightly inside the circle, facing along the track
+            r = self.radius - 0.5
+            s, lateral, heading = tracker.step([r*np.cos(angle)], [r*np.sin(angle)], [angle + np.pi/2])
+            self.assertAlmostEqual(tracker.progress()[0], angle/(2*np.pi), places=2)
+            self.assertAlmostEqual(lateral[0], 0.5, places=2)
+            self.assertAlmostEqual(heading[0], 0., places=1)
+
+    def test_lost_fallback(self):
+        tracker = TrackProgress(self.waypoints, window=2)
+        tracker.reset([self.radius], [0.], [0.])
+        # jump to the other side of the track, far outside the search window
+        tracker.step([-self.radius], [0.], [0.])
+        self.assertAlmostEqual(tracker.progress()[0], 0.5, places=2)
+
+    def test_matches_brute_force(self):
+        tracker = TrackProgress(self.waypoints, num_agents=2)
+        poses = np.array([[self.radius, 0.], [0., self.radius]])
+        tracker.reset(poses[:, 0], poses[:, 1], [0., 0.])
+        rng = np.random.default_rng(1234)
+        for _ in range(200):
+            # random walk close to the track
+            poses += rng.uniform(-0.3, 0.3, size=(2, 2))
+            poses *= self.radius / np.linalg.norm(poses, axis=1)[:, None]
+            tracker.step(poses[:, 0], poses[:, 1], [0., 0.])
+            for i in range(2):
+                diffs = tracker.points - poses[i]
+                brute = np.argmin(np.sum(diffs**2, axis=1))
+                ds = abs(tracker.s[i] - tracker.cum_s[brute])
+                self.assertLess(min(ds, tracker.length - ds), np.max(tracker.seg_lens) + 1e-6)
+
+    def test_partial_reset(self):
+        # closing point repeating the first one is dropped
+        tracker = TrackProgress(np.vstack((self.waypoints, self.waypoints[:1])), num_agents=2)
+        self.assertTrue(np.array_equal(tracker.point_indices, np.arange(500)))
+        tracker.reset([self.radius, 0.], [0., self.radius], [0., 0.])
+        # only the second vehicle moves to the other side
+        tracker.reset([self.radius, 0.], [0., -self.radius], [0., 0.], agents=[1])
+        self.assertAlmostEqual(tracker.progress()[0], 0., places=2)
+        self.assertAlmostEqual(tracker.progress()[1], 0.75, places=2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# MIT License
+
+# Copyright (c) 2021 Eoin Gogarty, Charlie Maguire and Manus McAuliffe (Formula Trintiy Autonomous)
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Replays an episode recorded with an EpisodeRecorder, e.g. to look at a crash late in a training run
+
+    python replaying.py ./recording -e 12 -s 80000 --render 300
+"""
+
+import time
+import argparse
+import numpy as np
+
+from f110_gym.envs.replay import Replay
+
+
+def main(args):
+    replay = Replay(args.log, skip_scans=not args.full_scans)
+    replay.load_episode(args.episode)
+    print("Episode {} has {} steps".format(args.episode, len(replay)))
+
+    if args.check:
+        start = time.time()
+        step = replay.divergence()
+        if step is None:
+            print("Replay matches the recording ({:.1f}s)".format(time.time() - start))
+        else:
+            print("Replay diverges from the recording at step {}".format(step))
+
+    # jump to the step of interest, then simulate a few steps from there
+    step = len(replay) - 1 if args.step is None else args.step
+    step = max(0, min(step - args.render, len(replay) - 1)) if args.render else step
+    start = time.time()
+    obs = replay.seek(step)
+    print("Seeked to step {} in {:.2f}s".format(step, time.time() - start))
+    for _ in range(min(args.render, len(replay) - 1 - step)):
+        replay.env.render(mode='human_async')
+        obs = replay.step()
+    print("Step {}: poses x {} y {} theta {}, collisions {}".format(
+        replay.step_index, *[np.round(obs[key], 3) for key in ('poses_x', 'poses_y', 'poses_theta', 'collisions')]))
+    replay.env.close()
+
+
+if __name__ == "__main__":
+    # parse runtime arguments to script
+    parser = argparse.ArgumentParser()
+    parser.add_argument("log",
+                        help="directory of the recording")
+    parser.add_argument("-e",
+                        "--episode",
+                        help="index of the episode to replay",
+                        type=int,
+                        default=0)
+    parser.add_argument("-s",
+                        "--step",
+                        help="step to stop at, the last step of the episode by default",
+                        type=int)
+    parser.add_argument("-r",
+                        "--render",
+                        help="render this many steps leading up to the step",
+                        type=int,
+                        default=0)
+    parser.add_argument("--check",
+                        help="check the replay against the recorded states first",
+                        action="store_true")
+    parser.add_argument("--full-scans",
+                        help="trace every scan instead of skipping provably unchanged ones",
+                        action="store_true")
+    args = parser.parse_args()
+    main(args)
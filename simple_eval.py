@@ -42,6 +42,6 @@ while episode < MIN_EVAL_EPISODES:
             if done:
                 print("Lap done")
             print("R:", reward)
-            eval_env.render()
+            eval_env.render(mode='human_async')
     except KeyboardInterrupt:
         pass
\ No newline at end of file
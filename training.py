@@ -39,6 +39,7 @@ from stable_baselines3.common.vec_env import SubprocVecEnv
 from stable_baselines3.common.env_util import make_vec_env
 
 from code.wrappers import F110_Wrapped, RandomMap
+from code.vec_wrappers import DecodeScans
 from code.eoin_callbacks import SaveOnBestTrainingRewardCallback
 
 
@@ -48,6 +49,7 @@ NUM_PROCESS = 4
 MAP_PATH = "./f1tenth_gym/examples/example_map"
 MAP_EXTENSION = ".png"
 MAP_CHANGE_INTERVAL = 3000
+SCAN_ENCODING = "mm"  # scans sent from the env processes as uint16 millimetres, None sends normalised floats
 TENSORBOARD_PATH = "./ppo_tensorboard"
 SAVE_CHECK_FREQUENCY = int(TRAIN_STEPS / 10)
 
@@ -70,7 +72,7 @@ def main(args):
                        map_ext=MAP_EXTENSION,
                        num_agents=1)
         # wrap basic gym with RL functions
-        env = F110_Wrapped(env)
+        env = F110_Wrapped(env, scan_encoding=SCAN_ENCODING)
         env = RandomMap(env, MAP_CHANGE_INTERVAL)
         return env
 
@@ -84,6 +86,9 @@ def main(args):
                         seed=np.random.randint(pow(2, 32) - 1),
                         monitor_dir=log_dir,
                         vec_env_cls=SubprocVecEnv)
+    # normalise the encoded scans once they're out of the env processes
+    if SCAN_ENCODING is not None:
+        envs = DecodeScans(envs)
 
     # load or create model
     model, reset_num_timesteps = load_model(args.load,